@@ -3,15 +3,22 @@ import time
 
 from android_world.agents import base_agent
 from android_world.agents import infer
+from android_world.agents import prompt_layout
+from android_world.agents import plan_history
+from android_world.agents import action_parser
+from android_world.agents import ui_element_matcher
+from android_world.agents import screen_settle
 from android_world.env import interface
 from android_world.env import json_action
-from typing import Any, Optional
-import re
-from typing import  Optional
+from typing import Optional
 import json
-import ast
 
-PLAN_PROMPT_TEMPLATE = """# Role & Objective:
+APP_NAME_LIST = '["Camera","Chrome","Clock","Contacts","Dialer","Files","Settings","Markor","Tasks","Simple Draw Pro","Simple Gallery Pro","Simple SMS Messenger","Audio Recorder","Pro Expense","Broccoli APP","OSMand","VLC","Joplin","Retro Music","OpenTracks","Simple Calendar Pro"]'
+CURRENT_TIME = "Today is October 15, Sunday, 2023, 23:34:00, which means it's the final day of this week."
+
+# The planner prompt is kept in pieces: the legacy layout interleaves them with the
+# per-step fields, the prefix-cache layout moves everything static to the system prompt.
+PLAN_INSTRUCTIONS = """# Role & Objective:
 You are an AI agent designed to operate an Android phone on behalf of a user. Your primary responsibilities are:
 - Answer questions: Respond to user queries (e.g., "What is my schedule for today?").
 - Perform tasks: Complete actions on the phone to achieve user goals (e.g., setting an alarm).
@@ -52,13 +59,17 @@ Based on this information, you must select and execute one of the following acti
 3. To copy some text: first select the exact text you want to copy, which usually also brings up the text selection bar, then click the 'copy' button in bar.
 4. To paste text into a text box, first long press the text box, then usually the text selection bar will appear with a ‘paste‘ button in it.
 
-# Current Context:
+"""
+
+PLAN_CONTEXT_TEMPLATE = """# Current Context:
 - **User Goal**: `{goal}`
 - **Previous Thoughts and Actions**: `{history}`
-- **<app_name_list>**: `["Camera","Chrome","Clock","Contacts","Dialer","Files","Settings","Markor","Tasks","Simple Draw Pro","Simple Gallery Pro","Simple SMS Messenger","Audio Recorder","Pro Expense","Broccoli APP","OSMand","VLC","Joplin","Retro Music","OpenTracks","Simple Calendar Pro"]`
-- **Current Time**: Today is October 15, Sunday, 2023, 23:34:00, which means it's the final day of this week.
+- **<app_name_list>**: `{app_name_list}`
+- **Current Time**: {current_time}
 
-# Start Task:
+"""
+
+PLAN_START_TASK = """# Start Task:
 1. Analyze the user goal and current context. Examine the screenshot and previous thoughts & actions carefully.
 2. Based on your analysis:
 - If you determine that the task has been accomplished—for instance, the Wi-Fi is enabled, the photo thumbnail is detected in the interface's lower - right corner, the correct answer was given in prior actions, or the proper action has been carried out—use the 'complete' status action to finalize the task.
@@ -67,9 +78,27 @@ Based on this information, you must select and execute one of the following acti
 4. Output your answer.Your answer should be as follows (including just one set of a thought and an action):
 Thought: ...\nAction: {{"action_type":...}}
 
-Your Answer:
 """
 
+PLAN_ANSWER = """Your Answer:
+"""
+
+PLAN_PROMPT_TEMPLATE = PLAN_INSTRUCTIONS + PLAN_CONTEXT_TEMPLATE + PLAN_START_TASK + PLAN_ANSWER
+
+# Prefix-cache layout: identical for every step and task, sent as the system prompt
+PLAN_SYSTEM_PROMPT = (PLAN_INSTRUCTIONS + """# Installed Apps:
+- **<app_name_list>**: `{app_name_list}`
+
+""" + PLAN_START_TASK).format(app_name_list=APP_NAME_LIST)
+
+# Volatile fields last; the history only grows, so the previous step's prompt stays a prefix
+PLAN_VOLATILE_TEMPLATE = """# Current Context:
+- **User Goal**: `{goal}`
+- **Current Time**: {current_time}
+- **Previous Thoughts and Actions**: `{history}`
+
+""" + PLAN_ANSWER
+
 GROUND_SYSTEM_PROMPT = """You are a helpful assistant."""
 
 GROUND_USER_PROMPT = """Your task is to help the user identify the precise coordinates (x, y) of a specific area/element/object on the screen based on a description.
@@ -85,15 +114,27 @@ Answer:
 def _plan_prompt(
     goal: str,
     history: list[str],
+    layout: str = prompt_layout.LEGACY,
+    history_window: Optional[plan_history.HistoryWindow] = None,
 ) -> str:
-    if history:
+    if history_window is not None:
+        history = history_window.render(history)
+    elif history:
         history = '\n'.join(history)
     else:
         history = 'You just started, no action has been performed yet.'
 
+    if layout == prompt_layout.PREFIX_CACHE:
+        return PLAN_VOLATILE_TEMPLATE.format(
+            goal=goal,
+            history=history,
+            current_time=CURRENT_TIME
+        )
     return PLAN_PROMPT_TEMPLATE.format(
         goal=goal,
-        history=history
+        history=history,
+        current_time=CURRENT_TIME,
+        app_name_list=APP_NAME_LIST
     )
 
 def _command_to_json(
@@ -101,8 +142,10 @@ def _command_to_json(
         tool_call: str
 ) :
     try:
-        string = tool_call.strip('()')
-        x, y = map(int, string.split(','))
+        point = action_parser.parse_point(tool_call)
+        if point is None:
+            return None
+        x, y = point.x, point.y
         plan_action_command = json.loads(plan_action)
         if plan_action_command['action_type'] in ['click','long_press']:
             return {'action_type': plan_action_command['action_type'], 'x': x, 'y': y}
@@ -125,22 +168,42 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
             ground_llm: infer.GrounderWrapper,
             name: str = 'PG_agent',
             wait_after_action_seconds: float = 2.0,
+            plan_prompt_layout: str = prompt_layout.LEGACY,
+            history_token_budget: Optional[int] = None,
+            element_matcher: Optional[ui_element_matcher.UIElementMatcher] = None,
+            use_ui_tree: bool = False,
+            adaptive_wait: bool = False,
     ):
         super().__init__(env, name)
         self.plan_llm = plan_llm
         self.ground_llm = ground_llm
         self.history = []
         self.wait_after_action_seconds = wait_after_action_seconds
+        # Opt-in: wait until the screen stops changing, at most wait_after_action_seconds.
+        # Compare screen_settle.stats() against the fixed sleep before enabling it by default
+        self.screen_settle = screen_settle.ScreenSettle(
+            lambda: screen_settle.grab_screenshot(self.env),
+            max_wait=wait_after_action_seconds,
+        ) if adaptive_wait else None
+        # 'prefix_cache' moves the static instructions into the system prompt
+        self.plan_prompt_layout = plan_prompt_layout
+        # Token-budgeted planner history; None sends the full history
+        self.history_window = plan_history.HistoryWindow(history_token_budget) if history_token_budget else None
+        # Opt-in until validated: targets found in the accessibility tree skip the grounder LLM
+        self.element_matcher = (element_matcher or ui_element_matcher.UIElementMatcher()) if use_ui_tree else None
 
     def reset(self, go_home_on_reset: bool = False):
         super().reset(go_home_on_reset)
         self.env.hide_automation_ui()
         self.history = []
+        if self.history_window is not None:
+            self.history_window.reset()
 
     def step(self, goal: str) -> base_agent.AgentInteractionResult:
         step_data = {
           'raw_screenshot': None,
           'plan_prompt': None,
+          'plan_prefix_stats': None,
           'plan_output':None,
           'plan_thought':None,
           'plan_action':None,
@@ -160,10 +223,17 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
 
         plan_prompt = _plan_prompt(
             goal,
-            self.history
+            self.history,
+            self.plan_prompt_layout,
+            self.history_window
         )
         step_data['plan_prompt'] = plan_prompt
-        system_prompt = "You are a helpful assistant."
+        if self.plan_prompt_layout == prompt_layout.PREFIX_CACHE:
+            system_prompt = PLAN_SYSTEM_PROMPT
+        else:
+            system_prompt = "You are a helpful assistant."
+        step_data['plan_prefix_stats'] = prompt_layout.DEFAULT_METER.measure(
+            goal, system_prompt, plan_prompt, static_chars=len(system_prompt))
         plan_output, plan_is_safe, plan_raw_response = self.plan_llm.predict_mm(
             system_prompt = system_prompt,
             user_prompt =plan_prompt,
@@ -173,16 +243,15 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
             raise RuntimeError('Error calling LLM in planning phase.')
         step_data['plan_output'] = plan_output
 
-        try:
-            plan_thought = plan_output.split('Action:')[0].replace('Thought:','').strip()
-            plan_action = plan_output.split('Action:')[1].strip()
-
-        except Exception as e:
+        plan = action_parser.parse_plan(plan_output)
+        if plan is None:
             print("Plan-Action prompt output is not in the correct format.")
             return base_agent.AgentInteractionResult(
                 False,
                 step_data,
             )
+        plan_thought, plan_action = plan.thought, plan.action
+        step_data['plan_repairs'] = plan.repairs
         print('Plan_Thought: ' + plan_thought)
         print('Plan_Action: ' + plan_action)
 
@@ -199,18 +268,29 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
             # print("Previous_actions: ", self.history[-5:])
 
         else:
-            # Grounding 阶段
-            ground_system_prompt = GROUND_SYSTEM_PROMPT
-            ground_user_prompt = GROUND_USER_PROMPT.format(plan_action=json.loads(plan_action)['target'])
-
-            ground_output, is_safe, ground_raw_response = self.ground_llm.predict_mm(
-                system_prompt=ground_system_prompt,
-                user_prompt=ground_user_prompt,
-                images=[before_screenshot]
-            )
+            # Grounding 阶段: the accessibility tree first, the grounder LLM as fallback
+            match = None
+            if self.element_matcher is not None:
+                match = self.element_matcher.match(plan_action_command.get('target'), state.ui_elements,
+                                                   plan_action_command['action_type'])
+            if match is not None:
+                print('UI element match: ', match.to_dict())
+                step_data['ground_source'] = 'ui_tree'
+                step_data['ui_match'] = match.to_dict()
+                ground_output = f'({match.x}, {match.y})'
+            else:
+                step_data['ground_source'] = 'grounder'
+                ground_system_prompt = GROUND_SYSTEM_PROMPT
+                ground_user_prompt = GROUND_USER_PROMPT.format(plan_action=json.loads(plan_action)['target'])
+
+                ground_output, is_safe, ground_raw_response = self.ground_llm.predict_mm(
+                    system_prompt=ground_system_prompt,
+                    user_prompt=ground_user_prompt,
+                    images=[before_screenshot]
+                )
 
-            if not ground_raw_response:
-                raise RuntimeError('Error calling LLM in grounding phase.')
+                if not ground_raw_response:
+                    raise RuntimeError('Error calling LLM in grounding phase.')
 
             step_data['ground_output'] = ground_output
             command = ground_output.replace('Action:','').strip()
@@ -266,7 +346,11 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
                 step_data,
             )
 
-        time.sleep(self.wait_after_action_seconds)
+        if self.screen_settle is not None:
+            step_data['settle_seconds'] = self.screen_settle.wait(converted_action.action_type,
+                                                                  step_data['raw_screenshot'])
+        else:
+            time.sleep(self.wait_after_action_seconds)
 
         return base_agent.AgentInteractionResult(
             False,
@@ -5,10 +5,21 @@ from android_world.agents import infer
 from android_world.env import interface
 from android_world.env import json_action
 from android_world.agents import get_app_name
+from android_world.agents import app_guide_kb
+from android_world.agents import prompt_layout
+from android_world.agents import plan_history
+from android_world.agents import action_parser
+from android_world.agents import ui_element_matcher
+from android_world.agents import screen_settle
 import json
-import pandas as pd
+from typing import Optional
 
-PLAN_PROMPT_TEMPLATE = """# Role: Android Phone Operator AI
+APP_NAME_LIST = '["Camera","Chrome","Clock","Contacts","Dialer","Files","Settings","Markor","Tasks","Simple Draw Pro","Simple Gallery Pro","Simple SMS Messenger","Audio Recorder","Pro Expense","Broccoli APP","OSMand","VLC","Joplin","Retro Music","OpenTracks","Simple Calendar Pro"]'
+CURRENT_TIME = "October 15, Sunday, 2023, 23:34:00"
+
+# The planner prompt is kept in pieces: the legacy layout interleaves them with the
+# per-step fields, the prefix-cache layout moves everything static to the system prompt.
+PLAN_INSTRUCTIONS = """# Role: Android Phone Operator AI
 You are an AI that controls an Android phone to complete user requests. Your responsibilities:
 - Answer questions by retrieving information from the phone.
 - Perform tasks by executing precise actions.
@@ -57,17 +68,21 @@ Respond with EXACT JSON format for one of these actions:
    - When guidance conflicts with actual situation, prioritize what you see on screen
 
 
-# Current Context
+"""
+
+PLAN_CONTEXT_TEMPLATE = """# Current Context
 - User Goal: `{goal}`
 - Previous Actions: `{history}`
-- Available Apps: `["Camera","Chrome","Clock","Contacts","Dialer","Files","Settings","Markor","Tasks","Simple Draw Pro","Simple Gallery Pro","Simple SMS Messenger","Audio Recorder","Pro Expense","Broccoli APP","OSMand","VLC","Joplin","Retro Music","OpenTracks","Simple Calendar Pro"]`
-- Current Time: October 15, Sunday, 2023, 23:34:00
+- Available Apps: `{app_name_list}`
+- Current Time: {current_time}
 - App Usage Guide:
   - app_name: `{ref_app_name}`
   - usage_notes: `{ref_usage_notes}`
 
 
-# Decision Process
+"""
+
+PLAN_DECISION_PROCESS = """# Decision Process
 1. Analyze goal, history, and current screen
 2. Check App Usage Guide's app_name and usage_notes for guidance
 3. Determine if task is already complete (use `status` if true)
@@ -80,7 +95,31 @@ Respond with EXACT JSON format for one of these actions:
 Thought: [Analysis including reference to key steps/points when applicable]
 Action: [Single JSON action]
 
-Your Response:"""
+"""
+
+PLAN_ANSWER = """Your Response:"""
+
+PLAN_PROMPT_TEMPLATE = PLAN_INSTRUCTIONS + PLAN_CONTEXT_TEMPLATE + PLAN_DECISION_PROCESS + PLAN_ANSWER
+
+# Prefix-cache layout: identical for every step and task, sent as the system prompt
+PLAN_SYSTEM_PROMPT = (PLAN_INSTRUCTIONS + """# Available Apps
+- Available Apps: `{app_name_list}`
+
+
+""" + PLAN_DECISION_PROCESS).format(app_name_list=APP_NAME_LIST)
+
+# Volatile fields last; goal and guide are fixed for a task and the history only grows,
+# so the previous step's prompt stays a prefix of this one
+PLAN_VOLATILE_TEMPLATE = """# Current Context
+- User Goal: `{goal}`
+- App Usage Guide:
+  - app_name: `{ref_app_name}`
+  - usage_notes: `{ref_usage_notes}`
+- Current Time: {current_time}
+- Previous Actions: `{history}`
+
+
+""" + PLAN_ANSWER
 
 GROUND_SYSTEM_PROMPT = """You are a helpful assistant."""
 
@@ -99,16 +138,30 @@ def _plan_prompt(
         goal: str,
         history: list[str],
         ref_app_name: str,
-        ref_usage_notes: str
+        ref_usage_notes: str,
+        layout: str = prompt_layout.LEGACY,
+        history_window: Optional[plan_history.HistoryWindow] = None
 ) -> str:
-    if history:
+    if history_window is not None:
+        history = history_window.render(history)
+    elif history:
         history = '\n'.join(history)  # [-5:]
     else:
         history = 'You just started, no action has been performed yet.'
 
+    if layout == prompt_layout.PREFIX_CACHE:
+        return PLAN_VOLATILE_TEMPLATE.format(
+            goal=goal,
+            history=history,
+            current_time=CURRENT_TIME,
+            ref_app_name=ref_app_name,
+            ref_usage_notes=ref_usage_notes
+        )
     return PLAN_PROMPT_TEMPLATE.format(
         goal=goal,
         history=history,
+        current_time=CURRENT_TIME,
+        app_name_list=APP_NAME_LIST,
         ref_app_name=ref_app_name,
         ref_usage_notes=ref_usage_notes
     )
@@ -119,9 +172,10 @@ def _command_to_json(
         tool_call: str
 ):
     try:
-        tool_call = tool_call.replace('[', '(').replace(']', ')')
-        string = tool_call.strip('()')
-        x, y = map(int, string.split(','))
+        point = action_parser.parse_point(tool_call)
+        if point is None:
+            return None
+        x, y = point.x, point.y
         plan_action_command = json.loads(plan_action)
         if plan_action_command['action_type'] in ['click', 'long_press']:
             return {'action_type': plan_action_command['action_type'], 'x': x, 'y': y}
@@ -145,32 +199,55 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
             ground_llm: infer.GrounderWrapper,
             name: str = 'PG_agent',
             wait_after_action_seconds: float = 2.0,
+            plan_prompt_layout: str = prompt_layout.LEGACY,
+            history_token_budget: Optional[int] = None,
+            element_matcher: Optional[ui_element_matcher.UIElementMatcher] = None,
+            use_ui_tree: bool = False,
+            adaptive_wait: bool = False,
     ):
         super().__init__(env, name)
         self.plan_llm = plan_llm
         self.ground_llm = ground_llm
         self.history = []
         self.wait_after_action_seconds = wait_after_action_seconds
+        # Opt-in: wait until the screen stops changing, at most wait_after_action_seconds.
+        # Compare screen_settle.stats() against the fixed sleep before enabling it by default
+        self.screen_settle = screen_settle.ScreenSettle(
+            lambda: screen_settle.grab_screenshot(self.env),
+            max_wait=wait_after_action_seconds,
+        ) if adaptive_wait else None
+        # 'prefix_cache' moves the static instructions into the system prompt
+        self.plan_prompt_layout = plan_prompt_layout
+        # Token-budgeted planner history; None sends the full history
+        self.history_window = plan_history.HistoryWindow(history_token_budget) if history_token_budget else None
+        # Opt-in until validated: targets found in the accessibility tree skip the grounder LLM
+        self.element_matcher = (element_matcher or ui_element_matcher.UIElementMatcher()) if use_ui_tree else None
         self.ref_app_name = None
         self.ref_usage_notes = None
-        self.ref_appname_finder = get_app_name.APPNAMEFinder(llm=ground_llm)
+        self.app_guide_resolved = False
         self.app_guidance_excel = 'APP_Usage_Guide_KB.xlsx'
+        self.ref_appname_finder = get_app_name.APPNAMEFinder(
+            llm=ground_llm, guide_kb=app_guide_kb.get_kb(self.app_guidance_excel))
+        # Compiled once per process; the workbook is only re-read when it changes
+        app_guide_kb.get_kb(self.app_guidance_excel).reload()
 
     def reset(self, go_home_on_reset: bool = False):
         super().reset(go_home_on_reset)
 
         self.env.hide_automation_ui()
         self.history = []
+        if self.history_window is not None:
+            self.history_window.reset()
         self.ref_app_name = None
         self.ref_usage_notes = None
+        self.app_guide_resolved = False
 
     def step(self, goal: str) -> base_agent.AgentInteractionResult:
-        if not self.ref_app_name:
+        # Looked up once per task, also when no app was found
+        if not self.app_guide_resolved:
             self.ref_app_name = self.ref_appname_finder.get_app_name(goal)
-            df = pd.read_excel(self.app_guidance_excel)
-            mask = df['app_name'].str.strip().str.lower() == self.ref_app_name.strip().lower()
-            matches = df[mask]
-            self.ref_usage_notes = matches.iloc[0]['usage_notes']
+            self.ref_usage_notes = app_guide_kb.get_kb(self.app_guidance_excel).lookup(self.ref_app_name)
+            self.app_guide_resolved = True
 
         print("ref_app_name:", self.ref_app_name)
         print("ref_usage_notes:", self.ref_usage_notes)
@@ -178,6 +255,7 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
         step_data = {
             'raw_screenshot': None,
             'plan_prompt': None,
+            'plan_prefix_stats': None,
             'plan_output': None,
             'plan_thought': None,
             'plan_action': None,
@@ -188,10 +266,12 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
             goal,
             self.history,
             self.ref_app_name,
-            self.ref_usage_notes
+            self.ref_usage_notes,
+            self.plan_prompt_layout,
+            self.history_window
         )
 
-        if self.ref_app_name != 'None' and self.history == []:
+        if self.ref_app_name is not None and self.history == []:
 
             plan_action_command = {"action_type": "open_app", "app_name": self.ref_app_name}
             plan_action = json.dumps(plan_action_command, ensure_ascii=False)
@@ -214,7 +294,12 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
             # Planning 阶段
 
             step_data['plan_prompt'] = plan_prompt
-            system_prompt = "You are a helpful assistant."
+            if self.plan_prompt_layout == prompt_layout.PREFIX_CACHE:
+                system_prompt = PLAN_SYSTEM_PROMPT
+            else:
+                system_prompt = "You are a helpful assistant."
+            step_data['plan_prefix_stats'] = prompt_layout.DEFAULT_METER.measure(
+                goal, system_prompt, plan_prompt, static_chars=len(system_prompt))
             plan_output, plan_is_safe, plan_raw_response = self.plan_llm.predict_mm(
                 system_prompt=system_prompt,
                 user_prompt=plan_prompt,
@@ -224,16 +309,15 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
                 raise RuntimeError('Error calling LLM in planning phase.')
             step_data['plan_output'] = plan_output
 
-            try:
-                plan_thought = plan_output.split('Action:')[0].replace('Thought:', '').strip()
-                plan_action = plan_output.split('Action:')[1].replace('```json', '').replace('```', '').strip()
-
-            except Exception as e:
+            plan = action_parser.parse_plan(plan_output)
+            if plan is None:
                 print("Plan-Action prompt output is not in the correct format.")
                 return base_agent.AgentInteractionResult(
                     False,
                     step_data,
                 )
+            plan_thought, plan_action = plan.thought, plan.action
+            step_data['plan_repairs'] = plan.repairs
             print('Plan_Thought: ' + plan_thought)
             print('Plan_Action: ' + plan_action)
 
@@ -251,18 +335,29 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
                 # print("Previous_actions: ", self.history[-5:])
 
             else:
-                # Grounding 阶段
-                ground_system_prompt = GROUND_SYSTEM_PROMPT
-                ground_user_prompt = GROUND_USER_PROMPT.format(plan_action=json.loads(plan_action)['target'])
-
-                ground_output, is_safe, ground_raw_response = self.ground_llm.predict_mm(
-                    system_prompt=ground_system_prompt,
-                    user_prompt=ground_user_prompt,
-                    images=[before_screenshot]
-                )
+                # Grounding 阶段: the accessibility tree first, the grounder LLM as fallback
+                match = None
+                if self.element_matcher is not None:
+                    match = self.element_matcher.match(plan_action_command.get('target'), state.ui_elements,
+                                                       plan_action_command['action_type'])
+                if match is not None:
+                    print('UI element match: ', match.to_dict())
+                    step_data['ground_source'] = 'ui_tree'
+                    step_data['ui_match'] = match.to_dict()
+                    ground_output = f'({match.x}, {match.y})'
+                else:
+                    step_data['ground_source'] = 'grounder'
+                    ground_system_prompt = GROUND_SYSTEM_PROMPT
+                    ground_user_prompt = GROUND_USER_PROMPT.format(plan_action=json.loads(plan_action)['target'])
+
+                    ground_output, is_safe, ground_raw_response = self.ground_llm.predict_mm(
+                        system_prompt=ground_system_prompt,
+                        user_prompt=ground_user_prompt,
+                        images=[before_screenshot]
+                    )
 
-                if not ground_raw_response:
-                    raise RuntimeError('Error calling LLM in grounding phase.')
+                    if not ground_raw_response:
+                        raise RuntimeError('Error calling LLM in grounding phase.')
 
                 step_data['ground_output'] = ground_output
                 command = ground_output.replace('Action:', '').strip()
@@ -321,7 +416,11 @@ class PGAgent(base_agent.EnvironmentInteractingAgent):
                 step_data,
             )
 
-        time.sleep(self.wait_after_action_seconds)
+        if self.screen_settle is not None:
+            step_data['settle_seconds'] = self.screen_settle.wait(converted_action.action_type,
+                                                                  step_data['raw_screenshot'])
+        else:
+            time.sleep(self.wait_after_action_seconds)
 
         return base_agent.AgentInteractionResult(
             False,
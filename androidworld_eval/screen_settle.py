@@ -0,0 +1,99 @@
+import time
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+# Actions that do not change the screen
+NO_SETTLE_ACTIONS = {'answer', 'status'}
+# Minimum waits for actions whose effect starts late (an app launch first shows the unchanged launcher)
+MIN_WAIT_SECONDS = {'open_app': 1.0, 'navigate_home': 0.3, 'navigate_back': 0.3}
+
+
+def _thumbnail(pixels: np.ndarray, stride: int) -> np.ndarray:
+    """Strided grayscale thumbnail, cheap enough to take every poll."""
+    frame = np.asarray(pixels)[::stride, ::stride]
+    if frame.ndim == 3:
+        frame = frame[..., :3].mean(axis=2)
+    return frame.astype(np.float32)
+
+
+def frame_difference(a: np.ndarray, b: np.ndarray) -> float:
+    """Mean absolute difference of two thumbnails in [0, 1]."""
+    if a.shape != b.shape:
+        return 1.0
+    return float(np.abs(a - b).mean() / 255.0)
+
+
+def grab_screenshot(env) -> np.ndarray:
+    """Current screen of an AndroidWorld env; prefers the controller's screenshot, which skips the UI tree."""
+    controller = getattr(env, 'controller', None)
+    if controller is not None and hasattr(controller, 'get_screenshot'):
+        return controller.get_screenshot()
+    return env.get_state(wait_to_stabilize=False).pixels
+
+
+class ScreenSettle:
+    """
+    Waits after an action until the screen stops changing, instead of a fixed sleep.
+
+    Downscaled frames are polled every `poll_interval` seconds; once `stable_frames`
+    consecutive frames differ by less than `threshold` the screen counts as settled.
+    If a pre-action frame is given, an unchanged screen is only accepted after
+    `change_timeout` (the action may not have been rendered yet). `max_wait` bounds the
+    wait in every case. The measured settle time is kept per action type.
+
+    Args:
+        grab: Returns the current screen pixels (H x W x C array)
+        poll_interval: Seconds between polls
+        max_wait: Longest wait, the former fixed sleep
+        threshold: Frame difference below which two frames are equal
+        stable_frames: Consecutive equal frames needed
+        change_timeout: Seconds to wait for a screen still equal to the pre-action frame to change
+        stride: Pixel stride of the thumbnails
+    """
+
+    def __init__(self, grab: Callable[[], np.ndarray], poll_interval: float = 0.1, max_wait: float = 2.0,
+                 threshold: float = 0.005, stable_frames: int = 2, change_timeout: float = 0.5, stride: int = 8):
+        self.grab = grab
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.threshold = threshold
+        self.stable_frames = stable_frames
+        self.change_timeout = change_timeout
+        self.stride = stride
+        self.settle_times: Dict[str, list] = {}
+
+    def wait(self, action_type: str, before: Optional[np.ndarray] = None) -> float:
+        """Block until the screen settled after `action_type`; returns the seconds waited."""
+        start = time.monotonic()
+        if action_type not in NO_SETTLE_ACTIONS:
+            time.sleep(MIN_WAIT_SECONDS.get(action_type, 0.0))
+            before = _thumbnail(before, self.stride) if before is not None else None
+            previous, stable = None, 0
+            while time.monotonic() - start < self.max_wait:
+                try:
+                    frame = _thumbnail(self.grab(), self.stride)
+                except Exception as e:
+                    print(f'Screen settle polling failed, falling back to the full wait: {e}')
+                    time.sleep(max(0.0, self.max_wait - (time.monotonic() - start)))
+                    break
+                unchanged = before is not None and frame_difference(frame, before) < self.threshold
+                if previous is not None and frame_difference(frame, previous) < self.threshold:
+                    stable += 1
+                else:
+                    stable = 0
+                previous = frame
+                if stable >= max(1, self.stable_frames - 1) and not (
+                        unchanged and time.monotonic() - start < self.change_timeout):
+                    break
+                time.sleep(self.poll_interval)
+        elapsed = time.monotonic() - start
+        self.settle_times.setdefault(action_type, []).append(elapsed)
+        return elapsed
+
+    def stats(self) -> Dict[str, Dict]:
+        """Settle time per action type: count, mean and max seconds."""
+        return {
+            action_type: {'count': len(times), 'mean': sum(times) / len(times), 'max': max(times)}
+            for action_type, times in self.settle_times.items()
+        }
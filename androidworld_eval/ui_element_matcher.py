@@ -0,0 +1,166 @@
+import difflib
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Quoted labels in a planner target, e.g. the "Save" button / 'Wi-Fi' toggle
+_QUOTED = re.compile(r'["“”]([^"“”]{1,80})["“”]|(?<![A-Za-z])[\'‘]([^\'‘’]{1,80})[\'’](?![A-Za-z])')
+# Targets located relative to another element ("the icon next to 'Notes'"); the named label is
+# the anchor, not the element to tap, so these go to the grounder
+_RELATIONAL = re.compile(r'\b(next to|below|above|beside|under|underneath|beneath|left of|right of)\b', re.IGNORECASE)
+_WORD = re.compile(r'[a-z0-9]+|[一-鿿]')
+# Words describing the element rather than naming it
+_FILLER = {'the', 'a', 'an', 'button', 'icon', 'tab', 'field', 'text', 'box', 'input', 'option', 'item',
+           'at', 'on', 'in', 'of', 'to', 'with', 'top', 'bottom', 'left', 'right', 'labeled', 'labelled',
+           'named', 'called', 'that', 'says', 'screen', 'menu', 'bar', 'link', 'entry', 'toggle'}
+
+
+def _normalize(text: Optional[str]) -> str:
+    return ' '.join(_WORD.findall(str(text).lower())) if text else ''
+
+
+def _words(text: str) -> List[str]:
+    return [word for word in text.split() if word not in _FILLER]
+
+
+class ElementMatch:
+    """A UI element resolved from a planner target, with the point to tap."""
+
+    def __init__(self, x: int, y: int, confidence: float, index: int, label: str, reason: str):
+        self.x = x
+        self.y = y
+        self.confidence = confidence
+        self.index = index
+        self.label = label
+        self.reason = reason
+
+    def to_dict(self) -> Dict:
+        return {'x': self.x, 'y': self.y, 'confidence': round(self.confidence, 3),
+                'index': self.index, 'label': self.label, 'reason': self.reason}
+
+
+def _center(element: Any) -> Optional[Tuple[int, int]]:
+    bbox = getattr(element, 'bbox_pixels', None)
+    if bbox is None:
+        return None
+    if bbox.x_max <= bbox.x_min or bbox.y_max <= bbox.y_min:
+        return None
+    return int((bbox.x_min + bbox.x_max) / 2), int((bbox.y_min + bbox.y_max) / 2)
+
+
+def _labels(element: Any) -> List[Tuple[str, str]]:
+    """(source, normalized label) pairs an element can be referred to by."""
+    labels = []
+    for source in ('text', 'content_description', 'hint_text', 'tooltip'):
+        label = _normalize(getattr(element, source, None))
+        if label:
+            labels.append((source, label))
+    resource = getattr(element, 'resource_name', None) or getattr(element, 'resource_id', None)
+    if resource:
+        # com.app:id/search_button -> "search button"
+        label = _normalize(str(resource).split('/')[-1].replace('_', ' '))
+        if label:
+            labels.append(('resource_id', label))
+    return labels
+
+
+def _score(label: str, source: str, target: str, quoted: List[str]) -> Tuple[float, str]:
+    """How well one label matches the target, in [0, 1]."""
+    if label in quoted:
+        return 1.0, f'quoted {source}'
+    if label == target:
+        return 0.95, f'exact {source}'
+    target_words = _words(target)
+    label_words = _words(label)
+    best, reason = 0.0, ''
+    if label_words and target_words:
+        if f' {label} ' in f' {target} ' and len(label) >= 3:
+            # The whole label is named in the description; longer labels cover more of it
+            coverage = len(label_words) / len(target_words)
+            best, reason = 0.7 + 0.2 * min(coverage, 1.0), f'{source} in target'
+        elif source == 'resource_id':
+            overlap = len(set(label_words) & set(target_words)) / len(set(label_words) | set(target_words))
+            best, reason = 0.75 * overlap, 'resource_id words'
+    for phrase in quoted or [' '.join(target_words)]:
+        ratio = difflib.SequenceMatcher(None, label, phrase).ratio()
+        if ratio * 0.9 > best:
+            best, reason = ratio * 0.9, f'fuzzy {source}'
+    if source == 'resource_id':
+        best = min(best, 0.8)  # ids are often generic, never let them outrank visible text
+    return best, reason
+
+
+class UIElementMatcher:
+    """
+    Resolves a planner `target` against the accessibility tree of the current state.
+
+    Every visible element is scored by its text, content description, hint and
+    resource id against the target description (quoted labels, exact and contained
+    labels, then fuzzy similarity). Elements that cannot take the action are
+    penalized, and a runner-up at a different position within `ambiguity_margin` halves
+    the confidence. Only a match of at least `min_confidence` is returned, anything
+    else goes to the grounder, as do targets described relative to another element
+    (next to / below / above / left of / right of / beside / under).
+
+    Args:
+        min_confidence: Confidence from which the element centre is used instead of the grounder
+        ambiguity_margin: Score gap to the best other element below which the match is ambiguous
+    """
+
+    def __init__(self, min_confidence: float = 0.85, ambiguity_margin: float = 0.05):
+        self.min_confidence = min_confidence
+        self.ambiguity_margin = ambiguity_margin
+        self.matched = 0
+        self.fallbacks = 0
+
+    def _candidates(self, target: str, action_type: str, elements: Sequence[Any]) -> List[Tuple[float, int, str, str]]:
+        normalized = _normalize(target)
+        quoted = [_normalize(double or single) for double, single in _QUOTED.findall(target)]
+        quoted = [phrase for phrase in quoted if phrase]
+        candidates = []
+        for index, element in enumerate(elements):
+            if getattr(element, 'is_visible', True) is False or _center(element) is None:
+                continue
+            best, best_label, best_reason = 0.0, '', ''
+            for source, label in _labels(element):
+                score, reason = _score(label, source, normalized, quoted)
+                if score > best:
+                    best, best_label, best_reason = score, label, reason
+            if best <= 0:
+                continue
+            if action_type == 'input_text' and not getattr(element, 'is_editable', False):
+                best *= 0.8
+            elif action_type == 'long_press' and getattr(element, 'is_long_clickable', None) is False:
+                best *= 0.95
+            candidates.append((best, index, best_label, best_reason))
+        candidates.sort(reverse=True)
+        return candidates
+
+    def match(self, target: Optional[str], elements: Optional[Sequence[Any]],
+              action_type: str = 'click') -> Optional[ElementMatch]:
+        """The element `target` refers to, None when no element matches confidently."""
+        if not target or not elements or _RELATIONAL.search(target):
+            self.fallbacks += 1
+            return None
+        candidates = self._candidates(target, action_type, elements)
+        if not candidates:
+            self.fallbacks += 1
+            return None
+        score, index, label, reason = candidates[0]
+        x, y = _center(elements[index])
+        for other_score, other_index, _, _ in candidates[1:]:
+            if score - other_score > self.ambiguity_margin:
+                break
+            # Nested views of the same control share a centre and are not ambiguous
+            ox, oy = _center(elements[other_index])
+            if abs(ox - x) > 10 or abs(oy - y) > 10:
+                score *= 0.5
+                reason += ', ambiguous'
+                break
+        if score < self.min_confidence:
+            self.fallbacks += 1
+            return None
+        self.matched += 1
+        return ElementMatch(x, y, score, index, label, reason)
+
+    def stats(self) -> Dict:
+        return {'matched': self.matched, 'fallbacks': self.fallbacks}
@@ -0,0 +1,292 @@
+import argparse
+import ast
+import json
+import re
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Repairs reported by the parsers
+CODE_FENCE = 'code_fence'
+MISSING_ACTION_MARKER = 'missing_action_marker'
+TRAILING_TEXT = 'trailing_text'
+UNBALANCED_BRACES = 'unbalanced_braces'
+SMART_QUOTES = 'smart_quotes'
+TRAILING_COMMA = 'trailing_comma'
+UNQUOTED_KEYS = 'unquoted_keys'
+PYTHON_LITERAL = 'python_literal'
+ACTION_TYPE_CASE = 'action_type_case'
+BRACKET_POINT = 'bracket_point'
+JSON_POINT = 'json_point'
+BOX_CENTER = 'box_center'
+FLOAT_POINT = 'float_point'
+NORMALIZED_POINT = 'normalized_point'
+
+# Also matches markdown-bold markers such as '**Action:**'
+_ACTION_MARKER = re.compile(r'\**Action\s*[:：]\**', re.I)
+_THOUGHT_MARKER = re.compile(r'\**Thought\s*[:：]\**', re.I)
+_CODE_FENCE = re.compile(r'```[a-zA-Z]*')
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+_UNQUOTED_KEY = re.compile(r'([{,]\s*)([A-Za-z_][A-Za-z0-9_]*)\s*:')
+_SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"})
+_NUMBER = r'(-?\d+(?:\.\d+)?)'
+_BOX = re.compile(r'\(\s*%s\s*,\s*%s\s*\)\s*,?\s*\(\s*%s\s*,\s*%s\s*\)' % ((_NUMBER,) * 4))
+_FOUR_NUMBERS = re.compile(r'\[\s*%s\s*,\s*%s\s*,\s*%s\s*,\s*%s\s*\]' % ((_NUMBER,) * 4))
+_PAREN_POINT = re.compile(r'\(\s*%s\s*,\s*%s\s*\)' % (_NUMBER, _NUMBER))
+_BRACKET_POINT = re.compile(r'\[\s*%s\s*,\s*%s\s*\]' % (_NUMBER, _NUMBER))
+_JSON_POINT = re.compile(r'"?x"?\s*[:=]\s*%s\s*,\s*"?y"?\s*[:=]\s*%s' % (_NUMBER, _NUMBER))
+_BARE_POINT = re.compile(r'%s\s*,\s*%s' % (_NUMBER, _NUMBER))
+_POINT_PUNCTUATION = re.compile(r'</?box>|[\s{}()\[\],.:"]')
+
+
+class PlanParse:
+    """A parsed planner reply; `action` is the JSON text kept in the history."""
+
+    __slots__ = ('thought', 'action', 'command', 'repairs')
+
+    def __init__(self, thought: str, action: str, command: Dict, repairs: List[str]):
+        self.thought = thought
+        self.action = action
+        self.command = command
+        self.repairs = repairs
+
+
+class PointParse:
+    __slots__ = ('x', 'y', 'repairs')
+
+    def __init__(self, x: int, y: int, repairs: List[str]):
+        self.x = x
+        self.y = y
+        self.repairs = repairs
+
+
+def _balanced_object(text: str, start: int) -> Tuple[int, int]:
+    """(end index after the object, braces still open) for the object opening at `start`."""
+    depth, in_string, escape, quote = 0, False, False, ''
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == quote:
+                in_string = False
+        elif char in '"\'':
+            # Apostrophes inside words are not quotes
+            if char == '"' or not (i > 0 and text[i - 1].isalnum()):
+                in_string, quote = True, char
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1, 0
+    return len(text), depth
+
+
+def _load_object(candidate: str, repairs: List[str]) -> Optional[Dict]:
+    try:
+        return json.loads(candidate)
+    except ValueError:
+        pass
+    fixed = candidate.translate(_SMART_QUOTES)
+    if fixed != candidate:
+        repairs.append(SMART_QUOTES)
+    for pattern, replacement, repair in ((_TRAILING_COMMA, r'\1', TRAILING_COMMA),
+                                         (_UNQUOTED_KEY, r'\1"\2":', UNQUOTED_KEYS)):
+        try:
+            return json.loads(fixed)
+        except ValueError:
+            pass
+        repaired = pattern.sub(replacement, fixed)
+        if repaired != fixed:
+            repairs.append(repair)
+            fixed = repaired
+    try:
+        return json.loads(fixed)
+    except ValueError:
+        pass
+    try:
+        # Single quotes, True/False/None
+        value = ast.literal_eval(fixed)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    repairs.append(PYTHON_LITERAL)
+    return value
+
+
+def parse_plan(output: Optional[str]) -> Optional[PlanParse]:
+    """
+    Parse a `Thought: ...\\nAction: {...}` planner reply, salvaging code fences, a missing
+    `Action:` marker, trailing prose, unbalanced braces and near-JSON. None if no action
+    object can be recovered.
+    """
+    if not output:
+        return None
+    repairs: List[str] = []
+    marker = _ACTION_MARKER.search(output)
+    if marker is not None:
+        head, body = output[:marker.start()], output[marker.end():]
+    else:
+        brace = output.find('{')
+        if brace < 0:
+            return None
+        repairs.append(MISSING_ACTION_MARKER)
+        head, body = output[:brace], output[brace:]
+    thought = _THOUGHT_MARKER.sub('', head, count=1).strip()
+
+    if '```' in body:
+        body = _CODE_FENCE.sub('', body)
+        repairs.append(CODE_FENCE)
+    start = body.find('{')
+    if start < 0:
+        return None
+    end, still_open = _balanced_object(body, start)
+    candidate = body[start:end]
+    if still_open > 0:
+        candidate = candidate.rstrip() + '}' * still_open
+        repairs.append(UNBALANCED_BRACES)
+    elif body[end:].strip():
+        repairs.append(TRAILING_TEXT)
+
+    json_repairs: List[str] = []
+    command = _load_object(candidate, json_repairs)
+    if not isinstance(command, dict) or not isinstance(command.get('action_type'), str):
+        return None
+    repairs.extend(json_repairs)
+    action_type = command['action_type'].strip().lower()
+    if action_type != command['action_type']:
+        command['action_type'] = action_type
+        repairs.append(ACTION_TYPE_CASE)
+
+    # Unchanged JSON is kept verbatim so histories stay as the model wrote them
+    if json_repairs or ACTION_TYPE_CASE in repairs or UNBALANCED_BRACES in repairs:
+        action = json.dumps(command, ensure_ascii=False)
+    else:
+        action = candidate.strip()
+    return PlanParse(thought, action, command, repairs)
+
+
+def parse_point(output: Optional[str], size: Optional[Tuple[int, int]] = None) -> Optional[PointParse]:
+    """
+    Parse a grounder reply: `(x, y)`, `[x, y]`, `x, y`, `{"x": .., "y": ..}`, a box given as
+    two corners or `[x1, y1, x2, y2]` (its center is used), with or without surrounding prose.
+    Coordinates in [0, 1] are scaled by `size` (width, height) when it is given.
+    """
+    if not output:
+        return None
+    repairs: List[str] = []
+    text = output.replace('Action:', '')
+    match = _BOX.search(text) or _FOUR_NUMBERS.search(text)
+    if match is not None:
+        x1, y1, x2, y2 = (float(value) for value in match.groups())
+        x, y = (x1 + x2) / 2, (y1 + y2) / 2
+        repairs.append(BOX_CENTER)
+    else:
+        for pattern, repair in ((_PAREN_POINT, None), (_BRACKET_POINT, BRACKET_POINT),
+                                (_JSON_POINT, JSON_POINT), (_BARE_POINT, None)):
+            match = pattern.search(text)
+            if match is not None:
+                if repair:
+                    repairs.append(repair)
+                break
+        else:
+            return None
+        x, y = float(match.group(1)), float(match.group(2))
+    if _POINT_PUNCTUATION.sub('', text[:match.start()] + text[match.end():]):
+        repairs.append(TRAILING_TEXT)
+    if not (x.is_integer() and y.is_integer()):
+        if size and 0 <= x <= 1 and 0 <= y <= 1:
+            x, y = x * size[0], y * size[1]
+            repairs.append(NORMALIZED_POINT)
+        else:
+            repairs.append(FLOAT_POINT)
+    return PointParse(int(round(x)), int(round(y)), repairs)
+
+
+# Replies seen in the wild, used by the benchmark when no corpus is given
+SAMPLE_PLAN_OUTPUTS = [
+    'Thought: Open the app.\nAction: {"action_type": "open_app", "app_name": "Chrome"}',
+    'Thought: Tap search.\nAction: ```json\n{"action_type": "click", "target": "search bar"}\n```',
+    'Thought: Tap search.\nAction: {"action_type": "click", "target": "search bar"} This opens the keyboard.',
+    '{"action_type": "navigate_back"}',
+    "Thought: Done.\nAction: {'action_type': 'status', 'goal_status': 'complete'}",
+    'Thought: Type.\nAction: {"action_type": "input_text", "text": "hi", "target": "box",}',
+    'Thought: Scroll.\nAction: {action_type: "scroll", direction: "down"}',
+    'Thought: Wait.\nAction: {"action_type": "wait"',
+    '**Thought:** Go home.\n**Action:** {"action_type": "Navigate_Home"}',
+]
+SAMPLE_GROUND_OUTPUTS = ['(540, 1200)', '[540, 1200]', '540,1200', 'The point is (540, 1200).',
+                         '{"x": 540, "y": 1200}', '<box>(500,1100),(580,1300)</box>', '[500, 1100, 580, 1300]',
+                         '(540.4, 1199.6)']
+
+
+def build_corpus(trace_paths: Iterable[str], corpus_path: str) -> int:
+    """Collect the distinct raw planner/grounder replies recorded in step traces."""
+    seen = set()
+    with open(corpus_path, 'w', encoding='utf-8') as out:
+        for path in trace_paths:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    for kind in ('plan', 'ground'):
+                        output = record.get(f'{kind}_output')
+                        if isinstance(output, str) and (kind, output) not in seen:
+                            seen.add((kind, output))
+                            out.write(json.dumps({'kind': kind, 'output': output}, ensure_ascii=False) + '\n')
+    return len(seen)
+
+
+def benchmark(samples: List[Tuple[str, str]], rounds: int = 100) -> Dict:
+    """Parse rate, repairs applied and mean parse time over (kind, output) samples."""
+    parsed, repairs = Counter(), Counter()
+    totals = Counter(kind for kind, _ in samples)
+    for kind, output in samples:
+        result = parse_plan(output) if kind == 'plan' else parse_point(output)
+        if result is not None:
+            parsed[kind] += 1
+            repairs.update(result.repairs)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for kind, output in samples:
+            parse_plan(output) if kind == 'plan' else parse_point(output)
+    elapsed = time.perf_counter() - start
+    return {
+        'samples': dict(totals),
+        'parse_rate': {kind: parsed[kind] / totals[kind] for kind in totals},
+        'repairs': dict(repairs.most_common()),
+        'mean_us': elapsed / max(1, rounds * len(samples)) * 1e6,
+    }
+
+
+def main():
+    import trace_writer
+    parser = argparse.ArgumentParser(description='Build a parser corpus from step traces and benchmark the parser')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='collect raw model replies from trace JSONL files')
+    build.add_argument('--trace-dir', default=trace_writer.DEFAULT_TRACE_DIR)
+    build.add_argument('--out', default='parser_corpus.jsonl')
+    bench = subparsers.add_parser('bench', help='run the parser over a corpus')
+    bench.add_argument('--corpus', help='corpus JSONL, the built-in samples when omitted')
+    bench.add_argument('--rounds', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        count = build_corpus(trace_writer.trace_files(args.trace_dir), args.out)
+        print(f'{count} replies written to {args.out}')
+        return
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            samples = [(entry['kind'], entry['output']) for entry in map(json.loads, f) if entry]
+    else:
+        samples = [('plan', output) for output in SAMPLE_PLAN_OUTPUTS]
+        samples += [('ground', output) for output in SAMPLE_GROUND_OUTPUTS]
+    print(json.dumps(benchmark(samples, args.rounds), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
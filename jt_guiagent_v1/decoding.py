@@ -0,0 +1,98 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+PLAN = 'plan'
+GROUND = 'ground'
+
+# Request field carrying the guided-decoding regex per serving engine
+GUIDED_REGEX_KEYS = {'vllm': 'guided_regex', 'sglang': 'regex'}
+
+# The action space of the planner prompt's action table: action_type -> (field, allowed values) in
+# the order the examples write them; None allows any string
+ACTION_FIELDS: Dict[str, List[Tuple[str, Optional[List[str]]]]] = {
+    'open_app': [('app_name', None)],
+    'click': [('target', None)],
+    'long_press': [('target', None)],
+    'input_text': [('text', None), ('target', None)],
+    'answer': [('text', None)],
+    'keyboard_enter': [],
+    'navigate_home': [],
+    'navigate_back': [],
+    'scroll': [('direction', ['up', 'down', 'left', 'right'])],
+    'wait': [],
+    'status': [('goal_status', ['complete', 'infeasible'])],
+}
+
+
+def _string(values: Optional[List[str]], max_chars: int) -> str:
+    if values:
+        return '"(?:%s)"' % '|'.join(re.escape(value) for value in values)
+    return r'"(?:[^"\\\n]|\\["\\/nt]){1,%d}"' % max_chars
+
+
+def action_pattern(value_chars: int = 200) -> str:
+    """Regex accepting exactly the action JSON objects of `ACTION_FIELDS`."""
+    branches = []
+    for action_type, fields in ACTION_FIELDS.items():
+        parts = [r'"action_type":\s?"%s"' % action_type]
+        parts += [r'"%s":\s?%s' % (name, _string(values, value_chars)) for name, values in fields]
+        branches.append(r'\{\s?' + r',\s?'.join(parts) + r'\s?\}')
+    return '(?:%s)' % '|'.join(branches)
+
+
+def plan_pattern(thought_chars: int = 600, value_chars: int = 200) -> str:
+    """`Thought: ...\\nAction: {...}` with a bounded thought and a valid action."""
+    return r'Thought:\s?[^{}]{1,%d}\nAction:\s?%s' % (thought_chars, action_pattern(value_chars))
+
+
+# The grounder answers a single `(x, y)`
+POINT_PATTERN = r'\(\d{1,5},\s?\d{1,5}\)'
+
+
+class DecodingSpec:
+    """
+    How one model phase decodes.
+
+    Args:
+        max_tokens: Completion token cap of the phase
+        max_tokens_key: Request field of the cap, None keeps the wrapper's own
+            (`max_new_tokens` for the planner, `max_tokens` for the grounder)
+        guided: Constrain decoding to the phase's grammar (the action-space regex for
+            the planner, `(x, y)` for the grounder) so every reply parses
+        backend: Serving engine, selects the request field of the regex (see GUIDED_REGEX_KEYS)
+        thought_chars: Longest thought the planner grammar allows
+        value_chars: Longest string value (target, text, ...) in the action JSON
+    """
+
+    def __init__(self, max_tokens: int = 1024, max_tokens_key: Optional[str] = None, guided: bool = False,
+                 backend: str = 'vllm', thought_chars: int = 600, value_chars: int = 200):
+        if backend not in GUIDED_REGEX_KEYS:
+            raise ValueError(f'Unknown guided decoding backend {backend!r}, expected one of {list(GUIDED_REGEX_KEYS)}')
+        self.max_tokens = max_tokens
+        self.max_tokens_key = max_tokens_key
+        self.guided = guided
+        self.backend = backend
+        self.thought_chars = thought_chars
+        self.value_chars = value_chars
+        self._patterns: Dict[str, str] = {}
+
+    def pattern(self, phase: str) -> str:
+        if phase not in self._patterns:
+            if phase == PLAN:
+                self._patterns[phase] = plan_pattern(self.thought_chars, self.value_chars)
+            elif phase == GROUND:
+                self._patterns[phase] = POINT_PATTERN
+            else:
+                raise ValueError(f'Unknown decoding phase {phase!r}')
+        return self._patterns[phase]
+
+    def apply(self, payload: Dict, phase: Optional[str], default_max_tokens_key: str) -> Dict:
+        """Set the token cap and, if guided, the grammar of `phase` on a chat payload."""
+        payload[self.max_tokens_key or default_max_tokens_key] = self.max_tokens
+        if self.guided and phase is not None:
+            payload[GUIDED_REGEX_KEYS[self.backend]] = self.pattern(phase)
+        return payload
+
+
+# The former behavior: free-form replies capped at 1024 tokens
+DEFAULT_SPEC = DecodingSpec()
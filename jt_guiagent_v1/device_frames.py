@@ -0,0 +1,34 @@
+import json
+import struct
+from typing import Dict, Tuple
+
+# Binary WebSocket frame: 4-byte big-endian header length, UTF-8 JSON header, raw image bytes.
+# The header carries the fields of the JSON text reply (requestId, code, ...) minus the screenshot.
+_HEADER_LENGTH = struct.Struct('>I')
+
+
+class FrameError(ValueError):
+    """A binary frame that does not follow the header-length/header/payload layout."""
+
+
+def encode_frame(header: Dict, payload: bytes = b'') -> bytes:
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    return _HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + payload
+
+
+def decode_frame(frame: bytes) -> Tuple[Dict, bytes]:
+    """Header dict and payload of a binary frame; the payload is copied out of the frame once."""
+    view = memoryview(frame)
+    if len(view) < _HEADER_LENGTH.size:
+        raise FrameError(f'Frame of {len(view)} bytes has no header length')
+    (header_length,) = _HEADER_LENGTH.unpack_from(view)
+    payload_offset = _HEADER_LENGTH.size + header_length
+    if payload_offset > len(view):
+        raise FrameError(f'Header length {header_length} exceeds the frame')
+    try:
+        header = json.loads(bytes(view[_HEADER_LENGTH.size:payload_offset]))
+    except ValueError as e:
+        raise FrameError(f'Invalid frame header: {e}')
+    if not isinstance(header, dict):
+        raise FrameError('Frame header is not a JSON object')
+    return header, bytes(view[payload_offset:])
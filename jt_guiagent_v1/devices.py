@@ -0,0 +1,76 @@
+from typing import Callable, Dict, Generic, List, Optional, TypeVar
+
+C = TypeVar('C')
+
+DEFAULT_DEVICE_ID = 'default'
+
+
+class DeviceBusy(Exception):
+    """The requested device (or every device) is running another task."""
+
+
+class DeviceNotConnected(Exception):
+    """No device with the requested id is connected."""
+
+
+class DeviceRegistry(Generic[C]):
+    """
+    Connected devices keyed by the device id sent on `/ws`, each with its own client.
+
+    A device reconnecting under the same id replaces its previous connection; other
+    devices are unaffected. A task acquires one device, a specific one or any idle one,
+    and releases it when it ends. Used from the event loop only, so no locking.
+
+    Args:
+        client_factory: Builds the client of a newly seen device, called as `client_factory(device_id)`
+    """
+
+    def __init__(self, client_factory: Callable[[str], C]):
+        self.client_factory = client_factory
+        self._clients: Dict[str, C] = {}
+        self._busy: Dict[str, str] = {}  # device_id -> task_id
+
+    def client(self, device_id: str) -> C:
+        """The client of `device_id`, created on first connect and kept across reconnects."""
+        client = self._clients.get(device_id)
+        if client is None:
+            client = self._clients[device_id] = self.client_factory(device_id)
+        return client
+
+    def connected(self) -> List[str]:
+        return [device_id for device_id, client in self._clients.items() if client.connected]
+
+    def idle(self) -> List[str]:
+        return [device_id for device_id in self.connected() if device_id not in self._busy]
+
+    def acquire(self, task_id: str, device_id: Optional[str] = None) -> str:
+        """Reserve `device_id`, or any idle device, for `task_id`; returns the device id."""
+        if device_id is None:
+            idle = self.idle()
+            if not idle:
+                if not self.connected():
+                    raise DeviceNotConnected('No device connected')
+                raise DeviceBusy('All devices are busy')
+            device_id = idle[0]
+        client = self._clients.get(device_id)
+        if client is None or not client.connected:
+            raise DeviceNotConnected(f'Device {device_id} not connected')
+        if device_id in self._busy and self._busy[device_id] != task_id:
+            raise DeviceBusy(f'Device {device_id} is running task {self._busy[device_id]}')
+        self._busy[device_id] = task_id
+        return device_id
+
+    def release(self, device_id: str, task_id: Optional[str] = None):
+        if task_id is None or self._busy.get(device_id) == task_id:
+            self._busy.pop(device_id, None)
+
+    def task_of(self, device_id: str) -> Optional[str]:
+        return self._busy.get(device_id)
+
+    def stats(self) -> Dict:
+        connected = self.connected()
+        return {
+            'connected': len(connected),
+            'busy': sum(1 for device_id in connected if device_id in self._busy),
+            'devices': {device_id: self._busy.get(device_id) for device_id in connected},
+        }
@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, Union
+import asyncio
+
+MAX_WORKERS = 8
+
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+Pending = Union[Future, asyncio.Future]
+
+
+def submit(fn, *args, **kwargs) -> Future:
+    """Run a blocking grounder call on the shared early-grounding threads."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='early-ground')
+    return _executor.submit(fn, *args, **kwargs)
+
+
+class EarlyGrounding:
+    """
+    Grounder request started from a partially streamed planner action.
+
+    `on_target` is given to the streaming planner as its target listener. When
+    `should_start(action_type)` holds, it starts the grounder through
+    `start(action_type, target)`, which returns a `concurrent.futures.Future`
+    (blocking step) or an `asyncio` task (async step). Once the plan is final,
+    `take(target)` hands over the request if it was for the same target and
+    cancels it otherwise.
+    """
+
+    def __init__(self, start: Callable[[str, str], Pending], should_start: Callable[[str], bool]):
+        self._start = start
+        self._should_start = should_start
+        self._lock = threading.Lock()
+        self.target: Optional[str] = None
+        self.pending: Optional[Pending] = None
+
+    def on_target(self, action_type: str, target: str):
+        if not self._should_start(action_type):
+            return
+        with self._lock:
+            if self.pending is not None and self.target == target:
+                return
+            self._cancel()
+            self.target = target
+            self.pending = self._start(action_type, target)
+        print(f'Grounding started early for target: {target}')
+
+    def take(self, target: str) -> Optional[Pending]:
+        with self._lock:
+            if self.pending is not None and self.target == target:
+                pending, self.pending = self.pending, None
+                return pending
+            self._cancel()
+            return None
+
+    def cancel(self):
+        with self._lock:
+            self._cancel()
+
+    def _cancel(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
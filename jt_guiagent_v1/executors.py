@@ -0,0 +1,172 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+def _timed(fn: Callable, args: Tuple) -> Tuple[Any, float, float]:
+    """Runs in the worker; wall-clock timestamps so queue time is measurable across processes."""
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time()
+
+
+class MeteredExecutor:
+    """
+    A thread or process pool that at most `max_pending` calls are handed to at once.
+
+    Further callers wait on the event loop (backpressure) instead of piling up in the
+    pool's unbounded queue. Tracks in-flight, queued and waiting calls plus average
+    queue and run times, for sizing the pool per machine.
+
+    Args:
+        name: Label in the metrics
+        executor: The pool
+        max_workers: Workers of the pool
+        max_pending: Calls submitted to the pool at most, running or queued
+    """
+
+    def __init__(self, name: str, executor: Executor, max_workers: int, max_pending: int):
+        self.name = name
+        self.executor = executor
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.queue_seconds = 0.0
+        self.run_seconds = 0.0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+
+    async def run(self, fn: Callable, *args) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        submitted = time.time()
+        try:
+            result, started, finished = await asyncio.get_running_loop().run_in_executor(
+                self.executor, _timed, fn, args)
+        except BaseException:
+            with self._lock:
+                self.failed += 1
+            raise
+        else:
+            with self._lock:
+                self.completed += 1
+                self.queue_seconds += max(0.0, started - submitted)
+                self.run_seconds += finished - started
+            return result
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            done = max(self.completed, 1)
+            return {
+                'workers': self.max_workers,
+                'in_flight': self.in_flight,
+                'queued': max(0, self.in_flight - self.max_workers),  # submitted, no worker free yet
+                'waiting': self.waiting,  # held back by max_pending
+                'max_in_flight': self.max_in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_queue_ms': round(1000 * self.queue_seconds / done, 2),
+                'avg_run_ms': round(1000 * self.run_seconds / done, 2),
+            }
+
+
+class StepExecutors:
+    """
+    Where the step pipeline runs work that must not block the event loop.
+
+    Blocking calls (file and workbook I/O, synchronous clients) go to a bounded thread
+    pool. CPU-heavy image work (decode, resize, re-encode, perceptual hashing) goes to
+    a process pool so it does not contend for the GIL with the server; with
+    `cpu_workers=0` it runs on the thread pool instead.
+
+    Args:
+        io_workers: Threads for blocking calls
+        cpu_workers: Processes for image work, None for the CPU count, 0 for no process pool
+        max_pending: Calls handed to each pool at once, None for 4 per worker
+    """
+
+    def __init__(self, io_workers: int = 8, cpu_workers: Optional[int] = 0, max_pending: Optional[int] = None):
+        if cpu_workers is None:
+            cpu_workers = os.cpu_count() or 1
+        self.blocking = MeteredExecutor(
+            'blocking', ThreadPoolExecutor(io_workers, thread_name_prefix='step-blocking'),
+            io_workers, max_pending or 4 * io_workers)
+        self.cpu: Optional[MeteredExecutor] = None
+        if cpu_workers > 0:
+            # spawn: forking a process that already runs threads and an event loop is unsafe
+            pool = ProcessPoolExecutor(cpu_workers, mp_context=multiprocessing.get_context('spawn'))
+            self.cpu = MeteredExecutor('cpu', pool, cpu_workers, max_pending or 4 * cpu_workers)
+
+    async def run_blocking(self, fn: Callable, *args) -> Any:
+        return await self.blocking.run(fn, *args)
+
+    async def run_cpu(self, fn: Callable, *args) -> Any:
+        """`fn` and its arguments must be picklable (module-level functions) for the process pool."""
+        if self.cpu is None:
+            return await self.blocking.run(fn, *args)
+        try:
+            return await self.cpu.run(fn, *args)
+        except BrokenProcessPool as e:
+            print(f'Image worker process died ({e}), running on the thread pool')
+            return await self.blocking.run(fn, *args)
+
+    async def map_cpu(self, fn: Callable, args_list: Iterable[Tuple]) -> List[Any]:
+        return list(await asyncio.gather(*(self.run_cpu(fn, *args) for args in args_list)))
+
+    def shutdown(self, wait: bool = True):
+        self.blocking.shutdown(wait)
+        if self.cpu is not None:
+            self.cpu.shutdown(wait)
+
+    def stats(self) -> Dict:
+        return {
+            'blocking': self.blocking.stats(),
+            'cpu': self.cpu.stats() if self.cpu is not None else None,
+        }
+
+
+_default_executors: Optional[StepExecutors] = None
+_default_lock = threading.Lock()
+
+
+def get_default() -> StepExecutors:
+    """The process-wide executors shared by all agents (thread pool only unless configured)."""
+    global _default_executors
+    with _default_lock:
+        if _default_executors is None:
+            _default_executors = StepExecutors()
+        return _default_executors
+
+
+def configure(io_workers: int = 8, cpu_workers: Optional[int] = 0, max_pending: Optional[int] = None) -> StepExecutors:
+    """Replace the process-wide executors; call once at startup, before agents are created."""
+    global _default_executors
+    with _default_lock:
+        if _default_executors is not None:
+            _default_executors.shutdown(wait=False)
+        _default_executors = StepExecutors(io_workers, cpu_workers, max_pending)
+        return _default_executors
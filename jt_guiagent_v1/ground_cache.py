@@ -0,0 +1,150 @@
+import hashlib
+import io
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+try:
+    from PIL import Image
+except ImportError:  # falls back to an exact content hash
+    Image = None
+
+import screenshot
+
+HASH_SIZE = 8
+
+
+def dhash(data: bytes, hash_size: int = HASH_SIZE) -> int:
+    """64-bit difference hash; visually identical frames hash equal even after re-encoding."""
+    with Image.open(io.BytesIO(data)) as img:
+        # JPEG can decode at a reduced scale, which makes hashing a full screenshot cheap
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        pixels = list(img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def digest(data: bytes) -> int:
+    """64-bit blake2b digest of the screenshot bytes; only byte-identical frames match."""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def fingerprint(image: screenshot.ImageData, perceptual: bool = False) -> int:
+    """
+    Cache key of a screenshot (base64 or raw bytes): an exact content digest, or with
+    `perceptual` (and Pillow) a difference hash that also matches re-encoded frames.
+    A dhash only sees coarse brightness gradients, so different screens can share it.
+    """
+    data = screenshot.to_bytes(image)
+    if perceptual and Image is not None:
+        try:
+            return dhash(data)
+        except (OSError, ValueError):
+            pass
+    return digest(data)
+
+
+def normalize_target(target: str) -> str:
+    return re.sub(r'\s+', ' ', target).strip(' \t\n.,;:!?"\'').lower()
+
+
+class GroundingCache:
+    """
+    LRU/TTL cache of grounded device coordinates, keyed by screen fingerprint and
+    normalized target description.
+
+    Screens are matched on an exact content digest by default. Perceptual matching
+    is opt-in: it also reuses points across re-encoded frames, but unrelated screens
+    with a similar layout can collide and get the cached click.
+
+    Args:
+        max_entries: Entries kept before the least recently used one is evicted
+        ttl_seconds: Age after which an entry is ignored and dropped
+        perceptual: Key screens by difference hash instead of the exact digest; needs Pillow
+        max_distance: Hamming distance between perceptual hashes still treated as the
+            same screen; ignored for exact digests
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300.0, perceptual: bool = False,
+                 max_distance: int = 0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.perceptual = perceptual and Image is not None
+        self.max_distance = max_distance if self.perceptual else 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[Tuple[int, int], float]]" = OrderedDict()
+        self._by_target: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+
+    def _find_key(self, target: str, screen: int) -> Optional[Tuple[str, int]]:
+        if (target, screen) in self._entries:
+            return target, screen
+        if self.max_distance:
+            for candidate in self._by_target.get(target, ()):
+                if bin(candidate ^ screen).count('1') <= self.max_distance:
+                    return target, candidate
+        return None
+
+    def _remove(self, key: Tuple[str, int]):
+        del self._entries[key]
+        screens = self._by_target.get(key[0])
+        if screens is not None:
+            screens.discard(key[1])
+            if not screens:
+                del self._by_target[key[0]]
+
+    def get(self, screen: int, target: str) -> Optional[Tuple[int, int]]:
+        target = normalize_target(target)
+        with self._lock:
+            key = self._find_key(target, screen)
+            if key is not None:
+                point, expires_at = self._entries[key]
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return point
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def invalidate(self, screen: int, target: str):
+        """Drop the entry `get` would return for `screen` and `target`, e.g. after it missed."""
+        target = normalize_target(target)
+        with self._lock:
+            key = self._find_key(target, screen)
+            if key is not None:
+                self._remove(key)
+                self.invalidations += 1
+
+    def put(self, screen: int, target: str, point: Tuple[int, int]):
+        target = normalize_target(target)
+        with self._lock:
+            key = (target, screen)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (point, time.monotonic() + self.ttl_seconds)
+            self._by_target.setdefault(target, set()).add(screen)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
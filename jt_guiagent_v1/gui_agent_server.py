@@ -1,32 +1,50 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import asyncio
 import json
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional
 import uuid
 from pydantic import BaseModel
 from loguru import logger
 import gui_agent
+import transport
+import screenshot
+import ground_cache
+import prompt_layout
+import sessions
+import trace_writer
+import screenshot_archive
+import decoding
+import devices
+import scheduler
+import executors
+import device_frames
 import time
 import sys
 from threading import Thread
 import uvicorn
-import os
-import signal
 
 
 app = FastAPI()
 
-logger.remove()
-logger.add("./log/gui_agent_{time:YYYY-MM-DD}.log", encoding='utf-8', rotation='00:00',
-           enqueue=True, context="spawn")
+# The image workers (Config.IMAGE_WORKERS) are spawned processes that import this script
+# again as __mp_main__; they only run screenshot/ground_cache functions, so the log sink
+# and the executors are set up in the server process only
+IMAGE_WORKER = __name__ == '__mp_main__'
+
+if not IMAGE_WORKER:
+    logger.remove()
+    logger.add("./log/gui_agent_{time:YYYY-MM-DD}.log", encoding='utf-8', rotation='00:00',
+               enqueue=True, context="spawn")
 
 
 class Webclient:
-    def __init__(self):
+    def __init__(self, device_id: str = devices.DEFAULT_DEVICE_ID):
+        self.device_id = device_id
         self.websocket = None
-        self.last_msg = None
         self.connected = False
+        # Replies awaited per requestId, resolved by the receive loop
+        self.pending: Dict[str, asyncio.Future] = {}
         self.reconnect_attempts = 0
         self.max_reconnect_attempts = 3
         self.reconnect_delay = 1  # seconds
@@ -46,20 +64,29 @@ class Webclient:
                 pass
         self.websocket = None
         self.connected = False
-
-    async def send_and_receive_msg(self, data: str) -> tuple[bool, str | None]:
+        self.fail_pending("WebSocket disconnected")
+
+    def fail_pending(self, reason: str):
+        """Wake every request still waiting for a reply of this device"""
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+
+    async def send_and_receive_msg(self, data: str, request_id: str,
+                                   timeout: float = 30.0) -> tuple[bool, Dict | str | None]:
+        """Send a request and wait for the reply carrying the same requestId"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
         try:
             if not self.connected or self.websocket is None:
                 return False, "WebSocket not connected"
             await self.websocket.send_text(data)
-
-
-            current_time = time.time()
-            while time.time() - current_time < 30:  # Wait for response for up to 30 seconds
-                await asyncio.sleep(0.2)
-                if self.last_msg is None:
-                    continue
-                return True, self.last_msg
+            return True, await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"No reply to request {request_id} within {timeout}s")
+            return False, None
+        except ConnectionError as e:
+            return False, str(e)
         except WebSocketDisconnect:
             logger.warning("WebSocket disconnected during send_and_receive_msg")
             await self.disconnect()
@@ -69,34 +96,73 @@ class Webclient:
             await self.disconnect()
             return False, str(e)
         finally:
-            self.last_msg = None
-        return False, None
-
-    def receive_msg(self, msg):
-        self.last_msg = msg
-
-
+            self.pending.pop(request_id, None)
 
-client = Webclient()
+    def receive_msg(self, msg: str):
+        """Resolve the pending request a reply belongs to; late or duplicate replies are dropped"""
+        try:
+            reply = json.loads(msg)
+        except json.JSONDecodeError:
+            logger.warning(f"Device {self.device_id} sent invalid JSON")
+            return
+        self._resolve(reply)
+
+    def receive_frame(self, frame: bytes):
+        """Binary reply: JSON header plus the raw screenshot, which is kept as bytes from here on"""
+        try:
+            reply, image = device_frames.decode_frame(frame)
+        except device_frames.FrameError as e:
+            logger.warning(f"Device {self.device_id} sent an invalid frame: {e}")
+            return
+        if image:
+            reply['screenshot'] = image
+        self._resolve(reply)
+
+    def _resolve(self, reply):
+        request_id = reply.get('requestId') if isinstance(reply, dict) else None
+        if request_id is None and len(self.pending) == 1:
+            # Clients that do not echo the requestId can only have one request in flight
+            request_id = next(iter(self.pending))
+        future = self.pending.get(request_id)
+        if future is None or future.done():
+            logger.warning(f"Dropped reply for unknown or answered request {request_id}")
+            return
+        future.set_result(reply)
+
+
+
+# One Webclient per connected phone, keyed by the deviceId it sends on connect
+device_registry = devices.DeviceRegistry(Webclient)
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await client.disconnect()
+async def websocket_endpoint(websocket: WebSocket, deviceId: str = devices.DEFAULT_DEVICE_ID):
+    client = device_registry.client(deviceId)
+    await client.disconnect()  # a reconnect replaces the previous connection of this device only
     await websocket.accept()
     client.update_websocket(websocket)
+    logger.info(f"Device {deviceId} connected")
+    task_scheduler.dispatch()
 
     try:
         while True:
-            data = await websocket.receive_text()
-            client.receive_msg(data)
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(message.get('code', 1000))
+            if message.get('bytes') is not None:
+                client.receive_frame(message['bytes'])
+            elif message.get('text') is not None:
+                client.receive_msg(message['text'])
     except WebSocketDisconnect:
-        logger.warning("Client disconnected")
+        logger.warning(f"Device {deviceId} disconnected")
     except Exception as e:
-        logger.error(f"WebSocket error: {e}")
+        logger.error(f"WebSocket error on device {deviceId}: {e}")
     finally:
-        client.update_websocket(None)
+        if client.websocket is websocket:  # not yet replaced by a reconnect
+            client.update_websocket(None)
+            client.fail_pending(f"Device {deviceId} disconnected")
 
 async def get_screenshot_api(
+        client: Webclient,
         taskId: str,
         requestId: str,
         is_screenshot_needed: bool = True,
@@ -115,19 +181,20 @@ async def get_screenshot_api(
         "is_screenshot_needed": is_screenshot_needed,
         "action": action,
         "ext": ext,
+        # The device may answer with a binary frame (see device_frames) instead of base64 in JSON
+        "accept_binary": True,
     }
 
     try:
         # Send request to the client
 
         print("截图请求已发送:",request_data)
-        success, response = await client.send_and_receive_msg(json.dumps(request_data))
-        print("code:",json.loads(response)['code'])
+        success, response = await client.send_and_receive_msg(json.dumps(request_data), requestId,
+                                                            Config.DEVICE_REPLY_TIMEOUT)
         if not success:
             return {"error": "No response from client"}
-        return json.loads(response)
-    except json.JSONDecodeError:
-        return {"error": "Client returned invalid JSON"}
+        print("code:",response.get('code'))
+        return response
     except Exception as e:
         logger.error(f"Error in get_screenshot_api: {e}")
         return {"error": str(e)}
@@ -135,53 +202,192 @@ async def get_screenshot_api(
 
 class Config:
     APP_CODE = "YOUR_APP_CODE"
-    PLANNER_URL = "YOUR_PLANNER_URL"
-    GROUNDER_URL = "YOUR_GROUNDER_URL"
+    PLANNER_URL = "YOUR_PLANNER_URL"  # one url or a list of replica urls
+    GROUNDER_URL = "YOUR_GROUNDER_URL"  # one url or a list of replica urls
+    HEDGE_REQUESTS = False  # duplicate a request to another replica once it is slower than the observed p95
+    HTTP_POOL_SIZE = 16  # keep-alive connections per model host
+    WARM_UP_CONNECTIONS = 2  # connections opened per model host at startup, 0 disables warm-up
+    RETRY_POLICY = transport.RetryPolicy(
+        max_attempts=3,
+        step_budget=90.0,  # seconds shared by the planner and grounder calls of one step
+        connect_timeout=3.05,
+        read_timeout=30.0,
+    )
+    PLANNER_STREAM = False  # stream planner replies and stop at the first complete Action JSON
+    PIPELINE_GROUNDING = False  # with PLANNER_STREAM, start grounding once the streamed target is complete
+    # Per-phase screenshot preparation; None sends the device screenshot unchanged. Downscaling is
+    # opt-in, e.g. screenshot.ImagePolicy(max_side=1280, format='JPEG', quality=80); the grounder's
+    # coordinates are then mapped back to device pixels
+    PLANNER_IMAGE_POLICY: Optional[screenshot.ImagePolicy] = None
+    GROUNDER_IMAGE_POLICY: Optional[screenshot.ImagePolicy] = None
+    GROUNDING_CACHE_SIZE = 1024  # 0 disables the grounding cache
+    GROUNDING_CACHE_TTL = 300  # seconds
+    # Screens match on an exact digest; perceptual (dhash) matching is opt-in, since different
+    # screens with a similar layout can share a hash and would get the cached click
+    GROUNDING_CACHE_PERCEPTUAL = False
+    GROUNDING_CACHE_MAX_DISTANCE = 0  # dhash bits that may differ, perceptual matching only
+    # 'prefix_cache' sends the static planner instructions as a verbatim system prompt so the
+    # serving engine's prefix cache can reuse them; 'legacy' keeps the original single-block prompt
+    PLAN_PROMPT_LAYOUT = prompt_layout.LEGACY
+    PROMPT_TIME_GRANULARITY = 'hour'  # 'second', 'minute', 'hour' or 'day' (prefix_cache layout only)
+    # Planner history budget in (estimated) tokens: recent steps verbatim, repeats collapsed,
+    # older steps summarized; None sends the full history
+    HISTORY_TOKEN_BUDGET = None
+    # Agents are kept per taskId across steps
+    MAX_AGENT_SESSIONS = 256  # least recently used session is evicted beyond this
+    AGENT_SESSION_IDLE_TIMEOUT = 1800  # seconds
+    DEVICE_REPLY_TIMEOUT = 30  # seconds a device may take to answer one screenshot/action request
+    # Tasks queue per device (round-robin between tenants) instead of being rejected
+    MAX_QUEUED_TASKS = 100  # beyond this new tasks are rejected
+    MAX_QUEUE_WAIT = 600  # seconds a task may wait for a device
+    QUEUE_STATUS_INTERVAL = 5  # seconds between queue position updates on the stream
+    MAX_CONCURRENT_LLM_STEPS = 8  # agent steps calling the models at the same time
+    # Step work off the event loop: blocking calls on a thread pool, image decode/resize/
+    # re-encode/hashing on worker processes (0 runs it on the thread pool; passthrough image
+    # policies need no decoding and are prepared inline); see /v1/metrics
+    BLOCKING_WORKERS = 8
+    IMAGE_WORKERS = 2
+    EXECUTOR_MAX_PENDING = None  # calls handed to each pool at once, None for 4 per worker
+    # Per-phase token caps; guided=True constrains replies to the action-space / (x, y) grammar
+    # (needs a vLLM or SGLang server, see decoding.GUIDED_REGEX_KEYS), e.g. max_tokens=320 for the
+    # planner and 16 for the grounder. max_tokens_key='max_tokens' sends the planner cap under the
+    # OpenAI name the grounder already uses
+    PLANNER_DECODING = decoding.DecodingSpec(max_tokens=1024, guided=False, thought_chars=600)
+    GROUNDER_DECODING = decoding.DecodingSpec(max_tokens=1024, guided=False)
+
+
+step_executors = (None if IMAGE_WORKER else
+                  executors.configure(Config.BLOCKING_WORKERS, Config.IMAGE_WORKERS, Config.EXECUTOR_MAX_PENDING))
+
+# Shared by every agent so that balancing and replica health are tracked process-wide
+planner_endpoints = transport.EndpointPool(Config.PLANNER_URL, hedge=Config.HEDGE_REQUESTS)
+grounder_endpoints = transport.EndpointPool(Config.GROUNDER_URL, hedge=Config.HEDGE_REQUESTS)
+
+
+warm_up_task: Optional[asyncio.Task] = None  # referenced so the background warm-up is not collected
+
+
+@app.on_event("startup")
+async def warm_up_model_connections():
+    """Pre-open pooled connections to the model endpoints without delaying startup"""
+    transport.configure(Config.HTTP_POOL_SIZE)
+    # Remaining run_in_executor(None, ...) calls share the bounded thread pool
+    asyncio.get_running_loop().set_default_executor(step_executors.blocking.executor)
+    if Config.WARM_UP_CONNECTIONS > 0:
+        # Steps call the models through astep/apredict, i.e. the async client of this loop
+        global warm_up_task
+        warm_up_task = asyncio.create_task(transport.awarm_up(
+            planner_endpoints.urls + grounder_endpoints.urls,
+            Config.APP_CODE,
+            Config.WARM_UP_CONNECTIONS,
+        ))
+
+grounding_cache = (ground_cache.GroundingCache(Config.GROUNDING_CACHE_SIZE, Config.GROUNDING_CACHE_TTL,
+                                               Config.GROUNDING_CACHE_PERCEPTUAL,
+                                               Config.GROUNDING_CACHE_MAX_DISTANCE)
+                   if Config.GROUNDING_CACHE_SIZE > 0 else None)
+
+def create_agent(taskId: str, goal: str, screenshot: List[screenshot.ImageData], previous_actions: List[str]) -> gui_agent.GUIAgent:
+    return gui_agent.GUIAgent(
+        taskId,
+        Config.APP_CODE,
+        planner_endpoints,
+        grounder_endpoints,
+        goal,
+        screenshot,
+        previous_actions,
+        retry_policy=Config.RETRY_POLICY,
+        plan_stream=Config.PLANNER_STREAM,
+        planner_image_policy=Config.PLANNER_IMAGE_POLICY,
+        grounder_image_policy=Config.GROUNDER_IMAGE_POLICY,
+        grounding_cache=grounding_cache,
+        pipeline_grounding=Config.PIPELINE_GROUNDING,
+        plan_prompt_layout=Config.PLAN_PROMPT_LAYOUT,
+        prompt_time_granularity=Config.PROMPT_TIME_GRANULARITY,
+        history_token_budget=Config.HISTORY_TOKEN_BUDGET,
+        planner_decoding=Config.PLANNER_DECODING,
+        grounder_decoding=Config.GROUNDER_DECODING,
+        step_executors=step_executors,
+    )
+
+# One agent per running task, reused across its steps
+agent_sessions = sessions.SessionRegistry(create_agent, Config.MAX_AGENT_SESSIONS, Config.AGENT_SESSION_IDLE_TIMEOUT)
+
+# Tasks wait here for a device; steps wait for an LLM slot
+task_scheduler = scheduler.TaskScheduler(device_registry, Config.MAX_CONCURRENT_LLM_STEPS, Config.MAX_QUEUED_TASKS)
 
 class AgentRequest(BaseModel):
     modelId: str
     taskId: str
     goal: str
+    deviceId: Optional[str] = None  # None runs the task on any idle device
+    tenantId: Optional[str] = None  # queued tasks are served round-robin between tenants
     ext: Optional[Dict] = None
 
 def generate_request_id():
     return str(uuid.uuid4())
 
-def generate_action_api(taskId:str,goal: str, screenshot: List[str], previous_actions: List[str]):
+async def generate_action_api(taskId:str,goal: str, screenshot: List[screenshot.ImageData], previous_actions: List[str]):
     """
-        调用gui_agent.py 生成下一步action
+        调用gui_agent.py 生成下一步action (awaits GUIAgent.astep, the event loop stays free during LLM calls)
         参数:
         goal (str): 目标描述
         screenshot (List[str]): 截图列表
         previous_actions (List[str]): 先前的动作列表
         """
     try:
-        agent = gui_agent.GUIAgent(
-            taskId,
-            Config.APP_CODE,
-            Config.PLANNER_URL,
-            Config.GROUNDER_URL,
-            goal,
-            screenshot,
-            previous_actions
-        )
-        previous_actions, action, plan_thought, plan_action = agent.step()
+        agent = agent_sessions.get_or_create(taskId, goal, screenshot, previous_actions)
+        if agent.goal != goal:  # taskId reused for a different goal
+            agent_sessions.remove(taskId)
+            agent = agent_sessions.get_or_create(taskId, goal, screenshot, previous_actions)
+        agent.new_step(screenshot, previous_actions)
+        previous_actions, action, plan_thought, plan_action = await agent.astep()
         # print("Previous Actions:",previous_actions)
         print("Current Actions:", action)
         return previous_actions, action, plan_thought, plan_action
     except Exception as e:
         print(f"GUI Agent API 时发生错误: {e}")
-        return previous_actions, None
-
-
-def restart_server():
-    """重启服务器的函数"""
-    logger.info("正在尝试重启服务器...")
-    time.sleep(1)  # 等待1秒让原有服务完全关闭
-    os.execv(sys.executable, ['python'] + sys.argv)
-
-
-async def gui_agent_process(goal: str, taskId: str):
+        return previous_actions, None, None, None
+
+
+async def wait_for_device(ticket: scheduler.Ticket):
+    """Stream the queue position and ETA of a task until it gets a device"""
+    while not ticket.started:
+        if time.monotonic() - ticket.submitted_at > Config.MAX_QUEUE_WAIT:
+            task_scheduler.cancel(ticket)
+            return_data = {
+                "code": 200,
+                "taskId": ticket.task_id,
+                "is_finish": 1,
+                "messages": ["排队超时, 没有空闲设备"]
+            }
+            yield json.dumps(return_data, ensure_ascii=False) + "\n\n"
+            return
+        eta = task_scheduler.eta_seconds(ticket)
+        return_data = {
+            "code": 200,
+            "taskId": ticket.task_id,
+            "is_finish": 0,
+            "queue_position": task_scheduler.position(ticket),
+            "eta_seconds": None if eta is None else round(eta),
+            "messages": []
+        }
+        yield json.dumps(return_data, ensure_ascii=False) + "\n\n"
+        await task_scheduler.wait_started(ticket, Config.QUEUE_STATUS_INTERVAL)
+
+
+async def gui_agent_process(goal: str, taskId: str, ticket: scheduler.Ticket):
+    if not ticket.started:
+        try:
+            async for update in wait_for_device(ticket):
+                yield update
+        finally:
+            if not ticket.started:  # timed out or the caller went away while queued
+                task_scheduler.cancel(ticket)
+        if not ticket.started:
+            return
+    deviceId = ticket.device_id
+    client = device_registry.client(deviceId)
     try:
 
         previous_actions = []
@@ -190,7 +396,7 @@ async def gui_agent_process(goal: str, taskId: str):
         print(f'Goal: {goal}')
 
         async def get_screenshot_api_wrapper(taskId, requestId, action):
-            return await get_screenshot_api(taskId, requestId,action=action)
+            return await get_screenshot_api(client, taskId, requestId,action=action)
 
         action = None
         while True:
@@ -211,9 +417,11 @@ async def gui_agent_process(goal: str, taskId: str):
 
                 screenshot = screenshot_response['screenshot']
                 i = i + 1
-                previous_actions, action ,plan_thought, plan_action = generate_action_api(taskId,goal, [screenshot], previous_actions)
+                async with task_scheduler.llm_slot():
+                    previous_actions, action ,plan_thought, plan_action = await generate_action_api(taskId,goal, [screenshot], previous_actions)
                 log_info = {
                     "task_id":taskId,
+                    "device_id":deviceId,
                     "step_id":i,
                     "request_id":requestId,
                     "goal":goal,
@@ -221,6 +429,9 @@ async def gui_agent_process(goal: str, taskId: str):
                     "action":action,
                     "plan_thought":plan_thought,
                     "plan_action":plan_action,
+                    "grounding_cache":grounding_cache.stats() if grounding_cache else None,
+                    "agent_sessions":agent_sessions.stats(),
+                    "scheduler":task_scheduler.stats(),
                     # "screenshot":screenshot
                 }
                 logger.info(f"response info: {log_info}")
@@ -269,9 +480,9 @@ async def gui_agent_process(goal: str, taskId: str):
                     yield json.dumps(return_data, ensure_ascii=False) + "\n\n"
 
             except (GeneratorExit, asyncio.CancelledError):
-                logger.warning("客户端断开连接，准备重启服务...")
-                Thread(target=restart_server).start()
-                break
+                # Only this task ends; its agent and device are released below
+                logger.warning(f"客户端断开连接, 结束任务 {taskId}")
+                raise
 
             except Exception as e:
                 logger.error(f"处理过程中出错: {e}")
@@ -281,6 +492,10 @@ async def gui_agent_process(goal: str, taskId: str):
         logger.error(f"Error in gui_agent_process: {e}")
         await client.disconnect()
         raise
+    finally:
+        # 任务结束释放该任务的agent和设备
+        agent_sessions.remove(taskId)
+        task_scheduler.finish(ticket)
 
 
 
@@ -289,13 +504,39 @@ async def gui_agent_endpoint(request: AgentRequest):
     """SSE endpoint for GUI agent processing"""
     logger.info(f"AgentRequest: {request}")
 
-    if not client.connected:
-        return {"error": "WebSocket client not connected"}
+    try:
+        ticket = task_scheduler.submit(request.taskId, request.tenantId, request.deviceId)
+    except scheduler.DuplicateTask as e:
+        # A second run would share the first one's agent session and leak its device
+        return JSONResponse(status_code=409, content={"error": str(e)})
+    except scheduler.QueueFull as e:
+        return JSONResponse(status_code=429, content={"error": f"Server overloaded, retry later ({e})"})
     return StreamingResponse(
-        gui_agent_process(request.goal, request.taskId),
+        gui_agent_process(request.goal, request.taskId, ticket),
         media_type="text/event-stream"
     )
 
+@app.get("/v1/metrics")
+async def metrics_endpoint():
+    """Queue depths and load of the executors, scheduler, devices and caches"""
+    return {
+        "executors": step_executors.stats(),
+        "scheduler": task_scheduler.stats(),
+        "devices": device_registry.stats(),
+        "agent_sessions": agent_sessions.stats(),
+        "grounding_cache": grounding_cache.stats() if grounding_cache else None,
+        "trace_writer": trace_writer.get_default().stats(),
+        "screenshot_archive": screenshot_archive.get_default().stats(),
+    }
+
+@app.on_event("shutdown")
+async def close_model_connections():
+    await transport.aclose()
+    trace_writer.get_default().close()
+    screenshot_archive.get_default().close()
+    step_executors.shutdown(wait=False)
+
+
 def run_server():
     """Function to run the uvicorn server with error handling"""
     while True:
@@ -318,13 +559,6 @@ def start_server_in_thread():
     return server_thread
 
 if __name__ == "__main__":
-    # 设置信号处理，捕获Ctrl+C
-    def handle_sigint(signum, frame):
-        logger.info("接收到中断信号，准备重启服务...")
-        Thread(target=restart_server).start()
-
-    signal.signal(signal.SIGINT, handle_sigint)
-
     # 启动服务器
     server_thread = start_server_in_thread()
 
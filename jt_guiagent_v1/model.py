@@ -1,183 +1,464 @@
 import json
+import asyncio
+import httpx
 import requests
 import time
-import base64
-from typing import List, Optional, Union
+from concurrent import futures
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+import transport
+import screenshot
+import action_parser
+import decoding
+from plan_stream import PlanStreamParser
 
 ERROR_CALLING_LLM = 'Error calling LLM'
 
-class PlannerWrapper:
-    RETRY_WAITING_SECONDS = 20
-    MAX_RETRIES = 3
-    DEFAULT_TEMPERATURE = 0.01
-    DEFAULT_MODEL = 'PLANNER'
+# (content, HTTP status or None on a transport error, Retry-After seconds)
+_Outcome = Tuple[Optional[str], Optional[int], Optional[float]]
 
-    def __init__(self, app_code: str, url: str,
-                 temperature: float = DEFAULT_TEMPERATURE,
-                 model: str = DEFAULT_MODEL):
-        self.app_code = app_code
-        self.url = url
-        self.temperature = temperature
-        self.model = model
+# Receives (action_type, target) from a streamed planner reply before it completes
+TargetListener = Optional[Callable[[str, str], None]]
 
+def parse_point(output: Optional[str]) -> Optional[Tuple[int, int]]:
+    """The point of a grounder reply such as '(540, 1200)' or '[540, 1200]', None if there is none."""
+    if not output or output == ERROR_CALLING_LLM:
+        return None
+    point = action_parser.parse_point(output)
+    return (point.x, point.y) if point is not None else None
 
-    def _create_payload(self, system_prompt: str, user_prompt: str,
-                        images_base64: List[str]) -> dict:
-        """Create the API request payload."""
-        content = [{'type': 'text', 'text': json.dumps(user_prompt, ensure_ascii=False)}]
-
-        for image_base64 in images_base64:
-            content.append({
-                'type': 'image_url',
-                'image_url': {
-                    'url': f'data:image/jpeg;base64,{image_base64}'
-                },
-            })
 
-        return {
-            'model': self.model,
-            'temperature': self.temperature,
-            'messages': [
-                {"role": "system", "content": json.dumps(system_prompt, ensure_ascii=False)},
-                {'role': 'user', 'content': content}
-            ],
-            'max_new_tokens': 1024,
-        }
-
-    def predict(self, system_prompt: str, user_prompt: str,
-                images_base64: List[str]) -> Union[str, dict]:
+class _ChatModelWrapper:
+    DEFAULT_TEMPERATURE = 0.01
+    DEFAULT_MODEL = ''
+    MAX_TOKENS_KEY = 'max_tokens'
+    DECODING_PHASE: Optional[str] = None  # grammar used by a guided DecodingSpec
+
+    def __init__(self, app_code: str, url: Union[str, Sequence[str], transport.EndpointPool],
+                 temperature: Optional[float] = None,
+                 model: Optional[str] = None,
+                 session: Optional[requests.Session] = None,
+                 retry_policy: Optional[transport.RetryPolicy] = None,
+                 decoding_spec: Optional[decoding.DecodingSpec] = None):
         """
-        Make a prediction call to the LLM API.
-
         Args:
-            system_prompt: The system prompt
-            user_prompt: The user prompt
-            images_base64: List of base64 encoded image strings
-
-        Returns:
-            API response content or error message
+            url: One endpoint, a list of replicas, or an EndpointPool shared between
+                wrappers so that balancing and health state is process-wide
+            decoding_spec: Token cap and optional guided-decoding grammar of this phase
         """
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f"Bearer {self.app_code}",
-        }
-
-        payload = self._create_payload(system_prompt, user_prompt, images_base64)
-
-        for attempt in range(self.MAX_RETRIES):
-            try:
-                response = requests.post(
-                    self.url,
-                    headers=headers,
-                    json=payload,
-                    timeout=30
-                )
-
-                if response.ok:
-                    response_json = response.json()
-                    if 'choices' in response_json:
-                        return response_json['choices'][0]['message']['content']
-                    elif 'error' in response_json:
-                        print(f"API Error: {response_json['error']['message']}")
-
-                # Exponential backoff
-                wait_time = self.RETRY_WAITING_SECONDS * (2 ** attempt)
-                time.sleep(wait_time)
-
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed (attempt {attempt + 1}): {str(e)}")
-                wait_time = self.RETRY_WAITING_SECONDS * (2 ** attempt)
-                time.sleep(wait_time)
-
-        return ERROR_CALLING_LLM
-
-
-
-class GrounderWrapper:
-    RETRY_WAITING_SECONDS = 20
-    MAX_RETRIES = 3
-    DEFAULT_TEMPERATURE = 0.01
-    DEFAULT_MODEL = 'GROUNDER'
-
-
-    def __init__(self, app_code: str, url: str,
-                 temperature: float = DEFAULT_TEMPERATURE,
-                 model: str = DEFAULT_MODEL):
         self.app_code = app_code
-        self.url = url
-        self.temperature = temperature
-        self.model = model
+        self.endpoints = transport.EndpointPool.of(url)
+        self.url = self.endpoints.urls[0]
+        self.temperature = self.DEFAULT_TEMPERATURE if temperature is None else temperature
+        self.model = model or self.DEFAULT_MODEL
+        self.session = session or transport.get_session()
+        self.retry_policy = retry_policy or transport.DEFAULT_RETRY_POLICY
+        self.decoding_spec = decoding_spec or decoding.DEFAULT_SPEC
 
 
     def _create_payload(self, system_prompt: str, user_prompt: str,
-                        images_base64: List[str]) -> dict:
-        """Create the API request payload."""
-        content = [{'type': 'text', 'text': json.dumps(user_prompt, ensure_ascii=False)}]
-        # print(content)
-
-        for image_base64 in images_base64:
+                        images_base64: List[Union[screenshot.ImageData, screenshot.PreparedImage]],
+                        json_wrap: bool = True) -> dict:
+        """
+        Create the API request payload. With `json_wrap` the prompts are sent as JSON
+        string literals (legacy format); without it they are sent verbatim, which keeps
+        a static system prompt byte-identical across requests for prefix caching.
+        """
+        if json_wrap:
+            system_prompt = json.dumps(system_prompt, ensure_ascii=False)
+            user_prompt = json.dumps(user_prompt, ensure_ascii=False)
+        content = [{'type': 'text', 'text': user_prompt}]
+
+        for image in images_base64:
+            if isinstance(image, screenshot.PreparedImage):
+                url = image.data_url
+            else:
+                url = screenshot.data_url(image)
             content.append({
                 'type': 'image_url',
                 'image_url': {
-                    'url': f'data:image/jpeg;base64,{image_base64}'
+                    'url': url
                 },
             })
 
-        return {
+        payload = {
             'model': self.model,
             'temperature': self.temperature,
             'messages': [
-                {"role": "system", "content": json.dumps(system_prompt, ensure_ascii=False)},
+                {"role": "system", "content": system_prompt},
                 {'role': 'user', 'content': content}
             ],
-            'max_tokens': 1024,
         }
+        return self.decoding_spec.apply(payload, self.DECODING_PHASE, self.MAX_TOKENS_KEY)
+
+    def _headers(self) -> dict:
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f"Bearer {self.app_code}",
+        }
+
+    @staticmethod
+    def _extract_content(response_json: dict) -> Optional[str]:
+        if 'choices' in response_json:
+            return response_json['choices'][0]['message']['content']
+        elif 'error' in response_json:
+            print(f"API Error: {response_json['error']['message']}")
+        return None
+
+    def _read_response(self, response: requests.Response, on_target: TargetListener = None) -> Optional[str]:
+        return self._extract_content(response.json())
+
+    async def _aread_response(self, response: httpx.Response, on_target: TargetListener = None) -> Optional[str]:
+        return self._extract_content(response.json())
+
+    def _is_endpoint_failure(self, status: Optional[int]) -> bool:
+        return status is None or status >= 500 or status == 429
+
+    def _attempt(self, endpoint: transport.Endpoint, payload: dict,
+                 timeouts: Tuple[float, float], on_target: TargetListener = None) -> _Outcome:
+        start = time.monotonic()
+        outcome = (None, None, None)
+        try:
+            with self.session.post(
+                endpoint.url,
+                headers=self._headers(),
+                json=payload,
+                timeout=timeouts,
+                stream=payload.get('stream', False)
+            ) as response:
+                if response.ok:
+                    outcome = (self._read_response(response, on_target), response.status_code, None)
+                elif not self.retry_policy.is_retryable(response.status_code):
+                    print(f"Non-retryable status {response.status_code}: {response.text[:200]}")
+                    outcome = (None, response.status_code, None)
+                else:
+                    retry_after = self.retry_policy.parse_retry_after(response.headers.get('Retry-After'))
+                    outcome = (None, response.status_code, retry_after)
+
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Request to {endpoint.url} failed: {str(e)}")
+        finally:
+            self.endpoints.release(endpoint, not self._is_endpoint_failure(outcome[1]),
+                                   time.monotonic() - start)
+        return outcome
+
+    async def _aattempt(self, endpoint: transport.Endpoint, payload: dict,
+                        timeouts: Tuple[float, float], on_target: TargetListener = None) -> _Outcome:
+        connect_timeout, read_timeout = timeouts
+        client = transport.get_async_client()
+        start = time.monotonic()
+        outcome = (None, None, None)
+        cancelled = False
+        try:
+            request = client.build_request(
+                'POST',
+                endpoint.url,
+                headers=self._headers(),
+                json=payload,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+            )
+            response = await client.send(request, stream=payload.get('stream', False))
+            try:
+                if response.is_success:
+                    outcome = (await self._aread_response(response, on_target), response.status_code, None)
+                elif not self.retry_policy.is_retryable(response.status_code):
+                    await response.aread()
+                    print(f"Non-retryable status {response.status_code}: {response.text[:200]}")
+                    outcome = (None, response.status_code, None)
+                else:
+                    retry_after = self.retry_policy.parse_retry_after(response.headers.get('Retry-After'))
+                    outcome = (None, response.status_code, retry_after)
+            finally:
+                await response.aclose()
+
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Request to {endpoint.url} failed: {str(e)}")
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # A cancelled hedge loser tells nothing about the endpoint's health
+            success = None if cancelled else not self._is_endpoint_failure(outcome[1])
+            self.endpoints.release(endpoint, success, time.monotonic() - start)
+        return outcome
+
+    def _send(self, payload: dict, timeouts: Tuple[float, float], on_target: TargetListener = None) -> _Outcome:
+        """One attempt, duplicated to a second replica if the first is slower than the hedge delay."""
+        primary = self.endpoints.acquire()
+        hedge_delay = self.endpoints.hedge_delay()
+        if hedge_delay is None:
+            return self._attempt(primary, payload, timeouts, on_target)
+
+        executor = transport.get_hedge_executor()
+        first = executor.submit(self._attempt, primary, payload, timeouts, on_target)
+        try:
+            return first.result(timeout=hedge_delay)
+        except futures.TimeoutError:
+            pass
+        secondary = self.endpoints.acquire(exclude=[primary])
+        if secondary is None:
+            return first.result()
+
+        print(f"Hedging request to {secondary.url} after {hedge_delay:.2f}s")
+        pending = {first, executor.submit(self._attempt, secondary, payload, timeouts, on_target)}
+        outcome = (None, None, None)
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                outcome = future.result()
+                if outcome[0] is not None:
+                    # The slower request finishes in the background and is discarded
+                    return outcome
+        return outcome
+
+    async def _asend(self, payload: dict, timeouts: Tuple[float, float],
+                     on_target: TargetListener = None) -> _Outcome:
+        primary = self.endpoints.acquire()
+        hedge_delay = self.endpoints.hedge_delay()
+        if hedge_delay is None:
+            return await self._aattempt(primary, payload, timeouts, on_target)
+
+        first = asyncio.ensure_future(self._aattempt(primary, payload, timeouts, on_target))
+        done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+        if done:
+            return first.result()
+        secondary = self.endpoints.acquire(exclude=[primary])
+        if secondary is None:
+            return await first
+
+        print(f"Hedging request to {secondary.url} after {hedge_delay:.2f}s")
+        pending = {first, asyncio.ensure_future(self._aattempt(secondary, payload, timeouts, on_target))}
+        outcome = (None, None, None)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    outcome = task.result()
+                    if outcome[0] is not None:
+                        return outcome
+            return outcome
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _predict_payload(self, payload: dict, deadline: float, on_target: TargetListener = None) -> Optional[str]:
+        """Retry one payload within `deadline`; None when every attempt failed."""
+        policy = self.retry_policy
+        delay = 0.0
+        for attempt in range(policy.max_attempts):
+            timeouts = policy.timeouts(deadline)
+            if timeouts is None:
+                break
+            content, status, retry_after = self._send(payload, timeouts, on_target)
+            if content is not None:
+                return content
+            # Error statuses outside RETRYABLE_STATUS (400, 401, 501, 505, ...) will not heal on retry
+            if status is not None and not 200 <= status < 300 and not policy.is_retryable(status):
+                break
+            print(f"Attempt {attempt + 1} failed (status {status})")
+            if attempt == policy.max_attempts - 1:
+                break
+            delay = policy.next_delay(delay, deadline, retry_after)
+            if delay is None:
+                break
+            time.sleep(delay)
+        return None
+
+    async def _apredict_payload(self, payload: dict, deadline: float,
+                                on_target: TargetListener = None) -> Optional[str]:
+        policy = self.retry_policy
+        delay = 0.0
+        for attempt in range(policy.max_attempts):
+            timeouts = policy.timeouts(deadline)
+            if timeouts is None:
+                break
+            content, status, retry_after = await self._asend(payload, timeouts, on_target)
+            if content is not None:
+                return content
+            # Error statuses outside RETRYABLE_STATUS (400, 401, 501, 505, ...) will not heal on retry
+            if status is not None and not 200 <= status < 300 and not policy.is_retryable(status):
+                break
+            print(f"Attempt {attempt + 1} failed (status {status})")
+            if attempt == policy.max_attempts - 1:
+                break
+            delay = policy.next_delay(delay, deadline, retry_after)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        return None
 
     def predict(self, system_prompt: str, user_prompt: str,
-                images_base64: List[str]) -> Union[str, dict]:
+                images_base64: List[Union[screenshot.ImageData, screenshot.PreparedImage]],
+                deadline: Optional[float] = None, on_target: TargetListener = None,
+                json_wrap: bool = True) -> Union[str, dict]:
         """
         Make a prediction call to the LLM API.
 
         Args:
             system_prompt: The system prompt
             user_prompt: The user prompt
-            images_base64: List of base64 encoded image strings
+            images_base64: List of base64 encoded image strings or prepared screenshots
+            deadline: `time.monotonic()` timestamp bounding all attempts, a fresh
+                budget from the retry policy when omitted
+            on_target: Streaming planner only; called with (action_type, target)
+                as soon as both are decoded, before the reply is complete
+            json_wrap: Send the prompts as JSON string literals (legacy format)
 
         Returns:
             API response content or error message
         """
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f"Bearer {self.app_code}",
-        }
+        payload = self._create_payload(system_prompt, user_prompt, images_base64, json_wrap)
+        if deadline is None:
+            deadline = self.retry_policy.deadline()
+        content = self._predict_payload(payload, deadline, on_target)
+        return ERROR_CALLING_LLM if content is None else content
+
+    async def apredict(self, system_prompt: str, user_prompt: str,
+                       images_base64: List[Union[screenshot.ImageData, screenshot.PreparedImage]],
+                       deadline: Optional[float] = None, on_target: TargetListener = None,
+                       json_wrap: bool = True) -> Union[str, dict]:
+        """
+        Asyncio counterpart of `predict`; waits on the shared async client and
+        `asyncio.sleep` so the event loop keeps serving while the call is in flight.
+        """
+        payload = self._create_payload(system_prompt, user_prompt, images_base64, json_wrap)
+        if deadline is None:
+            deadline = self.retry_policy.deadline()
+        content = await self._apredict_payload(payload, deadline, on_target)
+        return ERROR_CALLING_LLM if content is None else content
 
-        payload = self._create_payload(system_prompt, user_prompt, images_base64)
 
-        for attempt in range(self.MAX_RETRIES):
-            try:
-                response = requests.post(
-                    self.url,
-                    headers=headers,
-                    json=payload,
-                    timeout=30
-                )
 
-                if response.ok:
-                    response_json = response.json()
-                    if 'choices' in response_json:
-                        return response_json['choices'][0]['message']['content']
-                    elif 'error' in response_json:
-                        print(f"API Error: {response_json['error']['message']}")
+class PlannerWrapper(_ChatModelWrapper):
+    DEFAULT_MODEL = 'PLANNER'
+    MAX_TOKENS_KEY = 'max_new_tokens'
+    DECODING_PHASE = decoding.PLAN
 
-                # Exponential backoff
-                wait_time = self.RETRY_WAITING_SECONDS * (2 ** attempt)
-                time.sleep(wait_time)
+    def __init__(self, app_code: str, url: Union[str, Sequence[str], transport.EndpointPool],
+                 stream: bool = False, **kwargs):
+        """
+        Args:
+            stream: Request an OpenAI-compatible SSE stream and stop reading as soon
+                as the `Action: {...}` JSON is balanced, instead of waiting for the
+                full completion
+        """
+        super().__init__(app_code, url, **kwargs)
+        self.stream = stream
 
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed (attempt {attempt + 1}): {str(e)}")
-                wait_time = self.RETRY_WAITING_SECONDS * (2 ** attempt)
-                time.sleep(wait_time)
+    def _create_payload(self, system_prompt: str, user_prompt: str,
+                        images_base64: List[Union[screenshot.ImageData, screenshot.PreparedImage]],
+                        json_wrap: bool = True) -> dict:
+        payload = super()._create_payload(system_prompt, user_prompt, images_base64, json_wrap)
+        if self.stream:
+            payload['stream'] = True
+        return payload
+
+    @staticmethod
+    def _feed_event(parser: PlanStreamParser, line: str) -> bool:
+        """Feed one SSE line to the parser, True once the stream can be closed."""
+        if not line.startswith('data:'):
+            return False
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return True
+        chunk = json.loads(data)
+        if 'error' in chunk:
+            print(f"API Error: {chunk['error']['message']}")
+            return True
+        choices = chunk.get('choices') or [{}]
+        delta = choices[0].get('delta') or {}
+        return parser.feed(delta.get('content') or '')
+
+    def _read_response(self, response: requests.Response, on_target: TargetListener = None) -> Optional[str]:
+        if not self.stream:
+            return super()._read_response(response)
+        parser = PlanStreamParser(on_target)
+        for line in response.iter_lines(decode_unicode=True):
+            if line and self._feed_event(parser, line):
+                break
+        return parser.text or None
+
+    async def _aread_response(self, response: httpx.Response, on_target: TargetListener = None) -> Optional[str]:
+        if not self.stream:
+            return await super()._aread_response(response)
+        parser = PlanStreamParser(on_target)
+        async for line in response.aiter_lines():
+            if line and self._feed_event(parser, line):
+                break
+        return parser.text or None
+
+
+
+class GrounderWrapper(_ChatModelWrapper):
+    DEFAULT_MODEL = 'GROUNDER'
+    MAX_TOKENS_KEY = 'max_tokens'
+    DECODING_PHASE = decoding.GROUND
+    BATCH_CONCURRENCY = 8
+
+    def _batch_payloads(self, image: Union[screenshot.ImageData, screenshot.PreparedImage], targets: Sequence[str],
+                        user_prompt_template: str, system_prompt: str) -> List[dict]:
+        """One payload per target; they share the message dicts holding the encoded image."""
+        base = self._create_payload(system_prompt, '', [image])
+        system_message, user_message = base['messages']
+        image_parts = user_message['content'][1:]
+        payloads = []
+        for target in targets:
+            text = json.dumps(user_prompt_template.format(plan_action=target), ensure_ascii=False)
+            payload = dict(base)
+            payload['messages'] = [
+                system_message,
+                {'role': 'user', 'content': [{'type': 'text', 'text': text}] + image_parts},
+            ]
+            payloads.append(payload)
+        return payloads
+
+    @staticmethod
+    def _batch_point(image: Union[screenshot.ImageData, screenshot.PreparedImage], output: Optional[str]) -> Optional[Tuple[int, int]]:
+        point = parse_point(output)
+        if point is not None and isinstance(image, screenshot.PreparedImage):
+            point = image.to_device(*point)
+        return point
+
+    def predict_batch(self, image: Union[screenshot.ImageData, screenshot.PreparedImage], targets: Sequence[str],
+                      user_prompt_template: str, system_prompt: str = "You are a helpful assistant.",
+                      deadline: Optional[float] = None) -> List[Optional[Tuple[int, int]]]:
+        """
+        Ground several target descriptions on the same screenshot.
 
-        return ERROR_CALLING_LLM
+        The image is encoded once and the per-target requests run concurrently
+        (at most BATCH_CONCURRENCY at a time) within one shared deadline.
 
+        Args:
+            image: Base64 screenshot or prepared screenshot; prepared ones are mapped
+                back to device pixels
+            targets: Element descriptions
+            user_prompt_template: Grounder prompt with a `{plan_action}` placeholder
 
+        Returns:
+            One `(x, y)` per target, None where grounding failed
+        """
+        if not targets:
+            return []
+        if deadline is None:
+            deadline = self.retry_policy.deadline()
+        payloads = self._batch_payloads(image, targets, user_prompt_template, system_prompt)
+        with futures.ThreadPoolExecutor(max_workers=min(len(payloads), self.BATCH_CONCURRENCY)) as executor:
+            outputs = list(executor.map(lambda payload: self._predict_payload(payload, deadline), payloads))
+        return [self._batch_point(image, output) for output in outputs]
+
+    async def apredict_batch(self, image: Union[screenshot.ImageData, screenshot.PreparedImage], targets: Sequence[str],
+                             user_prompt_template: str, system_prompt: str = "You are a helpful assistant.",
+                             deadline: Optional[float] = None) -> List[Optional[Tuple[int, int]]]:
+        """Asyncio counterpart of `predict_batch`."""
+        if not targets:
+            return []
+        if deadline is None:
+            deadline = self.retry_policy.deadline()
+        payloads = self._batch_payloads(image, targets, user_prompt_template, system_prompt)
+        semaphore = asyncio.Semaphore(self.BATCH_CONCURRENCY)
+
+        async def _run(payload: dict) -> Optional[str]:
+            async with semaphore:
+                return await self._apredict_payload(payload, deadline)
+
+        outputs = await asyncio.gather(*(_run(payload) for payload in payloads))
+        return [self._batch_point(image, output) for output in outputs]
@@ -0,0 +1,162 @@
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+try:  # loaded as android_world.agents.plan_history by the AndroidWorld eval agents
+    from . import prompt_layout
+except ImportError:
+    import prompt_layout
+
+EMPTY_HISTORY = 'You just started, no action has been performed yet.'
+_STEP_PATTERN = re.compile(r'^Step (\d+):\s*(.*)$', re.S)
+# Argument shown for each action type in summaries
+_SUMMARY_FIELDS = ('app_name', 'text', 'target', 'direction', 'goal_status')
+
+
+def _parse_entry(entry: str, default_step: int) -> Tuple[int, str]:
+    match = _STEP_PATTERN.match(entry)
+    if match:
+        return int(match.group(1)), match.group(2).strip()
+    return default_step, entry.strip()
+
+
+def _action_key(action: str) -> str:
+    """Canonical form so that reformatted copies of the same action collapse together."""
+    try:
+        return json.dumps(json.loads(action), ensure_ascii=False, sort_keys=True)
+    except (ValueError, TypeError):
+        return re.sub(r'\s+', ' ', action)
+
+
+def summarize_action(action: str, max_chars: int = 40) -> str:
+    """`click 'search bar'` style one-liner of a planner action."""
+    try:
+        command = json.loads(action)
+    except (ValueError, TypeError):
+        return action if len(action) <= max_chars else action[:max_chars] + '…'
+    if not isinstance(command, dict):
+        return str(command)
+    parts = [str(command.get('action_type', '?'))]
+    for field in _SUMMARY_FIELDS:
+        value = command.get(field)
+        if value:
+            value = str(value)
+            if len(value) > max_chars:
+                value = value[:max_chars] + '…'
+            parts.append(f"'{value}'" if field in ('target', 'text') else value)
+    return ' '.join(parts)
+
+
+class _Run:
+    """Consecutive steps with the same action."""
+
+    __slots__ = ('first', 'last', 'action', 'key', 'count')
+
+    def __init__(self, step: int, action: str, key: str):
+        self.first = step
+        self.last = step
+        self.action = action
+        self.key = key
+        self.count = 1
+
+    def verbatim(self) -> str:
+        if self.count == 1:
+            return f'Step {self.first}: {self.action}'
+        return f'Steps {self.first}-{self.last}: {self.action} ×{self.count}'
+
+    def summary(self) -> str:
+        text = summarize_action(self.action)
+        return text if self.count == 1 else f'{text} ×{self.count}'
+
+
+class HistoryWindow:
+    """
+    Renders the `Step N: <action>` history of one task for the planner prompt within a
+    token budget.
+
+    The last `recent_steps` steps are kept verbatim, consecutive identical actions are
+    collapsed into run-lengths, and older steps are summarized per block of `chunk_steps`
+    steps (`Steps 1-5: open_app Chrome → click 'search bar' → scroll down ×3`). A block's
+    summary is built once when the block leaves the recent window, so successive prompts
+    keep a stable prefix. If the result is still over `token_budget`, the oldest
+    summaries and then verbatim steps are dropped.
+
+    `render` is incremental: entries already seen are not parsed again as long as the
+    list only grows.
+    """
+
+    def __init__(self, token_budget: int = 1024, recent_steps: int = 5, chunk_steps: int = 5,
+                 empty_text: str = EMPTY_HISTORY):
+        self.token_budget = token_budget
+        self.recent_steps = recent_steps
+        self.chunk_steps = chunk_steps
+        self.empty_text = empty_text
+        self.reset()
+
+    def reset(self):
+        self._seen = 0
+        self._last_entry: Optional[str] = None
+        self._steps: List[Tuple[int, str, str]] = []  # (step, action, key)
+        self._summaries: List[str] = []  # one line per closed block, oldest first
+        self._summarized_steps = 0
+
+    def _extend(self, entries: List[str]):
+        if len(entries) < self._seen or (self._seen and entries[self._seen - 1] != self._last_entry):
+            self.reset()  # not an extension of what was seen: rebuild
+        for entry in entries[self._seen:]:
+            step, action = _parse_entry(entry, len(self._steps) + 1)
+            self._steps.append((step, action, _action_key(action)))
+        self._seen = len(entries)
+        self._last_entry = entries[-1] if entries else None
+
+        # Close blocks that are entirely older than the recent window
+        while len(self._steps) - self._summarized_steps - self.chunk_steps >= self.recent_steps:
+            block = self._steps[self._summarized_steps:self._summarized_steps + self.chunk_steps]
+            self._summaries.append(self._summarize(block))
+            self._summarized_steps += self.chunk_steps
+
+    @staticmethod
+    def _runs(steps: List[Tuple[int, str, str]]) -> List[_Run]:
+        runs: List[_Run] = []
+        for step, action, key in steps:
+            if runs and runs[-1].key == key:
+                runs[-1].last = step
+                runs[-1].count += 1
+            else:
+                runs.append(_Run(step, action, key))
+        return runs
+
+    def _summarize(self, block: List[Tuple[int, str, str]]) -> str:
+        runs = self._runs(block)
+        return f'Steps {block[0][0]}-{block[-1][0]}: ' + ' → '.join(run.summary() for run in runs)
+
+    def render(self, entries: List[str]) -> str:
+        """History text for the prompt; `entries` is the task's full `previous_actions`."""
+        self._extend(entries)
+        if not self._steps:
+            return self.empty_text
+
+        summaries = list(self._summaries)
+        verbatim = [run.verbatim() for run in self._runs(self._steps[self._summarized_steps:])]
+        omitted = 0
+        while True:
+            lines = ([f'Steps 1-{omitted}: (omitted)'] if omitted else []) + summaries + verbatim
+            text = '\n'.join(lines)
+            if prompt_layout.estimate_tokens(text) <= self.token_budget or len(summaries) + len(verbatim) <= 1:
+                return text
+            dropped = summaries.pop(0) if summaries else verbatim.pop(0)
+            omitted = self._last_step_of(dropped, omitted)
+
+    @staticmethod
+    def _last_step_of(line: str, default: int) -> int:
+        match = re.match(r'Steps? (\d+)(?:-(\d+))?:', line)
+        if not match:
+            return default
+        return int(match.group(2) or match.group(1))
+
+    def stats(self) -> Dict:
+        return {
+            'steps': len(self._steps),
+            'summarized_steps': self._summarized_steps,
+            'summary_blocks': len(self._summaries),
+        }
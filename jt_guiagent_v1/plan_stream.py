@@ -0,0 +1,119 @@
+import json
+import re
+from typing import Callable, Dict, Optional
+
+ACTION_MARKER = 'Action:'
+THOUGHT_MARKER = 'Thought:'
+# Only matches once the closing quote of the value has arrived
+_FIELD_PATTERNS = {
+    name: re.compile(r'"%s"\s*:\s*"((?:[^"\\]|\\.)*)"' % name)
+    for name in ('action_type', 'target')
+}
+
+
+class PlanStreamParser:
+    """
+    Incrementally parse a streamed planner reply of the form
+    `Thought: ...\nAction: {...}`.
+
+    `feed` is called with each decoded chunk and returns True as soon as the
+    JSON object after `Action:` is balanced, so the caller can close the stream
+    without waiting for trailing tokens. Braces inside JSON strings are ignored.
+
+    Args:
+        on_target: Called once with `(action_type, target)` as soon as both string
+            fields of the action are complete, while the rest is still decoding
+    """
+
+    def __init__(self, on_target: Optional[Callable[[str, str], None]] = None):
+        self.buffer = ''
+        self.complete = False
+        self.fields: Dict[str, str] = {}
+        self._on_target = on_target
+        self._action_pos = -1   # index right after 'Action:'
+        self._json_start = -1   # index of the opening '{'
+        self._json_end = -1     # index right after the closing '}'
+        self._scan_pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> bool:
+        if self.complete or not chunk:
+            return self.complete
+        self.buffer += chunk
+
+        if self._action_pos < 0:
+            start = max(0, self._scan_pos - len(ACTION_MARKER))
+            index = self.buffer.find(ACTION_MARKER, start)
+            if index < 0:
+                self._scan_pos = len(self.buffer)
+                return False
+            self._action_pos = index + len(ACTION_MARKER)
+            self._scan_pos = self._action_pos
+
+        for i in range(self._scan_pos, len(self.buffer)):
+            char = self.buffer[i]
+            if self._json_start < 0:
+                if char == '{':
+                    self._json_start = i
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._json_end = i + 1
+                    self.complete = True
+                    break
+        self._scan_pos = len(self.buffer)
+        if self._json_start >= 0 and len(self.fields) < len(_FIELD_PATTERNS):
+            self._scan_fields()
+        return self.complete
+
+    def _scan_fields(self):
+        segment = self.buffer[self._json_start:self._json_end if self.complete else None]
+        for name, pattern in _FIELD_PATTERNS.items():
+            if name in self.fields:
+                continue
+            match = pattern.search(segment)
+            if match is None:
+                continue
+            try:
+                self.fields[name] = json.loads(f'"{match.group(1)}"')
+            except json.JSONDecodeError:
+                self.fields[name] = match.group(1)
+            if len(self.fields) == len(_FIELD_PATTERNS) and self._on_target is not None:
+                self._on_target(self.fields['action_type'], self.fields['target'])
+
+    @property
+    def thought(self) -> str:
+        end = self._action_pos - len(ACTION_MARKER) if self._action_pos >= 0 else len(self.buffer)
+        return self.buffer[:end].replace(THOUGHT_MARKER, '').strip()
+
+    @property
+    def action(self) -> Optional[str]:
+        """The balanced action JSON, None until it is complete."""
+        if not self.complete:
+            return None
+        return self.buffer[self._json_start:self._json_end]
+
+    @property
+    def text(self) -> str:
+        """
+        Reply text cut after the action JSON, with anything between `Action:` and
+        the JSON (e.g. a code fence) dropped. Everything received if incomplete.
+        """
+        if self.complete:
+            return f'{self.buffer[:self._action_pos]} {self.action}'
+        return self.buffer
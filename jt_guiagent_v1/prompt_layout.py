@@ -0,0 +1,70 @@
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+LEGACY = 'legacy'
+PREFIX_CACHE = 'prefix_cache'
+
+# Stable time formats; anything finer than the prompt needs breaks the cached prefix every call
+TIME_FORMATS = {
+    'second': '%Y-%m-%d %H:%M:%S',
+    'minute': '%Y-%m-%d %H:%M',
+    'hour': '%Y-%m-%d %H:00',
+    'day': '%Y-%m-%d',
+}
+
+
+def coarse_time(granularity: str = 'hour', now: Optional[datetime.datetime] = None) -> str:
+    now = now or datetime.datetime.now()
+    return now.strftime(TIME_FORMATS[granularity])
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: ~4 characters per token for ASCII, one per CJK/other wide character."""
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    limit = min(len(a), len(b))
+    index = 0
+    # Compare in blocks first; prompts share long prefixes
+    block = 256
+    while index + block <= limit and a[index:index + block] == b[index:index + block]:
+        index += block
+    while index < limit and a[index] == b[index]:
+        index += 1
+    return index
+
+
+class PrefixCacheMeter:
+    """
+    Measures how much of each planner prompt a server-side prefix/KV cache can reuse:
+    the static prefix shared by every request, and the prefix shared with the
+    previous request of the same task.
+    """
+
+    def __init__(self, max_tasks: int = 256):
+        self.max_tasks = max_tasks
+        self._previous: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def measure(self, task_id: str, system_prompt: str, user_prompt: str, static_chars: int) -> Dict:
+        text = system_prompt + user_prompt
+        with self._lock:
+            previous = self._previous.pop(task_id, '')
+            self._previous[task_id] = text
+            while len(self._previous) > self.max_tasks:
+                self._previous.popitem(last=False)
+        shared_chars = max(static_chars, _common_prefix_length(previous, text))
+        return {
+            'total_chars': len(text),
+            'static_chars': static_chars,
+            'cacheable_chars': shared_chars,
+            'cacheable_tokens': estimate_tokens(text[:shared_chars]),
+            'total_tokens': estimate_tokens(text),
+        }
+
+
+DEFAULT_METER = PrefixCacheMeter()
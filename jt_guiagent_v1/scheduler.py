@@ -0,0 +1,209 @@
+import asyncio
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+
+import devices
+
+DEFAULT_TENANT = 'default'
+
+
+class QueueFull(Exception):
+    """Too many tasks are already waiting; the caller should retry later."""
+
+
+class DuplicateTask(Exception):
+    """A task with this id is already queued or running."""
+
+
+class Ticket:
+    """A submitted task: queued until a device is assigned, then running until finished."""
+
+    def __init__(self, seq: int, task_id: str, tenant: str, device_id: Optional[str]):
+        self.seq = seq
+        self.task_id = task_id
+        self.tenant = tenant
+        self.requested_device = device_id  # None runs on any device
+        self.device_id: Optional[str] = None
+        self.submitted_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self._started = asyncio.Event()
+
+    @property
+    def started(self) -> bool:
+        return self.device_id is not None
+
+    def competes_with(self, other: 'Ticket') -> bool:
+        """Whether both tickets may be assigned the same device."""
+        return (self.requested_device is None or other.requested_device is None
+                or self.requested_device == other.requested_device)
+
+
+class TaskScheduler:
+    """
+    Queues `/v1/gui_agent` tasks for devices and bounds the LLM-bound work.
+
+    Tasks wait per tenant in arrival order; whenever a device becomes idle the
+    tenants are visited round-robin and the first task of a tenant that may run on
+    that device (pinned to it, or to no device) gets it. At most `max_queued` tasks
+    wait, beyond that `submit` raises QueueFull; a task id that is already queued or
+    running raises DuplicateTask. Steps of running tasks additionally
+    take one of `max_llm_steps` slots around their model calls, so a burst of tasks
+    queues up instead of overloading the model endpoints.
+
+    Queue position accounts for the round-robin (each other tenant gets at most one
+    turn per own turn) and the ETA multiplies it with a moving average of past task
+    durations.
+
+    Args:
+        registry: The connected devices
+        max_llm_steps: Agent steps running their LLM calls concurrently
+        max_queued: Waiting tasks before new ones are rejected
+        initial_task_seconds: Task duration assumed for the ETA until tasks finished
+    """
+
+    def __init__(self, registry: devices.DeviceRegistry, max_llm_steps: int = 8, max_queued: int = 100,
+                 initial_task_seconds: float = 60.0):
+        self.registry = registry
+        self.max_queued = max_queued
+        self.avg_task_seconds = initial_task_seconds
+        self.completed = 0
+        self.rejected = 0
+        self._llm_slots = asyncio.Semaphore(max_llm_steps)
+        self.llm_steps_running = 0
+        self.llm_steps_waiting = 0
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()  # tenant -> waiting tickets
+        self._running: Dict[str, Ticket] = {}  # task_id -> ticket
+        self._seq = itertools.count()
+
+    def submit(self, task_id: str, tenant: Optional[str] = None, device_id: Optional[str] = None) -> Ticket:
+        if self.active(task_id):
+            raise DuplicateTask(f'Task {task_id} is already queued or running')
+        if self.queued() >= self.max_queued:
+            self.rejected += 1
+            raise QueueFull(f'{self.queued()} tasks already queued')
+        ticket = Ticket(next(self._seq), task_id, tenant or DEFAULT_TENANT, device_id)
+        self._queues.setdefault(ticket.tenant, deque()).append(ticket)
+        self.dispatch()
+        return ticket
+
+    def active(self, task_id: str) -> bool:
+        """Whether `task_id` is queued or running."""
+        return task_id in self._running or any(
+            ticket.task_id == task_id for queue in self._queues.values() for ticket in queue)
+
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _take(self, device_id: str) -> Optional[Ticket]:
+        """Next ticket for `device_id`, visiting tenants round-robin."""
+        for tenant in list(self._queues):
+            queue = self._queues[tenant]
+            for ticket in queue:
+                if ticket.requested_device in (None, device_id):
+                    queue.remove(ticket)
+                    # The served tenant goes to the back of the rotation
+                    self._queues.move_to_end(tenant)
+                    if not queue:
+                        del self._queues[tenant]
+                    return ticket
+        return None
+
+    def dispatch(self):
+        """Assign idle devices to waiting tasks; call whenever a device connects or frees up."""
+        for device_id in self.registry.idle():
+            ticket = self._take(device_id)
+            if ticket is None:
+                continue
+            ticket.device_id = self.registry.acquire(ticket.task_id, device_id)
+            ticket.started_at = time.monotonic()
+            self._running[ticket.task_id] = ticket
+            ticket._started.set()
+
+    async def wait_started(self, ticket: Ticket, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for a device; True once the ticket runs."""
+        try:
+            await asyncio.wait_for(ticket._started.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return ticket.started
+
+    def cancel(self, ticket: Ticket):
+        """Withdraw a waiting ticket (the caller went away) or finish a running one."""
+        if ticket.started:
+            self.finish(ticket)
+            return
+        queue = self._queues.get(ticket.tenant)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.tenant]
+
+    def finish(self, ticket: Ticket):
+        if self._running.pop(ticket.task_id, None) is not ticket:
+            return
+        duration = time.monotonic() - ticket.started_at
+        self.avg_task_seconds = 0.8 * self.avg_task_seconds + 0.2 * duration
+        self.completed += 1
+        self.registry.release(ticket.device_id, ticket.task_id)
+        self.dispatch()
+
+    @asynccontextmanager
+    async def llm_slot(self):
+        """`async with scheduler.llm_slot():` around the model calls of one step."""
+        self.llm_steps_waiting += 1
+        try:
+            await self._llm_slots.acquire()
+        finally:
+            self.llm_steps_waiting -= 1
+        self.llm_steps_running += 1
+        try:
+            yield
+        finally:
+            self.llm_steps_running -= 1
+            self._llm_slots.release()
+
+    def position(self, ticket: Ticket) -> int:
+        """Tasks that will get a device before `ticket` (0 = next)."""
+        if ticket.started:
+            return 0
+        own = self._queues.get(ticket.tenant, ())
+        ahead_in_tenant = sum(1 for other in own if other.seq < ticket.seq and other.competes_with(ticket))
+        position = ahead_in_tenant
+        before_in_rotation = True
+        for tenant, queue in self._queues.items():
+            if tenant == ticket.tenant:
+                before_in_rotation = False
+                continue
+            competing = sum(1 for other in queue if other.competes_with(ticket))
+            # Round-robin: another tenant is served once per turn of this one, tenants
+            # ahead in the rotation also before its first turn
+            position += min(competing, ahead_in_tenant + (1 if before_in_rotation else 0))
+        return position
+
+    def eta_seconds(self, ticket: Ticket) -> Optional[float]:
+        """Rough wait until `ticket` gets a device, None while no eligible device is connected."""
+        if ticket.started:
+            return 0.0
+        if ticket.requested_device is not None:
+            eligible = 1 if ticket.requested_device in self.registry.connected() else 0
+        else:
+            eligible = len(self.registry.connected())
+        if eligible == 0:
+            return None
+        return math.ceil((self.position(ticket) + 1) / eligible) * self.avg_task_seconds
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self.queued(),
+            'running': len(self._running),
+            'tenants_waiting': len(self._queues),
+            'llm_steps_running': self.llm_steps_running,
+            'llm_steps_waiting': self.llm_steps_waiting,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_task_seconds': round(self.avg_task_seconds, 1),
+        }
@@ -0,0 +1,162 @@
+import base64
+import io
+from typing import Optional, Tuple, Union
+
+try:
+    from PIL import Image
+except ImportError:  # resizing/re-encoding is skipped without Pillow
+    Image = None
+
+_MAGIC_MIME_TYPES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+_FORMAT_MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+# A screenshot as sent by the device: base64 text (JSON frames) or raw bytes (binary frames)
+ImageData = Union[str, bytes]
+
+
+class ImagePolicy:
+    """
+    How a screenshot is prepared for one model phase.
+
+    Args:
+        max_side: Longest side in pixels after downscaling, None keeps the resolution
+        format: 'JPEG', 'PNG' or 'WEBP' to re-encode into, None keeps the device format
+        quality: Encoder quality for JPEG/WEBP
+    """
+
+    def __init__(self, max_side: Optional[int] = None, format: Optional[str] = None, quality: int = 85):
+        self.max_side = max_side
+        self.format = format.upper() if format else None
+        self.quality = quality
+
+    @property
+    def is_passthrough(self) -> bool:
+        return self.max_side is None and self.format is None
+
+
+class PreparedImage:
+    """
+    An encoded screenshot plus what is needed to map its coordinates back to the device.
+
+    Holds either the base64 text or the raw bytes; base64 is only produced (once) when
+    a model request needs the data URL.
+    """
+
+    def __init__(self, image: ImageData, mime_type: str,
+                 size: Optional[Tuple[int, int]] = None,
+                 source_size: Optional[Tuple[int, int]] = None):
+        self._base64 = image if isinstance(image, str) else None
+        self._data = image if isinstance(image, bytes) else None
+        self.mime_type = mime_type
+        self.size = size
+        self.source_size = source_size or size
+
+    @property
+    def base64(self) -> str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self._data).decode('ascii')
+        return self._base64
+
+    @property
+    def data_url(self) -> str:
+        return f'data:{self.mime_type};base64,{self.base64}'
+
+    @property
+    def scale(self) -> Tuple[float, float]:
+        """Device pixels per image pixel along x and y."""
+        if not self.size or not self.source_size:
+            return 1.0, 1.0
+        return self.source_size[0] / self.size[0], self.source_size[1] / self.size[1]
+
+    def to_device(self, x: float, y: float) -> Tuple[int, int]:
+        scale_x, scale_y = self.scale
+        return int(round(x * scale_x)), int(round(y * scale_y))
+
+
+def strip_data_url(image_base64: str) -> str:
+    if image_base64.startswith('data:'):
+        return image_base64.split(',', 1)[1]
+    return image_base64
+
+
+def sniff_mime_type(data: bytes) -> str:
+    for magic, mime_type in _MAGIC_MIME_TYPES:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+
+def to_bytes(image: ImageData) -> bytes:
+    """The raw image bytes, decoding base64 text only when that is what the device sent."""
+    if isinstance(image, bytes):
+        return image
+    return base64.b64decode(strip_data_url(image))
+
+
+def sniff_base64_mime_type(image_base64: str) -> str:
+    """Detect the real image format from the first decoded bytes only."""
+    head = strip_data_url(image_base64)[:16]
+    try:
+        return sniff_mime_type(base64.b64decode(head))
+    except ValueError:
+        return 'image/jpeg'
+
+
+def data_url(image: ImageData) -> str:
+    if isinstance(image, bytes):
+        return PreparedImage(image, sniff_mime_type(image)).data_url
+    if image.startswith('data:'):
+        return image
+    return f'data:{sniff_base64_mime_type(image)};base64,{image}'
+
+
+def is_passthrough(policy: Optional[ImagePolicy]) -> bool:
+    """True when `prepare` only wraps the screenshot, without decoding it (cheap enough to run inline)."""
+    return policy is None or policy.is_passthrough or Image is None
+
+
+def policy_key(policy: Optional[ImagePolicy]) -> Optional[Tuple]:
+    """Equal for policies that prepare a screenshot identically, None for passthrough."""
+    if is_passthrough(policy):
+        return None
+    return policy.max_side, policy.format, policy.quality
+
+
+def prepare(image: ImageData, policy: Optional[ImagePolicy] = None) -> PreparedImage:
+    """Downscale/re-encode one screenshot (base64 or raw bytes) according to `policy`."""
+    if isinstance(image, str):
+        image = strip_data_url(image)
+    if is_passthrough(policy):
+        if isinstance(image, bytes):
+            return PreparedImage(image, sniff_mime_type(image))
+        return PreparedImage(image, sniff_base64_mime_type(image))
+
+    raw = to_bytes(image)
+    with Image.open(io.BytesIO(raw)) as img:
+        source_size = img.size
+        target_format = policy.format or img.format or 'JPEG'
+        ratio = 1.0
+        if policy.max_side and max(source_size) > policy.max_side:
+            ratio = policy.max_side / max(source_size)
+        if ratio == 1.0 and target_format == img.format:
+            return PreparedImage(image, sniff_mime_type(raw), source_size, source_size)
+
+        if ratio < 1.0:
+            size = (max(1, round(source_size[0] * ratio)), max(1, round(source_size[1] * ratio)))
+            img = img.resize(size, Image.BILINEAR)
+        if target_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        buffer = io.BytesIO()
+        img.save(buffer, format=target_format, quality=policy.quality)
+        encoded = buffer.getvalue()
+        mime_type = _FORMAT_MIME_TYPES.get(target_format, sniff_mime_type(encoded[:16]))
+        return PreparedImage(encoded, mime_type, img.size, source_size)
@@ -0,0 +1,214 @@
+import argparse
+import atexit
+import hashlib
+import json
+import mmap
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, Optional, Set, Tuple, Union
+
+import screenshot
+
+DEFAULT_ARCHIVE_DIR = 'image_save'
+INDEX_NAME = 'index.jsonl'
+
+
+def frame_key(task_id: str, step_num: int) -> str:
+    return f'{task_id}_{step_num}'
+
+
+class ScreenshotArchive:
+    """
+    Deduplicating screenshot store packed into append-only segment files.
+
+    `submit` returns immediately; a small thread pool decodes and hashes the frame,
+    and a frame whose content was stored before only gets an index entry. New content
+    is appended to the active `segment-<n>.pack` (a new segment is started past
+    `segment_bytes`). `index.jsonl` records, append-only, where each blob lives and
+    which blob each `<task_id>_<step>` frame refers to; it is replayed on start-up.
+    Sealed segments are read through mmap.
+
+    Args:
+        directory: Archive directory
+        segment_bytes: Size after which the active segment is sealed
+        workers: Threads decoding/hashing submitted frames
+    """
+
+    def __init__(self, directory: str = DEFAULT_ARCHIVE_DIR, segment_bytes: int = 256 * 1024 * 1024,
+                 workers: int = 2):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.workers = workers
+        self.duplicates = 0
+        self.stored_bytes = 0
+        self._blobs: Dict[str, Tuple[int, int, int]] = {}  # digest -> (segment, offset, length)
+        self._frames: Dict[str, str] = {}  # frame key -> digest
+        self._segment = 0
+        self._segment_file = None
+        self._index_file = None
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._pending: Set[Future] = set()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._opened = False
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'segment-{segment:06d}.pack')
+
+    def _open(self):
+        """Replay the index and reopen the active segment; called under the lock."""
+        if self._opened:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        index_path = os.path.join(self.directory, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    if 'segment' in entry:
+                        self._blobs[entry['digest']] = (entry['segment'], entry['offset'], entry['length'])
+                        self._segment = max(self._segment, entry['segment'])
+                    else:
+                        self._frames[entry['frame']] = entry['digest']
+        self._index_file = open(index_path, 'a', encoding='utf-8')
+        self._segment_file = open(self._segment_path(self._segment), 'ab')
+        self._opened = True
+        atexit.register(self.close)
+
+    def submit(self, image: Union[str, bytes], task_id: str, step_num: int) -> str:
+        """Archive one frame off the caller's thread; returns its frame key."""
+        key = frame_key(task_id, step_num)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='screenshot-archive')
+            future = self._executor.submit(self._store, image, key)
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return key
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._pending.discard(future)
+        if future.exception() is not None:
+            print(f"图片保存失败: {future.exception()}")
+
+    def _store(self, image: Union[str, bytes], key: str) -> str:
+        data = screenshot.to_bytes(image)
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        with self._lock:
+            self._open()
+            if digest in self._blobs:
+                self.duplicates += 1
+            else:
+                if self._segment_file.tell() and self._segment_file.tell() + len(data) > self.segment_bytes:
+                    self._segment_file.close()
+                    self._segment += 1
+                    self._segment_file = open(self._segment_path(self._segment), 'ab')
+                offset = self._segment_file.tell()
+                self._segment_file.write(data)
+                self._segment_file.flush()
+                self._blobs[digest] = (self._segment, offset, len(data))
+                self.stored_bytes += len(data)
+                self._index_file.write(json.dumps(
+                    {'digest': digest, 'segment': self._segment, 'offset': offset, 'length': len(data)}) + '\n')
+            self._frames[key] = digest
+            self._index_file.write(json.dumps({'frame': key, 'digest': digest}) + '\n')
+            self._index_file.flush()
+        return digest
+
+    def flush(self, timeout: Optional[float] = None):
+        """Wait until every submitted frame is stored."""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            # Outside the lock: done-callbacks still running on the workers take it
+            executor.shutdown(wait=True)
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+            for f in (self._segment_file, self._index_file):
+                if f is not None:
+                    f.close()
+            self._segment_file = self._index_file = None
+            self._opened = False
+
+    def read_blob(self, digest: str) -> Optional[bytes]:
+        with self._lock:
+            self._open()
+            location = self._blobs.get(digest)
+            if location is None:
+                return None
+            segment, offset, length = location
+            if segment == self._segment:  # still being appended to, no stable mmap
+                with open(self._segment_path(segment), 'rb') as f:
+                    f.seek(offset)
+                    return f.read(length)
+            mapped = self._maps.get(segment)
+            if mapped is None:
+                with open(self._segment_path(segment), 'rb') as f:
+                    mapped = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return mapped[offset:offset + length]
+
+    def read_frame(self, task_id: str, step_num: int) -> Optional[bytes]:
+        with self._lock:
+            self._open()
+            digest = self._frames.get(frame_key(task_id, step_num))
+        return self.read_blob(digest) if digest else None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'frames': len(self._frames),
+                'blobs': len(self._blobs),
+                'duplicates': self.duplicates,
+                'stored_bytes': self.stored_bytes,
+                'segments': self._segment + 1,
+                'pending': len(self._pending),
+            }
+
+
+_default_archive: Optional[ScreenshotArchive] = None
+_default_lock = threading.Lock()
+
+
+def get_default() -> ScreenshotArchive:
+    """The process-wide archive shared by all agents."""
+    global _default_archive
+    with _default_lock:
+        if _default_archive is None:
+            _default_archive = ScreenshotArchive()
+        return _default_archive
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract a screenshot from the archive')
+    parser.add_argument('task_id')
+    parser.add_argument('step_num', type=int)
+    parser.add_argument('--dir', default=DEFAULT_ARCHIVE_DIR, help='archive directory')
+    parser.add_argument('--out', help='file to write, <task_id>_<step_num>.<ext> by default')
+    args = parser.parse_args()
+    archive = ScreenshotArchive(args.dir)
+    data = archive.read_frame(args.task_id, args.step_num)
+    if data is None:
+        print(f'No frame {frame_key(args.task_id, args.step_num)} in {args.dir}')
+        return
+    extension = screenshot.sniff_mime_type(data).split('/')[1].replace('jpeg', 'jpg')
+    out = args.out or f'{frame_key(args.task_id, args.step_num)}.{extension}'
+    with open(out, 'wb') as f:
+        f.write(data)
+    print(f'图片已成功保存到: {out}')
+
+
+if __name__ == '__main__':
+    main()
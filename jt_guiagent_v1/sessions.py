@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class SessionRegistry(Generic[T]):
+    """
+    Live per-task objects (agents) keyed by task id, kept across steps.
+
+    Sessions idle longer than `idle_timeout` seconds are dropped on the next access;
+    once `max_sessions` are live, the least recently used one is evicted.
+
+    Args:
+        factory: Builds a new session object, called as `factory(task_id, *args, **kwargs)`
+        max_sessions: Live sessions kept before the least recently used one is evicted
+        idle_timeout: Seconds without access after which a session is dropped
+        on_evict: Called with `(task_id, session)` for every session removed
+    """
+
+    def __init__(self, factory: Callable[..., T], max_sessions: int = 256, idle_timeout: float = 1800.0,
+                 on_evict: Optional[Callable[[str, T], None]] = None):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self.created = 0
+        self.reused = 0
+        self.evictions = 0
+        self._sessions: "OrderedDict[str, list]" = OrderedDict()  # task_id -> [session, last_used]
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> list:
+        removed = []
+        while self._sessions:
+            task_id, (session, last_used) = next(iter(self._sessions.items()))
+            if now - last_used <= self.idle_timeout and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[task_id]
+            self.evictions += 1
+            removed.append((task_id, session))
+        return removed
+
+    def _notify(self, removed: list):
+        # Outside the lock: cleanup may be slow or touch the registry
+        if self.on_evict is not None:
+            for task_id, session in removed:
+                self.on_evict(task_id, session)
+
+    def get(self, task_id: str) -> Optional[T]:
+        now = time.monotonic()
+        with self._lock:
+            removed = self._expire(now)
+            entry = self._sessions.get(task_id)
+            if entry is not None:
+                entry[1] = now
+                self._sessions.move_to_end(task_id)
+        self._notify(removed)
+        return entry[0] if entry is not None else None
+
+    def get_or_create(self, task_id: str, *args, **kwargs) -> T:
+        """The live session of `task_id`, created with the factory if there is none."""
+        session = self.get(task_id)
+        if session is not None:
+            with self._lock:
+                self.reused += 1
+            return session
+        session = self.factory(task_id, *args, **kwargs)
+        with self._lock:
+            existing = self._sessions.get(task_id)
+            if existing is not None:  # created concurrently, keep the first one
+                session = existing[0]
+                existing[1] = time.monotonic()
+            else:
+                self._sessions[task_id] = [session, time.monotonic()]
+                self.created += 1
+            removed = self._expire(time.monotonic())
+        self._notify(removed)
+        return session
+
+    def remove(self, task_id: str) -> Optional[T]:
+        with self._lock:
+            entry = self._sessions.pop(task_id, None)
+        if entry is None:
+            return None
+        self._notify([(task_id, entry[0])])
+        return entry[0]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'live': len(self._sessions),
+                'created': self.created,
+                'reused': self.reused,
+                'evictions': self.evictions,
+            }
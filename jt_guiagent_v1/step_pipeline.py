@@ -0,0 +1,470 @@
+import asyncio
+import json
+from typing import Dict, List, Optional, Tuple
+
+import model
+import transport
+import screenshot
+import ground_cache
+import early_grounding
+import prompt_layout
+import plan_history
+import trace_writer
+import screenshot_archive
+import action_parser
+import decoding
+import executors
+
+GROUND_SYSTEM_PROMPT = """You are a helpful assistant."""
+
+GROUND_USER_PROMPT = """Your task is to help the user identify the precise coordinates (x, y) of a specific area/element/object on the screen based on a description.
+
+- If the description is unclear or ambiguous, infer the most relevant area or element based on its likely context or purpose.
+- Your answer should be a single string (x, y) corresponding to the point of the interest.
+
+Description: {plan_action}
+
+Answer:
+"""
+
+# Actions the planner output fully specifies; everything else needs coordinates from the grounder.
+NON_GROUNDED_ACTIONS = ['status', 'answer', 'keyboard_enter', 'navigate_home', 'navigate_back', 'wait',  'scroll','open_app','input_text']
+
+
+def history_text(history: List[str], history_window: Optional[plan_history.HistoryWindow] = None) -> str:
+    """The whole history, or its token-budgeted rendering when a window is given."""
+    if history_window is not None:
+        return history_window.render(history)
+    return '\n'.join(history) if history else 'You just started, no action has been performed yet.'
+
+
+def command_to_json(plan_action: str, command: str,
+                    image: Optional[screenshot.PreparedImage] = None) -> Optional[Dict]:
+    """`image` is the screenshot the grounder saw; its coordinates are mapped back to device pixels."""
+    try:
+        point = action_parser.parse_point(command, image.size if image is not None else None)
+        if point is None:
+            return None
+        if point.repairs:
+            print(f'Ground output repaired: {point.repairs}')
+        x, y = point.x, point.y
+        if image is not None:
+            x, y = image.to_device(x, y)
+        plan_action_command = json.loads(plan_action)
+        action_type = plan_action_command['action_type']
+
+        if action_type in ['click', 'long_press']:
+            return {'action_type': action_type, 'x': x, 'y': y}
+        elif action_type == 'input_text':
+            return {
+                'action_type': action_type,
+                'text': plan_action_command['text'],
+                'x': x,
+                'y': y
+            }
+        return None
+    except (ValueError, json.JSONDecodeError, KeyError):
+        return None
+
+
+def needs_grounding(plan_action_command: Dict) -> bool:
+    return plan_action_command.get('action_type', '') not in NON_GROUNDED_ACTIONS
+
+
+class NoAction(Exception):
+    """The step produced no usable action; `step`/`astep` return the unchanged history."""
+
+
+class StepPipeline:
+    """
+    The plan -> ground -> record step shared by the v1 and v2 agents.
+
+    `step` and `astep` run the same phases; only the model calls, image preparation
+    and hashing differ between blocking and awaited. Agents supply the planner
+    prompts and may hook in before each step or replace the planner on a step.
+    """
+
+    def __init__(self,task_id:str,app_code: str , planner_url: str, grounder_url: str, goal: str, screenshot: List[screenshot.ImageData], previous_actions: List[str],
+                 retry_policy: Optional[transport.RetryPolicy] = None, plan_stream: bool = False,
+                 planner_image_policy: Optional[screenshot.ImagePolicy] = None,
+                 grounder_image_policy: Optional[screenshot.ImagePolicy] = None,
+                 grounding_cache: Optional[ground_cache.GroundingCache] = None,
+                 pipeline_grounding: bool = False, plan_prompt_layout: str = prompt_layout.LEGACY,
+                 prompt_time_granularity: str = 'hour', history_token_budget: Optional[int] = None,
+                 trace_sink: Optional[trace_writer.TraceWriter] = None,
+                 archive: Optional[screenshot_archive.ScreenshotArchive] = None,
+                 planner_decoding: Optional[decoding.DecodingSpec] = None,
+                 grounder_decoding: Optional[decoding.DecodingSpec] = None,
+                 step_executors: Optional[executors.StepExecutors] = None):
+
+        self.retry_policy = retry_policy or transport.DEFAULT_RETRY_POLICY
+        self.plan_llm = model.PlannerWrapper(app_code=app_code, url=planner_url, stream=plan_stream,
+                                             retry_policy=self.retry_policy, decoding_spec=planner_decoding)
+        self.ground_llm = model.GrounderWrapper(app_code=app_code, url=grounder_url, retry_policy=self.retry_policy,
+                                                decoding_spec=grounder_decoding)
+        self.previous_actions = previous_actions.copy()
+        self.goal = goal
+        self.screenshot = screenshot
+        self.task_id = task_id
+        self.image_policies = {'plan': planner_image_policy, 'ground': grounder_image_policy}
+        # Prepared screenshots per screenshot.policy_key, shared by phases with the same policy
+        self._prepared_images = {}
+        self._decoded_images = None
+        self.grounding_cache = grounding_cache
+        # With a streaming planner, start grounding as soon as the target is decoded
+        self.pipeline_grounding = pipeline_grounding
+        self._fingerprint = None
+        # Target served from the grounding cache in this step and in the previous one
+        self._cache_hit_target = None
+        self._previous_cache_hit = None
+        self.plan_prompt_layout = plan_prompt_layout
+        self.prompt_time_granularity = prompt_time_granularity
+        self.last_prefix_stats = None
+        # Without a budget the full history is sent, as before
+        self.history_window = (plan_history.HistoryWindow(history_token_budget)
+                               if history_token_budget else None)
+        self.trace_sink = trace_sink or trace_writer.get_default()
+        self.archive = archive or screenshot_archive.get_default()
+        # Raw model replies of the current step, kept in the trace for the parser corpus
+        self.last_outputs = {}
+        # Bounded pools for blocking and image work of the async path
+        self.executors = step_executors or executors.get_default()
+        self._step_num = len(self.previous_actions) + 1
+
+    # Hooks for the agents
+
+    def _plan_prompts(self) -> Tuple[str, str]:
+        """(system prompt, user prompt) of the planner call."""
+        raise NotImplementedError
+
+    def _prepare_step(self):
+        """Called at the start of every step, before the time budget starts."""
+
+    async def _aprepare_step(self):
+        self._prepare_step()
+
+    def _opening_plan(self) -> Optional[Tuple[Optional[str], str]]:
+        """(thought, action JSON) that replaces the planner call on this step, None to ask the planner."""
+        return None
+
+    # Per-step state
+
+    def new_step(self, screenshot: List[screenshot.ImageData], previous_actions: Optional[List[str]] = None):
+        """
+        Reuse this agent (kept per task by the server) for the next step: swap in the new
+        screenshot and drop everything derived from the previous one.
+        """
+        self.screenshot = screenshot
+        if previous_actions is not None:
+            self.previous_actions = previous_actions.copy()
+        self._prepared_images = {}
+        self._decoded_images = None
+        self._fingerprint = None
+        self._previous_cache_hit, self._cache_hit_target = self._cache_hit_target, None
+        self.last_outputs = {}
+
+    def _decoded_screenshots(self) -> List[bytes]:
+        """
+        The screenshots as raw bytes, base64-decoded at most once per step and shared by
+        the fingerprint, the archive and the re-encoding.
+        """
+        if self._decoded_images is None:
+            self._decoded_images = [screenshot.to_bytes(image) for image in self.screenshot]
+        return self._decoded_images
+
+    def _phase_images(self, phase: str) -> List[screenshot.PreparedImage]:
+        """
+        The screenshots prepared with the 'plan' or 'ground' image policy, computed once per
+        step; both phases get the same objects (and base64 text) when their policies match.
+        """
+        policy = self.image_policies[phase]
+        key = screenshot.policy_key(policy)
+        if key not in self._prepared_images:
+            if key is None:
+                # Passthrough keeps what the device sent, no decoding
+                self._prepared_images[key] = [screenshot.prepare(image) for image in self.screenshot]
+            else:
+                self._prepared_images[key] = [screenshot.prepare(image, policy)
+                                              for image in self._decoded_screenshots()]
+        return self._prepared_images[key]
+
+    async def _aphase_images(self, phase: str) -> List[screenshot.PreparedImage]:
+        """`_phase_images` with the decoding/re-encoding done on the image workers."""
+        policy = self.image_policies[phase]
+        key = screenshot.policy_key(policy)
+        if key is None:
+            # Nothing to decode: shipping the image to a worker process costs more than wrapping it
+            return self._phase_images(phase)
+        if key not in self._prepared_images:
+            self._prepared_images[key] = await self.executors.map_cpu(
+                screenshot.prepare, [(image, policy) for image in self._decoded_screenshots()])
+        return self._prepared_images[key]
+
+    def _plan_request(self) -> Dict:
+        system_prompt, user_prompt = self._plan_prompts()
+        self.last_prefix_stats = prompt_layout.DEFAULT_METER.measure(
+            self.task_id, system_prompt, user_prompt, static_chars=len(system_prompt))
+        print(f'Planner prompt prefix: {self.last_prefix_stats}')
+        return {
+            'system_prompt': system_prompt,
+            'user_prompt': user_prompt,
+            'images_base64': self._phase_images('plan'),
+            'json_wrap': self.plan_prompt_layout != prompt_layout.PREFIX_CACHE,
+        }
+
+    # Grounding cache
+
+    def _screen_fingerprint(self) -> int:
+        if self._fingerprint is None:
+            self._fingerprint = ground_cache.fingerprint(self._decoded_screenshots()[0],
+                                                         self.grounding_cache.perceptual)
+        return self._fingerprint
+
+    async def _ascreen_fingerprint(self) -> int:
+        if self._fingerprint is None:
+            if self.grounding_cache.perceptual:
+                # Decoding and resizing for the dhash is CPU work; the exact digest is cheap inline
+                self._fingerprint = await self.executors.run_cpu(ground_cache.fingerprint,
+                                                                 self._decoded_screenshots()[0], True)
+            else:
+                self._screen_fingerprint()
+        return self._fingerprint
+
+    def _cached_ground_action(self, plan_action: str, plan_action_command: Dict) -> Optional[Dict]:
+        """The action built from a cached grounding of the same target on this screen, if any."""
+        if self.grounding_cache is None:
+            return None
+        target = plan_action_command.get('target', '')
+        if self._previous_cache_hit == ground_cache.normalize_target(target):
+            # The same target again right after a cached hit: the cached point likely missed
+            print(f'Grounding cache bypassed for repeated target: {target}')
+            self.grounding_cache.invalidate(self._screen_fingerprint(), target)
+            return None
+        point = self.grounding_cache.get(self._screen_fingerprint(), target)
+        if point is None:
+            return None
+        self._cache_hit_target = ground_cache.normalize_target(target)
+        print(f'Grounding cache hit: {point}')
+        return command_to_json(plan_action, f'({point[0]}, {point[1]})')
+
+    def _cache_ground_action(self, plan_action_command: Dict, final_action: Optional[Dict]):
+        if self.grounding_cache is not None and final_action and 'x' in final_action:
+            self.grounding_cache.put(self._screen_fingerprint(), plan_action_command.get('target', ''),
+                                     (final_action['x'], final_action['y']))
+
+    # Grounder calls
+
+    def _ground_request(self, plan_action_command: Dict) -> Optional[Dict]:
+        """Build the grounder call for actions that need coordinates, None otherwise."""
+        if not needs_grounding(plan_action_command):
+            return None
+        target = plan_action_command.get('target', '')
+        return {
+            'system_prompt': GROUND_SYSTEM_PROMPT,
+            'user_prompt': GROUND_USER_PROMPT.format(plan_action=target),
+            'images_base64': self._phase_images('ground'),
+        }
+
+    def ground_targets(self, targets: List[str]) -> List[Optional[Tuple[int, int]]]:
+        """Device coordinates of several target descriptions on the current screenshot."""
+        return self.ground_llm.predict_batch(self._phase_images('ground')[0], targets,
+                                             GROUND_USER_PROMPT, GROUND_SYSTEM_PROMPT)
+
+    async def aground_targets(self, targets: List[str]) -> List[Optional[Tuple[int, int]]]:
+        images = await self._aphase_images('ground')
+        return await self.ground_llm.apredict_batch(images[0], targets, GROUND_USER_PROMPT, GROUND_SYSTEM_PROMPT)
+
+    def _ground_output(self, plan_action_command: Dict, deadline: float) -> str:
+        return self.ground_llm.predict(**self._ground_request(plan_action_command), deadline=deadline)
+
+    async def _aground_output(self, plan_action_command: Dict, deadline: float) -> str:
+        await self._aphase_images('ground')
+        return await self.ground_llm.apredict(**self._ground_request(plan_action_command), deadline=deadline)
+
+    def _early_grounding(self, deadline: float, asynchronous: bool = False) -> Optional[early_grounding.EarlyGrounding]:
+        """Starts the grounder from the streamed target while the planner is still decoding."""
+        if not (self.pipeline_grounding and self.plan_llm.stream):
+            return None
+
+        def start(action_type: str, target: str):
+            plan_action_command = {'action_type': action_type, 'target': target}
+            if asynchronous:
+                return asyncio.ensure_future(self._aground_output(plan_action_command, deadline))
+            return early_grounding.submit(self._ground_output, plan_action_command, deadline)
+
+        return early_grounding.EarlyGrounding(start, lambda action_type: needs_grounding({'action_type': action_type}))
+
+    # Phases shared by step and astep
+
+    def _begin_step(self) -> int:
+        self._step_num = len(self.previous_actions) + 1
+        print(f'----------step {self._step_num}')
+        return self._step_num
+
+    def _read_plan(self, plan_output: str) -> Tuple[str, str]:
+        """(thought, action JSON) of the planner reply; raises NoAction if it cannot be parsed."""
+        self.last_outputs['plan'] = plan_output
+        if not plan_output:
+            raise RuntimeError('No response received from LLM in planning phase.')
+
+        plan = action_parser.parse_plan(plan_output)
+        if plan is None:
+            print("Plan-Action prompt output is not in the correct format.")
+            self._trace_unparsed()
+            raise NoAction()
+        if plan.repairs:
+            print(f'Plan output repaired: {plan.repairs}')
+        return plan.thought, plan.action
+
+    @staticmethod
+    def _plan_command(plan: Tuple[Optional[str], str]) -> Tuple[Optional[str], str, Dict]:
+        plan_thought, plan_action = plan
+        print(f'Plan_Thought: {plan_thought}')
+        print(f'Plan_Action: {plan_action}')
+        try:
+            return plan_thought, plan_action, json.loads(plan_action)
+        except json.JSONDecodeError:
+            print("Invalid JSON in plan action.")
+            raise NoAction()
+
+    def _known_action(self, plan_action: str, plan_action_command: Dict) -> Optional[Dict]:
+        """The final action without calling the grounder, None if it needs grounding."""
+        if not needs_grounding(plan_action_command):
+            return plan_action_command
+        return self._cached_ground_action(plan_action, plan_action_command)
+
+    def _grounded_action(self, plan_action: str, plan_action_command: Dict, ground_output: str) -> Optional[Dict]:
+        self.last_outputs['ground'] = ground_output
+        if not ground_output:
+            raise RuntimeError('No response received from LLM in grounding phase.')
+
+        command = ground_output.replace('Action:', '').strip()
+        if not command:
+            print('Ground-Action prompt output is not in the correct format.')
+            self._trace_unparsed()
+            raise NoAction()
+        final_action = command_to_json(plan_action, command, self._phase_images('ground')[0])
+        self._cache_ground_action(plan_action_command, final_action)
+        return final_action
+
+    # Steps
+
+    def step(self):
+        step_num = self._begin_step()
+        self._prepare_step()
+        # Planner and grounder share one time budget per step
+        deadline = self.retry_policy.deadline()
+        early = self._early_grounding(deadline)
+        try:
+            plan = self._opening_plan()
+            if plan is None:
+                # Planning phase
+                try:
+                    plan_output = self.plan_llm.predict(**self._plan_request(), deadline=deadline,
+                                                        on_target=early.on_target if early else None)
+                except Exception as e:
+                    raise RuntimeError(f'Error calling LLM in planning phase: {str(e)}')
+                plan = self._read_plan(plan_output)
+            plan_thought, plan_action, plan_action_command = self._plan_command(plan)
+
+            final_action = self._known_action(plan_action, plan_action_command)
+            if final_action is None:
+                # Grounding phase
+                pending = early.take(plan_action_command.get('target', '')) if early else None
+                try:
+                    if pending is not None:
+                        ground_output = pending.result()
+                    else:
+                        ground_output = self._ground_output(plan_action_command, deadline)
+                except Exception as e:
+                    raise RuntimeError(f'Error calling LLM in grounding phase: {str(e)}')
+                final_action = self._grounded_action(plan_action, plan_action_command, ground_output)
+        except NoAction:
+            return self.previous_actions, None,None,None
+        finally:
+            if early is not None:
+                early.cancel()
+
+        return self._record_step(step_num, plan_thought, plan_action, plan_action_command, final_action)
+
+    async def astep(self):
+        """Same as `step`, but awaits the model calls instead of blocking the event loop."""
+        step_num = self._begin_step()
+        await self._aprepare_step()
+        # Planner and grounder share one time budget per step
+        deadline = self.retry_policy.deadline()
+        early = self._early_grounding(deadline, asynchronous=True)
+        try:
+            plan = self._opening_plan()
+            if plan is None:
+                # Planning phase
+                await self._aphase_images('plan')
+                try:
+                    plan_output = await self.plan_llm.apredict(**self._plan_request(), deadline=deadline,
+                                                               on_target=early.on_target if early else None)
+                except Exception as e:
+                    raise RuntimeError(f'Error calling LLM in planning phase: {str(e)}')
+                plan = self._read_plan(plan_output)
+            plan_thought, plan_action, plan_action_command = self._plan_command(plan)
+
+            if self.grounding_cache is not None and needs_grounding(plan_action_command):
+                await self._ascreen_fingerprint()
+            final_action = self._known_action(plan_action, plan_action_command)
+            if final_action is None:
+                # Grounding phase
+                pending = early.take(plan_action_command.get('target', '')) if early else None
+                try:
+                    if pending is not None:
+                        ground_output = await pending
+                    else:
+                        ground_output = await self._aground_output(plan_action_command, deadline)
+                except Exception as e:
+                    raise RuntimeError(f'Error calling LLM in grounding phase: {str(e)}')
+                final_action = self._grounded_action(plan_action, plan_action_command, ground_output)
+        except NoAction:
+            return self.previous_actions, None,None,None
+        finally:
+            if early is not None:
+                early.cancel()
+
+        return self._record_step(step_num, plan_thought, plan_action, plan_action_command, final_action)
+
+    def _trace_unparsed(self):
+        """Keep replies the parser could not use; they are the most valuable corpus entries."""
+        self.trace_sink.write({
+            'task_id': self.task_id,
+            'goal': self.goal,
+            'step_num': self._step_num,
+            'plan_output': self.last_outputs.get('plan'),
+            'ground_output': self.last_outputs.get('ground'),
+            'parse_failed': True,
+        })
+
+    def _record_step(self, step_num: int, plan_thought: Optional[str], plan_action: str,
+                     plan_action_command: Dict, final_action: Optional[Dict]):
+        history_entry = plan_action
+        self.previous_actions.append(f'Step {step_num}: {history_entry}')
+
+
+        # save: decoded, deduplicated and packed by the archive's writer threads, which get
+        # the bytes when this step already decoded them
+        # (`python screenshot_archive.py <task_id> <step_num>` extracts a frame)
+        image = self._decoded_images[0] if self._decoded_images is not None else self.screenshot[0]
+        image_save_path = self.archive.submit(image, self.task_id, step_num)
+
+
+        new_row = {
+            'task_id':self.task_id,
+            'goal':self.goal,
+            'step_num':step_num,
+            'plan_thought':plan_thought,
+            'plan_action_command': plan_action_command,
+            'final_action': final_action,
+            'image_paths': image_save_path,
+            'plan_output': self.last_outputs.get('plan'),
+            'ground_output': self.last_outputs.get('ground'),
+        }
+        # Appended by the background writer; `python trace_writer.py` exports record_trace.xlsx
+        self.trace_sink.write(new_row)
+
+        return self.previous_actions, final_action , plan_thought, plan_action_command
@@ -0,0 +1,215 @@
+import argparse
+import atexit
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+DEFAULT_TRACE_DIR = 'trace'
+DEFAULT_PREFIX = 'record_trace'
+_STOP = object()
+
+
+class TraceWriter:
+    """
+    Append-only JSONL sink for step traces, written by one background thread.
+
+    `write` only enqueues the record, so a step never waits on the disk and concurrent
+    tasks never contend for the file. The thread appends records in batches (up to
+    `batch_size`, or whatever arrived within `flush_interval` seconds) and rotates the
+    file once it exceeds `max_bytes`: `record_trace.jsonl` is renamed to
+    `record_trace.<epoch ms>.jsonl` and a new one is started. When the queue is full
+    records are dropped (and counted) rather than blocking the caller.
+
+    Args:
+        directory: Where the JSONL files are written
+        prefix: File name prefix
+        max_bytes: Rotation threshold of the active file
+        batch_size: Records written per flush at most
+        flush_interval: Seconds a record may wait for a batch to fill up
+        max_queue: Records buffered before new ones are dropped
+    """
+
+    def __init__(self, directory: str = DEFAULT_TRACE_DIR, prefix: str = DEFAULT_PREFIX,
+                 max_bytes: int = 64 * 1024 * 1024, batch_size: int = 256, flush_interval: float = 1.0,
+                 max_queue: int = 10000):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f'{self.prefix}.jsonl')
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def write(self, record: Dict) -> bool:
+        """Queue one record; False if it was dropped."""
+        if self._closed:
+            return False
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout: Optional[float] = None):
+        """Block until everything queued so far is on disk."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done, timeout=timeout)
+        done.wait(timeout)
+
+    def close(self, timeout: float = 5.0):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        # Millisecond timestamps of equal width keep the rotated files sorted by name
+        stamp = int(time.time() * 1000)
+        while os.path.exists(os.path.join(self.directory, f'{self.prefix}.{stamp:013d}.jsonl')):
+            stamp += 1
+        os.replace(self.path, os.path.join(self.directory, f'{self.prefix}.{stamp:013d}.jsonl'))
+        self.rotations += 1
+
+    def _write_batch(self, batch: List[Dict]):
+        if not batch:
+            return
+        try:
+            self._open()
+            lines = [json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in batch]
+            self._file.write(''.join(lines))
+            self._file.flush()
+            self.written += len(batch)
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+        except Exception as e:
+            print(f"保存trace失败: {str(e)}")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch, waiters, stop = [], [], False
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stop or waiters or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+    def stats(self) -> Dict:
+        return {
+            'written': self.written,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize(),
+            'rotations': self.rotations,
+        }
+
+
+_default_writer: Optional[TraceWriter] = None
+_default_lock = threading.Lock()
+
+
+def get_default() -> TraceWriter:
+    """The process-wide writer shared by all agents."""
+    global _default_writer
+    with _default_lock:
+        if _default_writer is None:
+            _default_writer = TraceWriter()
+        return _default_writer
+
+
+def trace_files(directory: str = DEFAULT_TRACE_DIR, prefix: str = DEFAULT_PREFIX) -> List[str]:
+    """Rotated files oldest first, then the active one."""
+    rotated = sorted(glob.glob(os.path.join(directory, f'{prefix}.*.jsonl')))
+    active = os.path.join(directory, f'{prefix}.jsonl')
+    return rotated + ([active] if os.path.exists(active) else [])
+
+
+def read_records(paths: List[str]) -> List[Dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+
+def export_xlsx(paths: List[str], xlsx_path: str = 'record_trace.xlsx') -> int:
+    """Write the records of `paths` into one spreadsheet, laid out like the former record_trace.xlsx."""
+    import pandas as pd
+    records = read_records(paths)
+    df = pd.DataFrame(records)
+    for column in df.columns:
+        # Nested values (actions) were stored as their str() in the workbook
+        df[column] = df[column].map(lambda value: str(value) if isinstance(value, (dict, list)) else value)
+    df.to_excel(xlsx_path, index=False)
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export JSONL step traces to a spreadsheet')
+    parser.add_argument('--dir', default=DEFAULT_TRACE_DIR, help='trace directory')
+    parser.add_argument('--prefix', default=DEFAULT_PREFIX, help='trace file prefix')
+    parser.add_argument('--out', default='record_trace.xlsx', help='xlsx file to write')
+    args = parser.parse_args()
+    count = export_xlsx(trace_files(args.dir, args.prefix), args.out)
+    print(f'{count} records exported to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
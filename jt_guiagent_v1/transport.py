@@ -0,0 +1,305 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 16
+WARM_UP_TIMEOUT = 5
+
+_session: Optional[requests.Session] = None
+_async_client: Optional[httpx.AsyncClient] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+_pool_size = DEFAULT_POOL_SIZE
+_lock = threading.Lock()
+
+
+class RetryPolicy:
+    """
+    Retry/timeout rules shared by the model wrappers.
+
+    Every step gets a deadline of `step_budget` seconds that both the planner and
+    grounder calls draw from. Retries use decorrelated jitter, honor Retry-After,
+    and stop immediately on error statuses (4xx and 5xx) other than the ones in RETRYABLE_STATUS.
+    """
+    RETRYABLE_STATUS = (408, 425, 429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 step_budget: float = 90.0, connect_timeout: float = 3.05, read_timeout: float = 30.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.step_budget = step_budget
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def deadline(self) -> float:
+        """Start a new budget, as a `time.monotonic()` timestamp."""
+        return time.monotonic() + self.step_budget
+
+    def timeouts(self, deadline: float) -> Optional[Tuple[float, float]]:
+        """(connect, read) timeouts clipped to what is left of the budget, None once it is spent."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return min(self.connect_timeout, remaining), min(self.read_timeout, remaining)
+
+    def is_retryable(self, status_code: int) -> bool:
+        return status_code in self.RETRYABLE_STATUS
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def next_delay(self, previous: float, deadline: float,
+                   retry_after: Optional[float] = None) -> Optional[float]:
+        """
+        Delay before the next attempt, or None when waiting would leave no room
+        for another request within the deadline.
+        """
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = min(self.max_delay, random.uniform(self.base_delay, max(previous, self.base_delay) * 3))
+        if time.monotonic() + delay + self.connect_timeout >= deadline:
+            return None
+        return delay
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class Endpoint:
+    LATENCY_WINDOW = 200
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+
+    def is_healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+
+class EndpointPool:
+    """
+    Replicas of one model service.
+
+    `acquire` picks the healthy endpoint with the fewest requests in flight.
+    An endpoint that fails `eject_after` times in a row is skipped for
+    `eject_seconds`. With `hedge` enabled, `hedge_delay` returns the observed
+    latency percentile after which a duplicate request should go to another replica.
+    """
+
+    def __init__(self, urls: Union[str, Sequence[str]], eject_after: int = 3, eject_seconds: float = 30.0,
+                 hedge: bool = False, hedge_percentile: float = 0.95, hedge_min_samples: int = 20):
+        if isinstance(urls, str):
+            urls = [urls]
+        if not urls:
+            raise ValueError('EndpointPool needs at least one url')
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, urls: Union[str, Sequence[str], 'EndpointPool']) -> 'EndpointPool':
+        return urls if isinstance(urls, cls) else cls(urls)
+
+    @property
+    def urls(self) -> List[str]:
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def acquire(self, exclude: Sequence[Endpoint] = ()) -> Optional[Endpoint]:
+        """
+        Reserve the least loaded endpoint. With `exclude` only other healthy
+        endpoints qualify and None is returned when there is none; otherwise an
+        ejected endpoint is still returned when every replica is ejected.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e.is_healthy(now) and e not in exclude]
+            if not candidates:
+                if exclude:
+                    return None
+                candidates = self.endpoints
+            endpoint = min(candidates, key=lambda e: (e.outstanding, e.consecutive_failures))
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, success: Optional[bool], latency: Optional[float] = None):
+        """Return a reservation; `success` None (e.g. a cancelled hedge) leaves health untouched."""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success:
+                endpoint.consecutive_failures = 0
+                if latency is not None:
+                    endpoint.latencies.append(latency)
+            elif success is not None:
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.eject_after:
+                    endpoint.ejected_until = time.monotonic() + self.eject_seconds
+                    print(f"Endpoint ejected for {self.eject_seconds}s: {endpoint.url}")
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, None when hedging is off or not yet calibrated."""
+        if not self.hedge or len(self.endpoints) < 2:
+            return None
+        with self._lock:
+            samples = sorted(latency for e in self.endpoints for latency in e.latencies)
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile))]
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'url': e.url,
+                'outstanding': e.outstanding,
+                'consecutive_failures': e.consecutive_failures,
+                'healthy': e.is_healthy(now),
+            } for e in self.endpoints]
+
+
+def _build_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _build_async_client(pool_size: int) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    return httpx.AsyncClient(limits=limits)
+
+
+def configure(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """(Re)build the shared session with `pool_size` keep-alive connections per host."""
+    global _session, _async_client, _pool_size
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _pool_size = pool_size
+        _session = _build_session(pool_size)
+        # Rebuilt lazily inside the running event loop on next use
+        _async_client = None
+        return _session
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """Threads running the blocking duplicates of hedged requests."""
+    global _hedge_executor
+    with _lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=_pool_size, thread_name_prefix='hedge')
+        return _hedge_executor
+
+
+def get_session() -> requests.Session:
+    """Return the process-wide keep-alive session shared by all model wrappers."""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = _build_session(_pool_size)
+        return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Return the shared pooled client used by the `apredict` coroutines of the running loop."""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    with _lock:
+        # Pooled connections belong to the loop that opened them
+        if _async_client is None or _async_client.is_closed or _async_client_loop is not loop:
+            _async_client = _build_async_client(_pool_size)
+            _async_client_loop = loop
+        return _async_client
+
+
+async def aclose():
+    """Close the shared async client, e.g. on server shutdown."""
+    global _async_client
+    with _lock:
+        client, _async_client = _async_client, None
+    if client is not None:
+        await client.aclose()
+
+
+def warm_up(urls: Iterable[str], app_code: str, connections: int = 1) -> int:
+    """
+    Open `connections` keep-alive connections to every url so the first task
+    does not pay TCP/TLS setup. Any HTTP status counts as a warm connection.
+
+    Returns:
+        Number of connections that were established
+    """
+    session = get_session()
+    headers = {'Authorization': f"Bearer {app_code}"}
+    targets = [url for url in dict.fromkeys(urls) if url] * max(connections, 0)
+    if not targets:
+        return 0
+
+    def _touch(url: str) -> bool:
+        try:
+            session.head(url, headers=headers, timeout=WARM_UP_TIMEOUT)
+            return True
+        except requests.exceptions.RequestException as e:
+            print(f"Warm-up failed for {url}: {str(e)}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=min(len(targets), _pool_size)) as executor:
+        warmed = sum(executor.map(_touch, targets))
+    print(f"Warm-up finished: {warmed}/{len(targets)} connections ready")
+    return warmed
+
+
+async def awarm_up(urls: Iterable[str], app_code: str, connections: int = 1) -> int:
+    """
+    Same as `warm_up` for the async client that `apredict` uses; call it on the loop
+    that serves the requests, since pooled connections belong to their loop.
+
+    Returns:
+        Number of connections that were established
+    """
+    client = get_async_client()
+    headers = {'Authorization': f"Bearer {app_code}"}
+    targets = [url for url in dict.fromkeys(urls) if url] * max(connections, 0)
+    if not targets:
+        return 0
+
+    async def _touch(url: str) -> bool:
+        try:
+            await client.head(url, headers=headers, timeout=WARM_UP_TIMEOUT)
+            return True
+        except httpx.HTTPError as e:
+            print(f"Warm-up failed for {url}: {str(e)}")
+            return False
+
+    # Concurrent requests make the client open one connection each, up to its pool limit
+    warmed = sum(await asyncio.gather(*(_touch(url) for url in targets)))
+    print(f"Async warm-up finished: {warmed}/{len(targets)} connections ready")
+    return warmed
@@ -0,0 +1,113 @@
+import os
+import pickle
+import threading
+import time
+from typing import Dict, Optional
+
+DEFAULT_KB_PATH = 'APP_Usage_Guide_KB.xlsx'
+CACHE_VERSION = 1
+
+
+def normalize_app_name(app_name: str) -> str:
+    return str(app_name).strip().lower()
+
+
+class AppGuideKB:
+    """
+    App Usage Guide knowledge base compiled once into a dict keyed by normalized app name.
+
+    The workbook is only parsed (with pandas) when it changed; the compiled dict is also
+    pickled next to it so a restarted process skips the Excel parsing altogether. The
+    workbook's mtime is re-checked at most every `check_interval` seconds, lookups
+    themselves are a plain dict access.
+
+    Args:
+        path: The APP_Usage_Guide_KB.xlsx workbook (columns app_name, usage_notes)
+        cache_path: Where to persist the compiled dict, None for `<path>.cache.pkl`,
+            '' to disable persisting
+        check_interval: Seconds between mtime checks for hot reload
+    """
+
+    def __init__(self, path: str = DEFAULT_KB_PATH, cache_path: Optional[str] = None, check_interval: float = 5.0):
+        self.path = path
+        self.cache_path = path + '.cache.pkl' if cache_path is None else cache_path
+        self.check_interval = check_interval
+        self.notes: Dict[str, object] = {}
+        self._signature = None
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load_cache(self, signature) -> Optional[Dict[str, object]]:
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, 'rb') as f:
+                cached = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        if cached.get('version') != CACHE_VERSION or cached.get('signature') != signature:
+            return None
+        return cached['notes']
+
+    def _save_cache(self, signature, notes: Dict[str, object]):
+        if not self.cache_path:
+            return
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'version': CACHE_VERSION, 'signature': signature, 'notes': notes}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f'App guide cache not written: {e}')
+
+    def _compile(self) -> Dict[str, object]:
+        import pandas as pd
+        df = pd.read_excel(self.path)
+        notes = {}
+        for app_name, usage_notes in zip(df['app_name'], df['usage_notes']):
+            if isinstance(app_name, str):
+                # The first row of an app wins, as with the former mask lookup
+                notes.setdefault(normalize_app_name(app_name), usage_notes)
+        return notes
+
+    def reload(self, force: bool = False):
+        """Recompile if the workbook changed since the last load (or always with `force`)."""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            signature = self._file_signature()
+            if signature == self._signature and not force:
+                return
+            notes = None if force else self._load_cache(signature)
+            if notes is None:
+                notes = self._compile()
+                self._save_cache(signature, notes)
+            self.notes = notes
+            self._signature = signature
+            print(f'App usage guide loaded: {len(notes)} apps from {self.path}')
+
+    def lookup(self, app_name: Optional[str]):
+        """usage_notes of `app_name`, None if the app is not in the knowledge base."""
+        if self._signature is None or time.monotonic() - self._checked_at > self.check_interval:
+            self.reload()
+        if app_name is None:
+            return None
+        return self.notes.get(normalize_app_name(app_name))
+
+
+_instances: Dict[str, AppGuideKB] = {}
+_instances_lock = threading.Lock()
+
+
+def get_kb(path: str = DEFAULT_KB_PATH) -> AppGuideKB:
+    """The process-wide knowledge base of `path`, shared by all agents."""
+    key = os.path.abspath(path)
+    with _instances_lock:
+        kb = _instances.get(key)
+        if kb is None:
+            kb = _instances[key] = AppGuideKB(path)
+        return kb
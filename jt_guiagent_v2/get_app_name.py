@@ -1,6 +1,9 @@
-import  os
 import json
-import model
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
 
 app_code =""
 url = ""
@@ -27,18 +30,252 @@ App List: {APP_NAME_LIST}
 Expected response:"""
 
 
+# Keywords that point to one app without naming it; matched on word boundaries. Generic nouns
+# ("photos", "note", "music", "map") are left out, they show up in goals for many apps
+APP_ALIASES = {
+    "Camera": ["take a photo", "take a picture", "take a selfie", "record a video"],
+    "Chrome": ["browser", "web browser"],
+    "Clock": ["alarm", "timer", "stopwatch"],
+    "Contacts": ["address book"],
+    "Dialer": ["phone call", "dial"],
+    "Files": ["file manager", "downloads folder"],
+    "Settings": ["wifi", "wi-fi", "bluetooth", "brightness", "airplane mode", "ringtone"],
+    "Markor": ["markdown"],
+    "Tasks": ["tasks app", "to-do list"],
+    "Simple Draw Pro": ["simple draw"],
+    "Simple Gallery Pro": ["simple gallery"],
+    "Simple SMS Messenger": ["simple sms", "sms", "text message"],
+    "Audio Recorder": ["audio recorder", "record audio", "audio recording", "voice recording"],
+    "Pro Expense": ["pro expense", "expense", "expenses"],
+    "Broccoli APP": ["broccoli"],
+    "OSMand": ["osmand maps"],
+    "VLC": ["vlc player"],
+    "Joplin": [],
+    "Retro Music": [],
+    "OpenTracks": ["open tracks", "activity tracking"],
+    "Simple Calendar Pro": ["simple calendar", "calendar event"],
+}
+
+
+# App names that are also everyday words ("my contacts", "the settings"); in lower case they
+# are weaker evidence than a proper mention ("Contacts", "the contacts app")
+COMMON_WORD_NAMES = {"Camera", "Clock", "Contacts", "Files", "Settings", "Tasks"}
+NAME_WEIGHT = 1.0
+COMMON_WORD_WEIGHT = 0.5
+
+
+def normalize_goal(goal: str) -> str:
+    return re.sub(r'\s+', ' ', goal).strip().lower()
+
+
+def _char_ngrams(text: str, n: int = 3) -> Counter:
+    grams = Counter()
+    for word in re.findall(r'[\w-]+', text.lower()):
+        padded = f' {word} '
+        for i in range(max(1, len(padded) - n + 1)):
+            grams[padded[i:i + n]] += 1
+    return grams
+
+
+class LocalAppRecognizer:
+    """
+    Picks the app to open first for a goal without calling a model.
+
+    An app name mentioned in the goal and each alias keyword count as one signal; a
+    name that is an everyday word only counts half unless written like a name. The
+    signals plus a character-trigram TF-IDF similarity against each app's profile
+    (name, aliases and, if given, its App Usage Guide notes) form the score, and the
+    confidence is the margin of the best app over the runner-up, so a goal pointing to
+    two apps ("... in the file manager, open it with Chrome") gets a low confidence.
+    A goal that does not name the best app gets confidence 0: keywords alone are a
+    guess and are left to the LLM.
+
+    Args:
+        app_names: The apps to choose from
+        aliases: Extra keywords per app
+        guide_notes: Optional usage notes per app name, added to the TF-IDF profiles
+    """
+
+    def __init__(self, app_names: Iterable[str] = APP_NAME_LIST, aliases: Dict[str, List[str]] = APP_ALIASES,
+                 guide_notes: Optional[Dict[str, str]] = None):
+        self.app_names = list(app_names)
+        guide_notes = {k.strip().lower(): v for k, v in (guide_notes or {}).items()}
+        self._name_patterns = {
+            app: re.compile(r'(?<![\w-])%s(?![\w-])' % re.escape(app.lower())) for app in self.app_names
+        }
+        # Case-sensitive, for telling "Contacts" from "my contacts"
+        self._proper_name_patterns = {
+            app: re.compile(r'(?<![\w-])%s(?![\w-])|(?<![\w-])%s app\b' % (re.escape(app), re.escape(app.lower())))
+            for app in self.app_names if app in COMMON_WORD_NAMES
+        }
+        # The name itself is scored as the name signal, not again as an alias
+        self._alias_patterns = {
+            app: [re.compile(r'(?<![\w-])%s(?![\w-])' % re.escape(alias.lower()))
+                  for alias in aliases.get(app, []) if alias.lower() != app.lower()]
+            for app in self.app_names
+        }
+        profiles = {}
+        for app in self.app_names:
+            notes = guide_notes.get(app.lower())
+            text = ' '.join([app] + aliases.get(app, []) + ([notes] if isinstance(notes, str) else []))
+            profiles[app] = _char_ngrams(text)
+        document_frequency = Counter(gram for grams in profiles.values() for gram in grams)
+        self._idf = {gram: math.log((1 + len(profiles)) / (1 + df)) + 1.0 for gram, df in document_frequency.items()}
+        self._profiles = {app: self._tfidf(grams) for app, grams in profiles.items()}
+
+    def _tfidf(self, grams: Counter) -> Dict[str, float]:
+        vector = {gram: count * self._idf[gram] for gram, count in grams.items() if gram in self._idf}
+        norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+        return {gram: value / norm for gram, value in vector.items()}
+
+    def _name_weight(self, app: str, goal: str) -> float:
+        pattern = self._proper_name_patterns.get(app)
+        if pattern is None or pattern.search(goal):
+            return NAME_WEIGHT
+        return COMMON_WORD_WEIGHT
+
+    def predict(self, goal: str) -> Tuple[Optional[str], float]:
+        """(app name, confidence in [0, 1]); (None, 0.0) when nothing matches."""
+        cased = re.sub(r'\s+', ' ', goal).strip()
+        text = cased.lower()
+        named = [app for app, pattern in self._name_patterns.items() if pattern.search(text)]
+        # A name that is part of a longer matched name was not mentioned on its own
+        named = [app for app in named if not any(app != other and app.lower() in other.lower() for other in named)]
+
+        goal_vector = self._tfidf(_char_ngrams(text))
+        scores = {}
+        proper_names = set()
+        for app in self.app_names:
+            evidence = sum(1.0 for pattern in self._alias_patterns[app] if pattern.search(text))
+            if app in named:
+                name_weight = self._name_weight(app, cased)
+                evidence += name_weight
+                if name_weight == NAME_WEIGHT:
+                    proper_names.add(app)
+            similarity = sum(weight * self._profiles[app].get(gram, 0.0) for gram, weight in goal_vector.items())
+            scores[app] = evidence + similarity
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        (best, best_score), (_, second_score) = ranked[0], ranked[1]
+        if best_score < 1.0:  # no full signal: similarity alone is not evidence
+            return None, 0.0
+        if best not in proper_names:
+            return best, 0.0
+        return best, (best_score - second_score) / best_score
+
+
+class GoalMemo:
+    """Bounded LRU memo of normalized goal -> app name."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, goal: str) -> Optional[str]:
+        key = normalize_goal(goal)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def put(self, goal: str, app_name: str):
+        key = normalize_goal(goal)
+        with self._lock:
+            self._entries[key] = app_name
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# Shared by every finder so that all tasks of a process benefit from each other's answers
+DEFAULT_MEMO = GoalMemo()
+_default_recognizers: Dict[Optional[str], Tuple[object, LocalAppRecognizer]] = {}
+_default_lock = threading.Lock()
+
+
+def default_recognizer(guide_kb=None) -> LocalAppRecognizer:
+    """
+    The shared recognizer, with the usage notes of `guide_kb` (an app_guide_kb.AppGuideKB)
+    in its TF-IDF profiles; rebuilt when the knowledge base was reloaded.
+    """
+    notes = {}
+    if guide_kb is not None:
+        try:
+            guide_kb.lookup(None)  # loads the workbook, or reloads it if it changed
+            notes = guide_kb.notes
+        except (OSError, ValueError, KeyError) as e:
+            print(f'App usage guide not used for app recognition: {e}')
+    key = guide_kb.path if guide_kb is not None else None
+    with _default_lock:
+        cached = _default_recognizers.get(key)
+        # A reload replaces the notes dict, so identity tells whether the profiles are stale
+        if cached is None or cached[0] is not notes:
+            cached = _default_recognizers[key] = (notes, LocalAppRecognizer(guide_notes=notes))
+        return cached[1]
+
+
 class APPNAMEFinder():
-    def __init__(self):
-        self.llm = model.GrounderWrapper(app_code=app_code, url=url)
+    """
+    Args:
+        session: Pooled HTTP session for the fallback LLM
+        llm: Model used below the confidence threshold, a GrounderWrapper by default
+        recognizer: Local fast path, the shared default recognizer when omitted
+        guide_kb: App Usage Guide knowledge base whose notes extend the default recognizer
+        confidence_threshold: Local answers below this go to the LLM
+        memo: goal -> app memo, shared process-wide by default; None disables it. Only
+            confident local answers and LLM answers are memoized
+    """
+
+    def __init__(self, session=None, llm=None, recognizer: Optional[LocalAppRecognizer] = None,
+                 guide_kb=None, confidence_threshold: float = 0.6, memo: Optional[GoalMemo] = DEFAULT_MEMO):
+        # Shares the pooled keep-alive transport with the planner/grounder wrappers
+        if llm is None:
+            # Imported here so the eval agents, which pass their own llm, do not need model.py
+            import model
+            llm = model.GrounderWrapper(app_code=app_code, url=url, session=session)
+        self.llm = llm
+        self.recognizer = recognizer
+        self.guide_kb = guide_kb
+        self.confidence_threshold = confidence_threshold
+        self.memo = memo
+
+    def get_app_name(self, goal: str) -> Optional[str]:
+        """The app to open first, None if neither the recognizer nor the LLM found one."""
+        if self.memo is not None:
+            app_name = self.memo.get(goal)
+            if app_name is not None:
+                return app_name
+        recognizer = self.recognizer or default_recognizer(self.guide_kb)
+        app_name, confidence = recognizer.predict(goal)
+        print(f'Local app recognizer: {app_name} ({confidence:.2f})')
+        if app_name is None or confidence < self.confidence_threshold:
+            # A low-confidence local guess is not used: a wrong app would be opened unchecked
+            app_name = self._llm_app_name(goal)
+        if app_name is not None and self.memo is not None:
+            self.memo.put(goal, app_name)
+        return app_name
 
-    def get_app_name(self, goal: str):
+    def _llm_app_name(self, goal: str) -> Optional[str]:
         prompt = PROMPT_TEMPLATE.format(goal=goal,APP_NAME_LIST=APP_NAME_LIST)
         system_prompt = "You are a helpful assistant."
-        output, is_safe, raw_response = self.llm.predict(
+        output = self.llm.predict(
             system_prompt = system_prompt,
             user_prompt =prompt,
             images_base64=[]
         )
+        # Some wrappers return (output, is_safe, raw_response)
+        if isinstance(output, tuple):
+            output = output[0]
+        if not isinstance(output, str):
+            return None
         output = output.replace('```json','').replace('```','').strip()
         print(output)
-        return json.loads(output)['app_name']
+        try:
+            app_name = json.loads(output)['app_name']
+        except (ValueError, KeyError, TypeError):
+            return None
+        # "None" and names outside the list count as no answer
+        if not isinstance(app_name, str):
+            return None
+        return next((app for app in APP_NAME_LIST if app.lower() == app_name.strip().lower()), None)
@@ -1,14 +1,18 @@
 
 import json
-import model
-from typing import List, Dict, Optional, Tuple
+import prompt_layout
+import plan_history
+import step_pipeline
+from typing import List, Optional, Tuple
 import datetime
-import pandas as  pd
-import os
-import base64
 import get_app_name
+import app_guide_kb
 
-PLAN_PROMPT_TEMPLATE = """# Role: Android Phone Operator AI
+APP_NAME_LIST = '["Camera","Chrome","Clock","Contacts","Dialer","Files","Settings","Markor","Tasks","Simple Draw Pro","Simple Gallery Pro","Simple SMS Messenger","Audio Recorder","Pro Expense","Broccoli APP","OSMand","VLC","Joplin","Retro Music","OpenTracks","Simple Calendar Pro"]'
+
+# The planner prompt is kept in pieces: the legacy layout interleaves them with the
+# per-step fields, the prefix-cache layout moves everything static to the system prompt.
+PLAN_INSTRUCTIONS = """# Role: Android Phone Operator AI
 You are an AI that controls an Android phone to complete user requests. Your responsibilities:
 - Answer questions by retrieving information from the phone.
 - Perform tasks by executing precise actions.
@@ -57,17 +61,21 @@ Respond with EXACT JSON format for one of these actions:
    - When guidance conflicts with actual situation, prioritize what you see on screen
 
 
-# Current Context
+"""
+
+PLAN_CONTEXT_TEMPLATE = """# Current Context
 - User Goal: `{goal}`
 - Previous Actions: `{history}`
-- Available Apps: `["Camera","Chrome","Clock","Contacts","Dialer","Files","Settings","Markor","Tasks","Simple Draw Pro","Simple Gallery Pro","Simple SMS Messenger","Audio Recorder","Pro Expense","Broccoli APP","OSMand","VLC","Joplin","Retro Music","OpenTracks","Simple Calendar Pro"]`
+- Available Apps: `{app_name_list}`
 - Current Time: {current_time}
 - App Usage Guide:
   - app_name: `{ref_app_name}`
   - usage_notes: `{ref_usage_notes}`
 
 
-# Decision Process
+"""
+
+PLAN_DECISION_PROCESS = """# Decision Process
 1. Analyze goal, history, and current screen
 2. Check App Usage Guide's app_name and usage_notes for guidance
 3. Determine if task is already complete (use `status` if true)
@@ -80,200 +88,103 @@ Respond with EXACT JSON format for one of these actions:
 Thought: [Analysis including reference to key steps/points when applicable]
 Action: [Single JSON action]
 
-Your Response:"""
+"""
 
-GROUND_SYSTEM_PROMPT = """You are a helpful assistant."""
+PLAN_ANSWER = """Your Response:"""
 
-GROUND_USER_PROMPT = """Your task is to help the user identify the precise coordinates (x, y) of a specific area/element/object on the screen based on a description.
+PLAN_PROMPT_TEMPLATE = PLAN_INSTRUCTIONS + PLAN_CONTEXT_TEMPLATE + PLAN_DECISION_PROCESS + PLAN_ANSWER
 
-- If the description is unclear or ambiguous, infer the most relevant area or element based on its likely context or purpose.
-- Your answer should be a single string (x, y) corresponding to the point of the interest.
+# Prefix-cache layout: identical for every step and task, sent verbatim as the system prompt
+PLAN_SYSTEM_PROMPT = (PLAN_INSTRUCTIONS + """# Available Apps
+- Available Apps: `{app_name_list}`
 
-Description: {plan_action}
 
-Answer:
-"""
+""" + PLAN_DECISION_PROCESS).format(app_name_list=APP_NAME_LIST)
+
+# Volatile fields, least to most frequently changing: goal and guide are fixed for a task
+# and the history only grows, so the previous step's prompt stays a prefix of this one
+PLAN_VOLATILE_TEMPLATE = """# Current Context
+- User Goal: `{goal}`
+- App Usage Guide:
+  - app_name: `{ref_app_name}`
+  - usage_notes: `{ref_usage_notes}`
+- Current Time: {current_time}
+- Previous Actions: `{history}`
+
 
+""" + PLAN_ANSWER
 
-def _plan_prompt(goal: str, history: List[str],ref_app_name: str,ref_usage_notes: str) -> str:
-    history_str = '\n'.join(history) if history else 'You just started, no action has been performed yet.'
+def _plan_prompt(goal: str, history: List[str],ref_app_name: str,ref_usage_notes: str,
+                 history_window: Optional[plan_history.HistoryWindow] = None) -> str:
+    history_str = step_pipeline.history_text(history, history_window)
     current_time = datetime.datetime.now()
     formatted_time = current_time.strftime('%Y-%m-%d %H:%M:%S')
     return PLAN_PROMPT_TEMPLATE.format(goal=goal, history=history_str,current_time=formatted_time,ref_app_name = ref_app_name,
-        ref_usage_notes = ref_usage_notes)
-
-
-def _command_to_json(plan_action: str, command: str) -> Optional[Dict]:
-        try:
-            string = command.strip('()')
-            x, y = map(int, string.split(','))
-            plan_action_command = json.loads(plan_action)
-            action_type = plan_action_command['action_type']
-
-            if action_type in ['click', 'long_press']:
-                return {'action_type': action_type, 'x': x, 'y': y}
-            elif action_type == 'input_text':
-                return {
-                    'action_type': action_type,
-                    'text': plan_action_command['text'],
-                    'x': x,
-                    'y': y
-                }
-            return None
-        except (ValueError, json.JSONDecodeError, KeyError):
-            return None
-
-
-class GUIAgent:
-    def __init__(self,task_id:str,app_code: str , planner_url: str, grounder_url: str, goal: str, screenshot: List[str], previous_actions: List[str],):
-
-        self.plan_llm = model.PlannerWrapper(app_code=app_code, url=planner_url)
-        self.ground_llm = model.GrounderWrapper(app_code=app_code, url=grounder_url)
-        self.previous_actions = previous_actions.copy()
-        self.goal = goal
-        self.screenshot = screenshot
-        self.task_id = task_id
-        self.ref_appname_finder = get_app_name.APPNAMEFinder()
+        ref_usage_notes = ref_usage_notes, app_name_list=APP_NAME_LIST)
+
+
+def _prefix_plan_prompt(goal: str, history: List[str], ref_app_name: str, ref_usage_notes: str,
+                        time_granularity: str = 'hour',
+                        history_window: Optional[plan_history.HistoryWindow] = None) -> str:
+    """User prompt of the prefix-cache layout; `PLAN_SYSTEM_PROMPT` carries the instructions."""
+    history_str = step_pipeline.history_text(history, history_window)
+    return PLAN_VOLATILE_TEMPLATE.format(goal=goal, history=history_str,
+                                         current_time=prompt_layout.coarse_time(time_granularity),
+                                         ref_app_name=ref_app_name, ref_usage_notes=ref_usage_notes)
+
+
+class GUIAgent(step_pipeline.StepPipeline):
+    """
+    The v2 agent: the shared plan -> ground step with the v2 planner prompt, which
+    carries the App Usage Guide of the app recognized from the goal; the first step
+    opens that app without asking the planner.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.app_guidance_excel = 'APP_Usage_Guide_KB.xlsx'
+        self.ref_appname_finder = get_app_name.APPNAMEFinder(guide_kb=app_guide_kb.get_kb(self.app_guidance_excel))
         self.ref_app_name = None
         self.ref_usage_notes = None
+        # Set once the app was looked up, also when none was found, so the LLM is asked once per task
+        self.app_guide_resolved = False
 
-
-    def step(self):
-        step_num = len(self.previous_actions) + 1
-
-        if not self.ref_app_name:
+    def _prepare_step(self):
+        if not self.app_guide_resolved:
             self.ref_app_name = self.ref_appname_finder.get_app_name(self.goal)
-            df = pd.read_excel(self.app_guidance_excel)
-            mask = df['app_name'].str.strip().str.lower() == self.ref_app_name.strip().lower()
-            matches = df[mask]
-            self.ref_usage_notes =  matches.iloc[0]['usage_notes']
-
-        # Planning phase
-        plan_prompt = _plan_prompt(
-            self.goal,
-            self.previous_actions,
-            self.ref_app_name,
-            self.ref_usage_notes
-        )
-        screenshot = self.screenshot
-
-        if self.ref_app_name and self.previous_actions == []:
+            self.ref_usage_notes = app_guide_kb.get_kb(self.app_guidance_excel).lookup(self.ref_app_name)
+            self.app_guide_resolved = True
 
-            plan_action_command = {"action_type":"open_app","app_name":self.ref_app_name}
-            plan_action = json.dumps(plan_action_command,ensure_ascii=False)
-            plan_thought = None
-            print('----------step ' + str(len(self.previous_actions) + 1))
+    async def _aprepare_step(self):
+        if not self.app_guide_resolved:
+            # App recognition and the KB lookup are synchronous, keep them off the loop
+            await self.executors.run_blocking(self._prepare_step)
 
+    def _opening_plan(self) -> Optional[Tuple[None, str]]:
+        """The first step opens the recognized app directly, without asking the planner."""
+        if self.ref_app_name is not None and self.previous_actions == []:
+            plan_action_command = {"action_type":"open_app","app_name":self.ref_app_name}
+            return None, json.dumps(plan_action_command,ensure_ascii=False)
+        return None
+
+    def _plan_prompts(self) -> Tuple[str, str]:
+        if self.plan_prompt_layout == prompt_layout.PREFIX_CACHE:
+            system_prompt = PLAN_SYSTEM_PROMPT
+            plan_prompt = _prefix_plan_prompt(
+                self.goal,
+                self.previous_actions,
+                self.ref_app_name,
+                self.ref_usage_notes,
+                self.prompt_time_granularity,
+                self.history_window
+            )
         else:
-
             system_prompt = "You are a helpful assistant."
-
-            try:
-
-                plan_output = self.plan_llm.predict(
-                    system_prompt=system_prompt,
-                    user_prompt=plan_prompt,
-                    images_base64=screenshot
-                )
-
-            except Exception as e:
-                raise RuntimeError(f'Error calling LLM in planning phase: {str(e)}')
-
-            if not plan_output:
-                raise RuntimeError('No response received from LLM in planning phase.')
-
-            try:
-                plan_thought = plan_output.split('Action:')[0].replace('Thought:','').strip()
-                plan_action = plan_output.split('Action:')[1].split('Thought:')[0].strip()
-
-            except IndexError:
-                print("Plan-Action prompt output is not in the correct format.")
-                return self.previous_actions, None,None,None
-
-        print(f'Plan_Thought: {plan_thought}')
-        print(f'Plan_Action: {plan_action}')
-
-        try:
-            plan_action_command = json.loads(plan_action)
-            action_type = plan_action_command.get('action_type', '')
-            if action_type in ['status', 'answer', 'keyboard_enter', 'navigate_home', 'navigate_back', 'wait',  'scroll','open_app','input_text']:
-                final_action = plan_action_command
-            else:
-                # Grounding phase
-                ground_system_prompt = GROUND_SYSTEM_PROMPT
-                target = plan_action_command.get('target', '')
-
-                ground_user_prompt = GROUND_USER_PROMPT.format(plan_action=target)
-                try:
-                    ground_output = self.ground_llm.predict(
-                        system_prompt=ground_system_prompt,
-                        user_prompt=ground_user_prompt,
-                        images_base64=screenshot
-                    )
-                except Exception as e:
-                    raise RuntimeError(f'Error calling LLM in grounding phase: {str(e)}')
-
-                if not ground_output:
-                    raise RuntimeError('No response received from LLM in grounding phase.')
-
-                command = ground_output.replace('Action:', '').strip()
-
-                if not command:
-                    print('Ground-Action prompt output is not in the correct format.')
-                    return self.previous_actions, None
-
-                final_action = _command_to_json(plan_action, command)
-
-        except json.JSONDecodeError:
-            print("Invalid JSON in plan action.")
-            return self.previous_actions, None
-
-
-        history_entry = plan_action
-        self.previous_actions.append(f'Step {step_num}: {history_entry}')
-
-
-        # save
-        save_dir = 'image_save/'
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-        image_name = self.task_id+'_'+str(step_num)+'.jpg'
-        image_save_path = os.path.join(save_dir, image_name)
-
-        base64_data = screenshot[0]
-        if base64_data.startswith('data:'):
-            base64_data = base64_data.split(',', 1)[1]
-        image_data = base64.b64decode(base64_data)
-        with open(image_save_path, 'wb') as f:
-            f.write(image_data)
-
-        print(f"图片已成功保存到: {image_save_path}")
-
-
-        new_row = {
-            'task_id':self.task_id,
-            'goal':self.goal,
-            'step_num':step_num,
-            'plan_thought':plan_thought,
-            'plan_action_command': plan_action_command,
-            'final_action': final_action,
-            'image_paths': image_save_path
-        }
-        try:
-            df = pd.DataFrame([new_row])
-            excel_path = 'record_trace.xlsx'
-
-            if not os.path.exists(excel_path):
-                df.to_excel(excel_path, index=False)
-            else:
-                with pd.ExcelWriter(excel_path, mode='a', engine='openpyxl',
-                                    if_sheet_exists='overlay') as writer:
-                    sheet_name = writer.sheets['Sheet1'].title
-                    startrow = writer.sheets[sheet_name].max_row
-                    df.to_excel(writer, index=False, header=False, startrow=startrow)
-
-        except Exception as e:
-            print(f"保存到Excel失败: {str(e)}")
-
-        return self.previous_actions, final_action , plan_thought, plan_action_command
+            plan_prompt = _plan_prompt(
+                self.goal,
+                self.previous_actions,
+                self.ref_app_name,
+                self.ref_usage_notes,
+                self.history_window
+            )
+        return system_prompt, plan_prompt